@@ -1,14 +1,174 @@
-from flask import Flask, request, send_file, render_template_string, jsonify
+from flask import Flask, Response, g, redirect, request, send_file, render_template_string, jsonify
 import qrcode
+from qrcode import util as qrutil
 import io
 import requests
 from PIL import Image
+import numpy as np
 from urllib.parse import urlparse
+import argparse
 import base64
+import bisect
+import csv
 import json
+import math
+import gc
+import hashlib
+import hmac
+import re
 import os
+import pickle
+import struct
+import zlib
+import collections
+import contextlib
+import contextvars
+import itertools
+import logging
+import logging.handlers
+import sys
+import time
+import tracemalloc
+import atexit
+import queue
+import random
+import resource
+import sqlite3
+import threading
+import shutil
+import signal
+import zipfile
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import redis
+except ImportError:  # Solo hace falta con QR_STORAGE_URL=redis://...
+    redis = None
 
 app = Flask(__name__)
+# Proxies de confianza delante de la app: con N > 0, request.remote_addr es la IP
+# que vio el último de ellos en X-Forwarded-For y no lo que diga el cliente
+TRUSTED_PROXIES = int(os.environ.get('QR_TRUSTED_PROXIES', '0'))
+if TRUSTED_PROXIES > 0:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Logging estructurado: una línea JSON por evento, escrita por un hilo de fondo
+# para que las peticiones nunca se bloqueen en stdout. Cada evento lleva el id de
+# correlación de la petición (o del trabajo); los DEBUG solo se emiten en una
+# fracción de las peticiones y los errores repetidos se limitan por ventana.
+LOG_LEVEL = os.environ.get('QR_LOG_LEVEL', 'INFO').upper()
+LOG_DEBUG_SAMPLE = float(os.environ.get('QR_LOG_DEBUG_SAMPLE', '0'))
+LOG_RATE_WINDOW = float(os.environ.get('QR_LOG_RATE_WINDOW', '60'))
+LOG_RATE_KEYS_MAX = 1024
+
+# (id de correlación, si el contexto está muestreado para DEBUG)
+contexto_log = contextvars.ContextVar('contexto_log', default=(None, False))
+
+class FormatoJSON(logging.Formatter):
+    CAMPOS_ESTANDAR = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        evento = {
+            'ts': round(record.created, 3),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        evento.update((k, v) for k, v in vars(record).items() if k not in self.CAMPOS_ESTANDAR)
+        return json.dumps(evento, default=str, ensure_ascii=False)
+
+class FiltroContexto(logging.Filter):
+    """Añade el id de correlación, muestrea DEBUG y limita errores repetidos
+
+    Corre en el hilo que registra el evento, antes de encolarlo. Solo se
+    limitan los avisos que lo piden con extra={'limitar': clave}: uno por
+    (plantilla, clave) y ventana; el resto siempre se emite.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.nivel = logging.getLevelName(LOG_LEVEL)
+        self._ultimos = {}  # (plantilla, clave de 'limitar') -> [instante, suprimidos]
+        self._lock = threading.Lock()
+        self._formato = logging.Formatter()
+        self.suprimidos = 0
+
+    def filter(self, record):
+        correlacion, muestreado = contexto_log.get()
+        if record.levelno < self.nivel:
+            if correlacion is None:
+                muestreado = random.random() < LOG_DEBUG_SAMPLE
+            if not muestreado:
+                return False
+        if correlacion is not None:
+            record.request_id = correlacion
+        if record.exc_info:
+            # QueueHandler descarta exc_info al encolar: guardar ya la traza como campo
+            record.exc = self._formato.formatException(record.exc_info)
+            record.exc_info = None
+
+        limitar = record.__dict__.pop('limitar', None)
+        if limitar is not None and record.levelno >= logging.WARNING:
+            clave = (record.msg, str(limitar))
+            ahora = time.monotonic()
+            with self._lock:
+                ultimo = self._ultimos.get(clave)
+                if ultimo is not None and ahora - ultimo[0] < LOG_RATE_WINDOW:
+                    ultimo[1] += 1
+                    self.suprimidos += 1
+                    return False
+                if ultimo is not None and ultimo[1]:
+                    record.suprimidos = ultimo[1]
+                _guardar_acotado(self._ultimos, clave, [ahora, 0], LOG_RATE_KEYS_MAX)
+        return True
+
+def configurar_logging():
+    """Logger 'qr' con QueueHandler; el QueueListener escribe en stdout desde su propio hilo"""
+    cola = queue.SimpleQueue()
+    manejador = logging.handlers.QueueHandler(cola)
+    manejador.addFilter(FiltroContexto())
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoJSON())
+    oyente = logging.handlers.QueueListener(cola, salida)
+    oyente.start()
+    atexit.register(oyente.stop)
+
+    registro = logging.getLogger('qr')
+    registro.addHandler(manejador)
+    registro.propagate = False
+    # Sin muestreo de DEBUG, descartar en el propio logger sin crear el registro
+    registro.setLevel(logging.DEBUG if LOG_DEBUG_SAMPLE > 0 else LOG_LEVEL)
+    return registro
+
+log = configurar_logging()
+
+@app.before_request
+def asignar_correlacion():
+    """Id de correlación de la petición (X-Request-Id si viene del proxy) y decisión de muestreo"""
+    correlacion = request.headers.get('X-Request-Id') or os.urandom(8).hex()
+    g.request_id = correlacion[:64]
+    g.inicio_peticion = time.perf_counter()
+    g.token_log = contexto_log.set((g.request_id, random.random() < LOG_DEBUG_SAMPLE))
+
+@app.after_request
+def registrar_peticion(response):
+    response.headers['X-Request-Id'] = g.get('request_id', '')
+    if 'inicio_peticion' in g:
+        log.info("peticion", extra={
+            'metodo': request.method, 'ruta': request.path, 'status': response.status_code,
+            'ms': round((time.perf_counter() - g.inicio_peticion) * 1000, 2)
+        })
+    return response
+
+@app.teardown_request
+def limpiar_correlacion(exc=None):
+    token = g.pop('token_log', None)
+    if token is not None:
+        contexto_log.reset(token)
 
 # Diccionario para almacenar el historial de QRs por usuario
 user_qr_history = {}
@@ -572,7 +732,8 @@ HTML = '''
         <div id="generate" class="tab-content active">
             <p style="color: #718096; margin-bottom: 30px;">¡Crea códigos QR súper rápido!</p>
             <form action="/" method="post">
-                <input name="data" placeholder="🔗 Pega tu enlace o texto aquí" required>
+                <input name="data" id="dataInput" placeholder="🔗 Pega tu enlace o texto aquí" required oninput="schedulePreview()">
+                <img id="livePreview" alt="Vista previa" style="display: none; width: 160px; margin: 0 auto 20px; image-rendering: pixelated;">
                 <button type="submit">🚀 ¡Generar QR!</button>
             </form>
         </div>
@@ -607,6 +768,34 @@ HTML = '''
     <script src="https://unpkg.com/jsqr@1.4.0/dist/jsQR.js"></script>
     <script>
         let video, canvas, context, scanning = false;
+        let previewTimer = null, previewController = null;
+
+        // Vista previa en vivo: espera a que se deje de escribir y cancela la petición anterior
+        function schedulePreview() {
+            clearTimeout(previewTimer);
+            previewTimer = setTimeout(updatePreview, 250);
+        }
+
+        async function updatePreview() {
+            const data = document.getElementById('dataInput').value.trim();
+            const img = document.getElementById('livePreview');
+            if (previewController) previewController.abort();
+            if (!data) {
+                img.style.display = 'none';
+                return;
+            }
+            previewController = new AbortController();
+            try {
+                const response = await fetch('/qr_preview?' + new URLSearchParams({ data: data }), { signal: previewController.signal });
+                if (!response.ok) return;
+                const blob = await response.blob();
+                if (img.src.startsWith('blob:')) URL.revokeObjectURL(img.src);
+                img.src = URL.createObjectURL(blob);
+                img.style.display = 'block';
+            } catch (e) {
+                if (e.name !== 'AbortError') console.error('Error en la vista previa', e);
+            }
+        }
         let scannedData = '';
         let currentUser = null;
 
@@ -866,143 +1055,983 @@ def hex_to_rgb(hex_color):
 
         return (r, g, b)
     except (ValueError, TypeError, AttributeError) as e:
-        print(f"Error en hex_to_rgb con color '{hex_color}': {e}")
+        log.warning("Color inválido en hex_to_rgb: %r", hex_color, extra={'error': str(e), 'limitar': hex_color})
         # Color por defecto en caso de error
         return (0, 0, 0)
 
-# Inserta el logo en el centro del QR
-def generar_qr_personalizado(data, logo_url=None, bg_color="#ffffff", qr_color="#000000", qr_style="square", qr_size="medium", include_logo=True):
-    print(f"Generando QR con colores: QR={qr_color}, Fondo={bg_color}")
+# Configuración del QR según el tamaño elegido
+QR_SIZE_MAP = {
+    "small": {"version": 1, "box_size": 8, "border": 3},
+    "medium": {"version": 1, "box_size": 10, "border": 4},
+    "large": {"version": 1, "box_size": 12, "border": 5}
+}
+
+# Codificación por segmentos: qr.add_data(data) solo separa tramos numéricos o
+# alfanuméricos de 20+ caracteres; aquí se elige el modo de cada carácter con
+# programación dinámica sobre el coste en bits. Los costes van en sextos de bit
+# para que numérico (10/3 bits) y alfanumérico (11/2 bits) sean enteros.
+SEGMENT_MODES = (qrutil.MODE_NUMBER, qrutil.MODE_ALPHA_NUM, qrutil.MODE_8BIT_BYTE)
+# Los bits del contador de caracteres cambian en las versiones 10 y 27
+SEGMENT_VERSION_GROUPS = ((1, 9), (10, 26), (27, 40))
+
+def _coste_caracter(modo, caracter):
+    """Coste en sextos de bit de un carácter en el modo dado, o None si no es representable"""
+    if modo == qrutil.MODE_NUMBER:
+        return 20 if '0' <= caracter <= '9' else None
+    if modo == qrutil.MODE_ALPHA_NUM:
+        return 33 if caracter.encode('utf-8') in qrutil.ALPHA_NUM else None
+    return len(caracter.encode('utf-8')) * 48
+
+def segmentar_optimo(data, version):
+    """Parte data en segmentos de modo mixto con el mínimo de bits para la versión dada.
+
+    Devuelve (segmentos, bits) con segmentos como lista de (modo, texto).
+    """
+    bits_cuenta = qrutil.mode_sizes_for_version(version)
+    cabecera = {modo: (4 + bits_cuenta[modo]) * 6 for modo in SEGMENT_MODES}
+    redondear = lambda coste: -(-coste // 6) * 6
+
+    # costes[modo]: mínimo para lo ya codificado terminando en un segmento de ese modo
+    costes = dict(cabecera)
+    cambios = []
+    for caracter in data:
+        actuales = {}
+        for modo in SEGMENT_MODES:
+            coste = _coste_caracter(modo, caracter)
+            if coste is not None:
+                actuales[modo] = costes[modo] + coste
+        # Abrir un segmento nuevo tras este carácter cierra el anterior en un bit entero
+        cambio = {}
+        costes = dict(actuales)
+        for modo in SEGMENT_MODES:
+            for previo, coste in actuales.items():
+                candidato = redondear(coste) + cabecera[modo]
+                if previo != modo and candidato < costes.get(modo, math.inf):
+                    costes[modo] = candidato
+                    cambio[modo] = previo
+        cambios.append(cambio)
+
+    if not data:
+        return [], 0
+    modo = min(costes, key=costes.get)
+    bits = redondear(costes[modo]) // 6
+
+    # Reconstruir el modo de cada carácter de atrás hacia delante
+    modos = []
+    for cambio in reversed(cambios):
+        modo = cambio.get(modo, modo)
+        modos.append(modo)
+    modos.reverse()
+
+    segmentos = []
+    inicio = 0
+    for fin in range(1, len(data) + 1):
+        if fin == len(data) or modos[fin] != modos[inicio]:
+            segmentos.append((modos[inicio], data[inicio:fin]))
+            inicio = fin
+    return segmentos, bits
+
+def segmentos_optimos(data, error_correction=qrcode.constants.ERROR_CORRECT_M):
+    """Devuelve (version, segmentos) con la versión mínima en la que cabe data, o None si no cabe"""
+    for primera, ultima in SEGMENT_VERSION_GROUPS:
+        segmentos, bits = segmentar_optimo(data, primera)
+        for version in range(primera, ultima + 1):
+            if bits <= qrutil.BIT_LIMIT_TABLE[error_correction][version]:
+                return version, segmentos
+    return None
+
+def cabe_en_qr(data, error_correction=qrcode.constants.ERROR_CORRECT_M):
+    """Si data cabe en algún QR; sin segmentar cuando cabe entero en modo byte en la versión 40
+
+    Ni en modo numérico (10 bits por 3 dígitos) cabe más de bits * 3 / 10
+    caracteres: por encima se descarta sin recorrer data.
+    """
+    bits = qrutil.BIT_LIMIT_TABLE[error_correction][40]
+    if len(data) * 10 > bits * 3:
+        return False
+    if len(data.encode('utf-8')) <= (bits - 4 - qrutil.length_in_bits(qrutil.MODE_8BIT_BYTE, 40)) // 8:
+        return True
+    return segmentos_optimos(data, error_correction) is not None
+
+def agregar_datos(qr, data):
+    """Sustituye a qr.add_data(data) usando la segmentación de coste mínimo"""
+    resultado = segmentos_optimos(data, qr.error_correction)
+    if resultado is None:
+        # Demasiado largo para cualquier versión: que qrcode lance su error habitual
+        qr.add_data(data)
+        return
+    for modo, texto in resultado[1]:
+        qr.add_data(qrutil.QRData(texto.encode('utf-8'), mode=modo, check_data=False))
+
+# Backend de codificación: "numpy" (Reed–Solomon y máscaras vectorizados) o "qrcode"
+QR_ENCODER = os.environ.get('QR_ENCODER', 'numpy')
+
+def _tablas_gf256():
+    """Exponenciales y logaritmos de GF(256) con el polinomio 0x11d de QR
+
+    log(0) se representa con 512 y las exponenciales desde 510 valen 0: así
+    un producto con un factor nulo sale 0 sin ramas (los logaritmos válidos
+    suman como mucho 508).
+    """
+    exp = np.zeros(1025, dtype=np.uint8)
+    log = np.full(256, 512, dtype=np.int16)
+    x = 1
+    for i in range(255):
+        exp[i] = exp[i + 255] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    return exp, log
+
+GF_EXP, GF_LOG = _tablas_gf256()
+
+# Por número de bytes de corrección: polinomio generador; por (datos, corrección): matriz de paridad
+_generadores_rs = {}
+_paridades_rs = {}
+
+def generador_rs(ec):
+    """Coeficientes (mayor grado primero) de prod(x - a^i) para i < ec"""
+    generador = _generadores_rs.get(ec)
+    if generador is None:
+        generador = np.array([1], dtype=np.uint8)
+        for i in range(ec):
+            # (g · x) ^ (g · a^i)
+            siguiente = np.append(generador, 0)
+            siguiente[1:] ^= GF_EXP[GF_LOG[generador].astype(np.int32) + i]
+            generador = siguiente
+        _generadores_rs[ec] = generador
+    return generador
+
+def dividir_rs(datos, ec):
+    """Resto de datos · x^ec entre el generador, para todos los bloques a la vez
+
+    `datos` es (bloques, k): la división larga avanza byte a byte, pero cada
+    paso opera sobre todos los bloques con las tablas de logaritmos.
+    """
+    log_g = GF_LOG[generador_rs(ec)[1:]].astype(np.int32)
+    resto = np.zeros((datos.shape[0], ec), dtype=np.uint8)
+    for columna in datos.T:
+        factor = columna ^ resto[:, 0]
+        resto[:, :-1] = resto[:, 1:]
+        resto[:, -1] = 0
+        resto ^= GF_EXP[GF_LOG[factor].astype(np.int32)[:, None] + log_g]
+    return resto
+
+def paridad_rs(k, ec):
+    """Logaritmos de la matriz (k, ec) que da la paridad de un bloque de k bytes
+
+    El código es lineal: la paridad de un bloque es la suma (XOR) de la
+    paridad de cada byte en su posición, que es el resto del vector unitario
+    multiplicado por el byte. Se calcula una vez por (k, ec).
+    """
+    clave = (k, ec)
+    matriz = _paridades_rs.get(clave)
+    if matriz is None:
+        matriz = GF_LOG[dividir_rs(np.eye(k, dtype=np.uint8), ec)].astype(np.int32)
+        _paridades_rs[clave] = matriz
+    return matriz
+
+def codificar_bloques_rs(datos, ec):
+    """Bytes de corrección de (bloques, k) bytes de datos: un producto en GF(256)"""
+    productos = GF_EXP[GF_LOG[datos].astype(np.int32)[:, :, None] + paridad_rs(datos.shape[1], ec)[None]]
+    return np.bitwise_xor.reduce(productos, axis=1)
+
+def _bits_segmento(segmento, version):
+    """Cabecera y datos de un segmento como texto binario, igual que QRData.write
+
+    BitBuffer de qrcode añade los bits de uno en uno; aquí cada grupo se
+    formatea de una vez (y el modo byte entero de una sola conversión).
+    """
+    partes = []
+
+    def poner(valor, longitud):
+        partes.append(format(valor & ((1 << longitud) - 1), f'0{longitud}b'))
+
+    datos = segmento.data
+    poner(segmento.mode, 4)
+    poner(len(datos), qrutil.length_in_bits(segmento.mode, version))
+    if segmento.mode == qrutil.MODE_NUMBER:
+        for i in range(0, len(datos), 3):
+            grupo = datos[i:i + 3]
+            poner(int(grupo), qrutil.NUMBER_LENGTH[len(grupo)])
+    elif segmento.mode == qrutil.MODE_ALPHA_NUM:
+        for i in range(0, len(datos), 2):
+            grupo = datos[i:i + 2]
+            if len(grupo) > 1:
+                poner(qrutil.ALPHA_NUM.find(grupo[0]) * 45 + qrutil.ALPHA_NUM.find(grupo[1]), 11)
+            else:
+                poner(qrutil.ALPHA_NUM.find(grupo), 6)
+    elif datos:
+        poner(int.from_bytes(datos, 'big'), 8 * len(datos))
+    return ''.join(partes)
+
+def _longitud_segmento(segmento, tamanos):
+    """Bits que ocupa un segmento (cabecera incluida) sin escribirlo"""
+    n = len(segmento)
+    if segmento.mode == qrutil.MODE_NUMBER:
+        datos = n // 3 * 10 + (0, 4, 7)[n % 3]
+    elif segmento.mode == qrutil.MODE_ALPHA_NUM:
+        datos = n // 2 * 11 + n % 2 * 6
+    else:
+        datos = n * 8
+    return 4 + tamanos[segmento.mode] + datos
+
+# Anexo estructurado (ISO 18004 §8): modo 0011, posición, total - 1 y paridad
+MODE_STRUCTURED_APPEND = 0b0011
+APPEND_HEADER_BITS = 20
+
+def _bits_anexo(anexo):
+    """Cabecera de anexo estructurado para anexo = (posición, total, paridad)"""
+    if anexo is None:
+        return ''
+    posicion, total, paridad = anexo
+    return f"{MODE_STRUCTURED_APPEND:04b}{posicion:04b}{total - 1:04b}{paridad:08b}"
+
+def version_minima(qr, inicio=None, anexo=None):
+    """Lo mismo que QRCode.best_fit, contando bits en vez de escribirlos"""
+    inicio = inicio or 1
+    tamanos = qrutil.mode_sizes_for_version(inicio)
+    necesarios = sum(_longitud_segmento(segmento, tamanos) for segmento in qr.data_list)
+    necesarios += APPEND_HEADER_BITS if anexo else 0
+    version = bisect.bisect_left(qrutil.BIT_LIMIT_TABLE[qr.error_correction], necesarios, inicio)
+    if version == 41:
+        raise qrcode.exceptions.DataOverflowError()
+    # Si la versión cambia de grupo, los campos de longitud crecen: volver a contar
+    if tamanos is not qrutil.mode_sizes_for_version(version):
+        return version_minima(qr, version, anexo)
+    return version
+
+def palabras_codigo(version, error_correction, data_list, anexo=None):
+    """Equivalente de qrcode.util.create_data con el Reed–Solomon vectorizado"""
+    bits = _bits_anexo(anexo) + ''.join(_bits_segmento(segmento, version) for segmento in data_list)
+
+    bloques = qrcode.base.rs_blocks(version, error_correction)
+    limite = sum(bloque.data_count * 8 for bloque in bloques)
+    if len(bits) > limite:
+        raise qrcode.exceptions.DataOverflowError(
+            "Code length overflow. Data size (%s) > size available (%s)" % (len(bits), limite)
+        )
+    # Terminador, relleno hasta byte y bytes de relleno alternos, como create_data
+    bits += '0' * min(limite - len(bits), 4)
+    bits += '0' * (-len(bits) % 8)
+    relleno = (limite - len(bits)) // 8
+    datos = np.frombuffer(
+        int(bits, 2).to_bytes(len(bits) // 8, 'big') + bytes([qrutil.PAD0, qrutil.PAD1]) * (relleno // 2)
+        + bytes([qrutil.PAD0]) * (relleno % 2),
+        dtype=np.uint8
+    )
 
-    # Configurar tamaño según la opción elegida
-    size_map = {
-        "small": {"version": 1, "box_size": 8, "border": 3},
-        "medium": {"version": 1, "box_size": 10, "border": 4},
-        "large": {"version": 1, "box_size": 12, "border": 5}
+    # Hay como mucho dos longitudes de bloque por versión; todas con la misma corrección
+    ec = bloques[0].total_count - bloques[0].data_count
+    max_dc = max(bloque.data_count for bloque in bloques)
+    rejilla = np.full((len(bloques), max_dc), -1, dtype=np.int16)
+    correccion = np.empty((len(bloques), ec), dtype=np.uint8)
+    offset = 0
+    for k, grupo in itertools.groupby(range(len(bloques)), key=lambda i: bloques[i].data_count):
+        indices = list(grupo)
+        trozo = datos[offset:offset + k * len(indices)].reshape(len(indices), k)
+        offset += trozo.size
+        rejilla[indices, :k] = trozo
+        correccion[indices] = codificar_bloques_rs(trozo, ec)
+
+    # Entrelazado: columna a columna, saltando los huecos de los bloques cortos
+    intercalados = rejilla.T.ravel()
+    return np.concatenate([intercalados[intercalados >= 0].astype(np.uint8), correccion.T.ravel()])
+
+# Por versión: matriz de prueba (funciones fijas, formato en claro), coordenadas
+# de los módulos de datos en orden de colocación y las 8 máscaras sobre ellos
+_plantillas_qr = {}
+
+def plantilla_qr(version):
+    """Matriz base y recorrido de datos de una versión, calculados una vez"""
+    plantilla = _plantillas_qr.get(version)
+    if plantilla is not None:
+        return plantilla
+
+    # Patrones fijos con los métodos del propio qrcode, formato en modo prueba
+    qr = qrcode.QRCode(version=version)
+    n = qr.modules_count = version * 4 + 17
+    qr.modules = [[None] * n for _ in range(n)]
+    qr.setup_position_probe_pattern(0, 0)
+    qr.setup_position_probe_pattern(n - 7, 0)
+    qr.setup_position_probe_pattern(0, n - 7)
+    qr.setup_position_adjust_pattern()
+    qr.setup_timing_pattern()
+    qr.setup_type_info(True, 0)
+    if version >= 7:
+        qr.setup_type_number(True)
+
+    # Mismo recorrido en zigzag que QRCode.map_data
+    filas, columnas = [], []
+    fila, paso = n - 1, -1
+    for columna in range(n - 1, 0, -2):
+        if columna <= 6:
+            columna -= 1
+        while 0 <= fila < n:
+            for c in (columna, columna - 1):
+                if qr.modules[fila][c] is None:
+                    filas.append(fila)
+                    columnas.append(c)
+            fila += paso
+        fila -= paso
+        paso = -paso
+
+    base = np.array([[bool(celda) for celda in fila] for fila in qr.modules])
+    i = np.array(filas)[None, :]
+    j = np.array(columnas)[None, :]
+    mascaras = np.stack([
+        (i + j) % 2 == 0,
+        np.broadcast_to(i % 2 == 0, i.shape),
+        np.broadcast_to(j % 3 == 0, j.shape),
+        (i + j) % 3 == 0,
+        (i // 2 + j // 3) % 2 == 0,
+        (i * j) % 2 + (i * j) % 3 == 0,
+        ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+        ((i * j) % 3 + (i + j) % 2) % 2 == 0
+    ]).reshape(8, -1)
+    plantilla = (base, np.array(filas), np.array(columnas), mascaras)
+    _plantillas_qr[version] = plantilla
+    return plantilla
+
+# Patrones 1:1:3:1:1 con 4 módulos claros de la regla 3, como enteros de 11 bits
+_PATRON_FINDER_A = 0b10111010000
+_PATRON_FINDER_B = 0b00001011101
+
+def _penalizacion_filas(matrices):
+    """Reglas 1 y 3 en las filas de un bloque (máscaras, n, n)"""
+    k, n, _ = matrices.shape
+    filas = matrices.reshape(k * n, n)
+
+    # Regla 1: cada racha de 5 o más módulos iguales suma longitud - 2
+    inicios = np.ones(filas.shape, dtype=bool)
+    np.not_equal(filas[:, 1:], filas[:, :-1], out=inicios[:, 1:])
+    posiciones = np.flatnonzero(inicios)
+    longitudes = np.diff(np.append(posiciones, filas.size))
+    puntos = np.bincount(posiciones // (n * n), weights=np.where(longitudes >= 5, longitudes - 2, 0), minlength=k)
+
+    # Regla 3: ventanas de 11 módulos leídas como enteros
+    ventanas = np.zeros((k, n, n - 10), dtype=np.int16)
+    for desplazamiento in range(11):
+        ventanas <<= 1
+        ventanas |= matrices[:, :, desplazamiento:desplazamiento + n - 10]
+    coincidencias = (ventanas == _PATRON_FINDER_A) | (ventanas == _PATRON_FINDER_B)
+    return puntos.astype(np.int64) + 40 * coincidencias.sum(axis=(1, 2))
+
+def penalizaciones_mascaras(matrices):
+    """Puntuación de qrcode.util.lost_point para un bloque (máscaras, n, n)"""
+    puntos = _penalizacion_filas(matrices) + _penalizacion_filas(matrices.transpose(0, 2, 1))
+
+    # Regla 2: bloques 2x2 del mismo color
+    esquina = matrices[:, :-1, :-1]
+    bloques = (esquina == matrices[:, 1:, :-1]) & (esquina == matrices[:, :-1, 1:]) & (esquina == matrices[:, 1:, 1:])
+    puntos += 3 * bloques.sum(axis=(1, 2))
+
+    # Regla 4: proporción de oscuros, con la misma aritmética en coma flotante que qrcode
+    n = matrices.shape[1]
+    for i, oscuros in enumerate(matrices.sum(axis=(1, 2)).tolist()):
+        porcentaje = float(oscuros) / (n ** 2)
+        puntos[i] += int(abs(porcentaje * 100 - 50) / 5) * 10
+    return puntos
+
+def compilar_qr(qr, anexo=None):
+    """Sustituye a qr.make(fit=True): mismo resultado, sin los bucles de qrcode
+
+    Calcula las palabras de código con el Reed–Solomon vectorizado, evalúa
+    las 8 máscaras a la vez sobre una pila (8, n, n) y deja qr.modules y
+    qr.data_cache como los dejaría qrcode. Con anexo = (posición, total,
+    paridad) el símbolo lleva cabecera de anexo estructurado, que qrcode
+    no sabe escribir: en ese caso se usa este camino aunque QR_ENCODER lo
+    desactive.
+    """
+    if QR_ENCODER != 'numpy' and anexo is None:
+        qr.make(fit=True)
+        return
+
+    # qr._version: la propiedad version lanzaría el best_fit de qrcode si no hay versión fija
+    version = qr.version = version_minima(qr, qr._version, anexo)
+    palabras = palabras_codigo(version, qr.error_correction, qr.data_list, anexo)
+    base, filas, columnas, mascaras = plantilla_qr(version)
+
+    # Los módulos sobrantes tras las palabras de código van en claro (antes de la máscara)
+    bits = np.zeros(len(filas), dtype=bool)
+    bits[:palabras.size * 8] = np.unpackbits(palabras)[:len(filas)]
+
+    matrices = np.repeat(base[None], 8, axis=0)
+    matrices[:, filas, columnas] = bits[None] ^ mascaras
+    if qr.mask_pattern is None:
+        mascara = int(np.argmin(penalizaciones_mascaras(matrices)))
+    else:
+        mascara = qr.mask_pattern
+
+    qr.modules_count = base.shape[0]
+    qr.modules = matrices[mascara].tolist()
+    qr.setup_type_info(False, mascara)
+    if version >= 7:
+        qr.setup_type_number(False)
+    qr.data_cache = palabras.tolist()
+
+# Tamaño del logo (ancho en px) según el tamaño del QR
+LOGO_SIZE_MAP = {
+    "small": 40,
+    "medium": 60,
+    "large": 80
+}
+
+# Cachés de logos: imagen original por URL y versión redimensionada por (URL, tamaño)
+# Con logos subidos el número de claves no está acotado: se descartan las más antiguas
+LOGO_CACHE_MAX = 256
+logo_originales = {}
+logo_sprites = {}
+
+def _guardar_acotado(cache, clave, valor, maximo=LOGO_CACHE_MAX):
+    """Guarda en un dict usado como caché, descartando las entradas más antiguas"""
+    cache[clave] = valor
+    while len(cache) > maximo:
+        cache.pop(next(iter(cache)))
+
+# Logos subidos por los usuarios: se guardan una sola vez por hash del contenido
+LOGO_UPLOAD_MAX_BYTES = int(os.environ.get('QR_LOGO_MAX_BYTES', str(2 * 1024 * 1024)))
+LOGO_UPLOAD_MAX_PIXELS = 4096 * 4096
+LOGO_UPLOAD_FORMATS = {"PNG", "JPEG", "WEBP", "GIF"}
+LOGO_NORMALIZED_MAX = 1024
+LOGO_STORE_DIR = os.environ.get('QR_LOGO_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploaded_logos'))
+# Los renders se refieren a un logo subido como "logo:<sha256>" en lugar de una URL
+PREFIJO_LOGO_SUBIDO = "logo:"
+
+class LogoUploadError(Exception):
+    """Logo subido rechazado; `status` es el código HTTP a devolver"""
+
+    def __init__(self, mensaje, status=400):
+        super().__init__(mensaje)
+        self.status = status
+
+def ruta_logo_subido(sha):
+    """Ruta del logo normalizado para un hash, o None si el hash no es válido"""
+    if not re.fullmatch(r'[0-9a-f]{64}', sha or ''):
+        return None
+    return os.path.join(LOGO_STORE_DIR, f"{sha}.png")
+
+def guardar_logo_subido(stream, content_length=None):
+    """Lee un logo por trozos con límite de tamaño y guarda su versión RGBA normalizada
+
+    Devuelve (hash, nuevo). Si el mismo contenido ya se subió antes, no se
+    vuelve a decodificar.
+    """
+    if content_length is not None and content_length > LOGO_UPLOAD_MAX_BYTES:
+        raise LogoUploadError(f"El logo supera {LOGO_UPLOAD_MAX_BYTES} bytes", 413)
+
+    hasher = hashlib.sha256()
+    contenido = bytearray()
+    while True:
+        trozo = stream.read(64 * 1024)
+        if not trozo:
+            break
+        contenido += trozo
+        hasher.update(trozo)
+        if len(contenido) > LOGO_UPLOAD_MAX_BYTES:
+            raise LogoUploadError(f"El logo supera {LOGO_UPLOAD_MAX_BYTES} bytes", 413)
+    if not contenido:
+        raise LogoUploadError("No se recibió ningún archivo")
+
+    sha = hasher.hexdigest()
+    if almacen.existe_logo(sha):
+        return sha, False
+
+    # Image.open solo lee la cabecera: comprobar formato y dimensiones antes de decodificar
+    try:
+        img = Image.open(io.BytesIO(contenido))
+    except Image.DecompressionBombError:
+        raise LogoUploadError(f"El logo supera el máximo de {LOGO_UPLOAD_MAX_PIXELS} píxeles")
+    except Exception:
+        raise LogoUploadError("El archivo no es una imagen válida")
+    if img.format not in LOGO_UPLOAD_FORMATS:
+        raise LogoUploadError(f"Formato no soportado: {img.format}")
+    ancho, alto = img.size
+    if ancho < 1 or alto < 1 or ancho * alto > LOGO_UPLOAD_MAX_PIXELS:
+        raise LogoUploadError(f"El logo mide {ancho}x{alto}; el máximo es {LOGO_UPLOAD_MAX_PIXELS} píxeles")
+
+    try:
+        # En JPEG, draft decodifica directamente a escala reducida
+        img.draft("RGB", (LOGO_NORMALIZED_MAX, LOGO_NORMALIZED_MAX))
+        logo = img.convert("RGBA")
+        logo.thumbnail((LOGO_NORMALIZED_MAX, LOGO_NORMALIZED_MAX), Image.LANCZOS)
+    except Exception:
+        raise LogoUploadError("No se pudo decodificar la imagen")
+
+    salida = io.BytesIO()
+    logo.save(salida, format="PNG")
+    almacen.guardar_logo(sha, salida.getvalue())
+    return sha, True
+
+def cargar_logo_subido(sha):
+    """Abre el logo normalizado de un hash, o None si no existe"""
+    if ruta_logo_subido(sha) is None:
+        return None
+    contenido = almacen.leer_logo(sha)
+    if contenido is None:
+        return None
+    with Image.open(io.BytesIO(contenido)) as logo:
+        return logo.convert("RGBA")
+
+def descargar_logo(logo_url):
+    """Descarga un logo y lo decodifica como RGBA, o devuelve None si no es válido"""
+    # Descargar logo con headers para evitar bloqueos
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     }
+    response = requests.get(logo_url, headers=headers, timeout=10, stream=True)
+    response.raise_for_status()
+
+    # Verificar que el contenido sea una imagen válida
+    content_type = response.headers.get('content-type', '')
+
+    # Saltar SVGs ya que PIL tiene problemas con ellos
+    if 'svg' in content_type.lower():
+        log.info("Logo SVG no soportado: %s", logo_url)
+        return None
+
+    if not content_type.startswith('image/'):
+        log.warning("URL de logo sin imagen: %s", logo_url, extra={'content_type': content_type, 'limitar': logo_url})
+        return None
+
+    # Intentar abrir la imagen
+    try:
+        return Image.open(io.BytesIO(response.content)).convert("RGBA")
+    except Exception as img_error:
+        log.warning("Logo no decodificable: %s", logo_url, extra={'error': str(img_error), 'limitar': logo_url})
+        return None
+
+def cargar_logo_original(logo_url):
+    """Devuelve el logo a resolución original, descargándolo solo la primera vez"""
+    logo = logo_originales.get(logo_url)
+    if logo is None:
+        if logo_url.startswith(PREFIJO_LOGO_SUBIDO):
+            logo = cargar_logo_subido(logo_url[len(PREFIJO_LOGO_SUBIDO):])
+        else:
+            logo = descargar_logo(logo_url)
+        if logo is not None:
+            _guardar_acotado(logo_originales, logo_url, logo)
+    return logo
+
+# Plazo para el logo en peticiones interactivas: si la descarga no llega a tiempo
+# se responde sin logo (degradado) y la descarga sigue en segundo plano para la
+# siguiente petición. Una descarga fallida no se reintenta hasta LOGO_RETRY_SECONDS.
+LOGO_DEADLINE = float(os.environ.get('QR_LOGO_DEADLINE', '0.3'))
+LOGO_RETRY_SECONDS = 60
+_descargas_logo = {}  # URL -> (futuro, instante de inicio)
+_descargas_logo_lock = threading.Lock()
+_descargas_logo_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="logos")
+estadisticas_logo = collections.Counter()
+
+def logo_listo(logo_url, plazo=LOGO_DEADLINE):
+    """True si el logo está en caché o llega dentro del plazo; si no, deja la descarga en marcha"""
+    if logo_url in logo_originales or logo_url.startswith(PREFIJO_LOGO_SUBIDO):
+        return True
+    with _descargas_logo_lock:
+        futuro, inicio = _descargas_logo.get(logo_url, (None, 0))
+        # Reutilizar la descarga en curso, o una fallida reciente; una ya terminada
+        # bien cuyo logo salió de la caché se vuelve a lanzar
+        reciente = futuro is not None and (
+            not futuro.done()
+            or ((futuro.exception() or futuro.result() is None) and time.monotonic() - inicio < LOGO_RETRY_SECONDS)
+        )
+        if not reciente:
+            futuro = _descargas_logo_executor.submit(cargar_logo_original, logo_url)
+            _guardar_acotado(_descargas_logo, logo_url, (futuro, time.monotonic()))
+    try:
+        return futuro.result(timeout=plazo) is not None
+    except FuturesTimeoutError:
+        return False
+    except Exception as e:
+        log.warning("Error al descargar logo %s", logo_url, extra={'error': str(e), 'limitar': logo_url})
+        return False
+
+def cargar_logo(logo_url, qr_size="medium"):
+    """Devuelve el logo redimensionado para el tamaño del QR, usando la caché"""
+    clave = (logo_url, qr_size)
+    if clave in logo_sprites:
+        return logo_sprites[clave]
+
+    logo = cargar_logo_original(logo_url)
+    if logo is None:
+        return None
+
+    # Redimensionar logo según el tamaño del QR
+    basewidth = LOGO_SIZE_MAP.get(qr_size, 60)
+    wpercent = basewidth / float(logo.size[0])
+    hsize = int(float(logo.size[1]) * float(wpercent))
+    logo = logo.resize((basewidth, hsize), Image.LANCZOS)
+
+    _guardar_acotado(logo_sprites, clave, logo)
+    return logo
+
+# Pool de búferes de trabajo del rasterizado (por proceso; 0 bytes = sin reutilizar)
+BUFFER_POOL_BYTES = int(os.environ.get('QR_BUFFER_POOL_BYTES', str(64 * 1024 * 1024)))
+BUFFER_POOL_PER_KEY = int(os.environ.get('QR_BUFFER_POOL_PER_KEY', '4'))
+
+class PoolBuffers:
+    """Arrays y BytesIO reutilizables entre renders, por dimensiones y tipo
+
+    Los renders del mismo tamaño piden siempre los mismos búferes: en vez de
+    reservarlos y liberarlos en cada petición se toman prestados y se
+    devuelven. Limitado por bytes totales; se descartan primero las
+    dimensiones que llevan más tiempo sin pedirse.
+    """
+
+    def __init__(self, max_bytes, max_por_clave):
+        self.max_bytes = max_bytes
+        self.max_por_clave = max_por_clave
+        self.bytes = 0
+        self.prestamos = 0
+        self.creados = 0
+        self._libres = collections.OrderedDict()
+        self._flujos = []
+        self._lock = threading.Lock()
+
+    def tomar(self, forma, dtype=np.uint8):
+        """Array sin inicializar de la forma y tipo dados"""
+        clave = (tuple(forma), np.dtype(dtype).str)
+        with self._lock:
+            self.prestamos += 1
+            libres = self._libres.get(clave)
+            if libres:
+                self._libres.move_to_end(clave)
+                buf = libres.pop()
+                self.bytes -= buf.nbytes
+                return buf
+            self.creados += 1
+        return np.empty(forma, dtype)
+
+    def devolver(self, buf):
+        if buf.nbytes > self.max_bytes:
+            return
+        clave = (buf.shape, buf.dtype.str)
+        with self._lock:
+            libres = self._libres.setdefault(clave, [])
+            self._libres.move_to_end(clave)
+            if len(libres) >= self.max_por_clave:
+                return
+            libres.append(buf)
+            self.bytes += buf.nbytes
+            while self.bytes > self.max_bytes:
+                _, expulsados = self._libres.popitem(last=False)
+                self.bytes -= sum(b.nbytes for b in expulsados)
+
+    @contextlib.contextmanager
+    def prestamo(self):
+        """Entrega una función `tomar`; todo lo tomado vuelve al pool al salir"""
+        prestados = []
+
+        def tomar(forma, dtype=np.uint8):
+            buf = self.tomar(forma, dtype)
+            prestados.append(buf)
+            return buf
+        try:
+            yield tomar
+        finally:
+            for buf in prestados:
+                self.devolver(buf)
+
+    @contextlib.contextmanager
+    def flujo(self):
+        """BytesIO posicionado al principio; conserva su capacidad entre usos"""
+        with self._lock:
+            self.prestamos += 1
+            if self._flujos:
+                buf = self._flujos.pop()
+            else:
+                self.creados += 1
+                buf = io.BytesIO()
+        buf.seek(0)
+        try:
+            yield buf
+        finally:
+            with self._lock:
+                if len(self._flujos) < self.max_por_clave and buf.getbuffer().nbytes <= self.max_bytes:
+                    self._flujos.append(buf)
+
+    def resumen(self):
+        with self._lock:
+            return {
+                'bytes': self.bytes,
+                'dimensiones': len(self._libres),
+                'prestamos': self.prestamos,
+                'creados': self.creados
+            }
 
-    size_config = size_map.get(qr_size, size_map["medium"])
+buffer_pool = PoolBuffers(BUFFER_POOL_BYTES, BUFFER_POOL_PER_KEY)
+
+# Estilos con forma por módulo: qr_style -> forma de cada módulo
+MODULE_SHAPES = {
+    "rounded": "rounded",
+    "circle": "dot"
+}
+# Geometría de cada forma, en fracciones de módulo: tamaño del módulo, radio
+# de sus esquinas y radio de las esquinas de los patrones de posición
+SHAPE_GEOMETRY = {
+    "square": {"lado": 1.0, "radio": 0.0, "radio_finder": 0.0},
+    "rounded": {"lado": 1.0, "radio": 0.3, "radio_finder": 1.2},
+    "dot": {"lado": 0.9, "radio": 0.45, "radio_finder": 1.75}
+}
+# Los tiles se dibujan a esta escala y se reducen para antialiasing
+SHAPE_SUPERSAMPLE = 4
+
+# Cachés de tiles de módulo y sprites de patrones de posición por (forma, box_size)
+_tiles_modulo = {}
+_sprites_finder = {}
+
+def tile_modulo(forma, box_size):
+    """Cobertura antialiased (0-255) de un módulo con la forma dada"""
+    clave = (forma, box_size)
+    tile = _tiles_modulo.get(clave)
+    if tile is None:
+        from PIL import ImageDraw
+
+        geometria = SHAPE_GEOMETRY[forma]
+        escala = box_size * SHAPE_SUPERSAMPLE
+        margen = escala * (1 - geometria["lado"]) / 2
+        grande = Image.new("L", (escala, escala), 0)
+        ImageDraw.Draw(grande).rounded_rectangle(
+            [margen, margen, escala - margen - 1, escala - margen - 1],
+            radius=escala * geometria["radio"], fill=255
+        )
+        tile = np.asarray(grande.resize((box_size, box_size), Image.BOX))
+        _tiles_modulo[clave] = tile
+    return tile
+
+def sprite_finder(forma, box_size):
+    """Cobertura antialiased de un patrón de posición completo (7x7 módulos)"""
+    clave = (forma, box_size)
+    sprite = _sprites_finder.get(clave)
+    if sprite is None:
+        from PIL import ImageDraw
+
+        radio = SHAPE_GEOMETRY[forma]["radio_finder"]
+        m = box_size * SHAPE_SUPERSAMPLE
+        grande = Image.new("L", (7 * m, 7 * m), 0)
+        draw = ImageDraw.Draw(grande)
+        # Anillo exterior de 7 módulos con hueco de 5 y centro de 3
+        draw.rounded_rectangle([0, 0, 7 * m - 1, 7 * m - 1], radius=radio * m, fill=255)
+        draw.rounded_rectangle([m, m, 6 * m - 1, 6 * m - 1], radius=max(radio - 1, 0) * m, fill=0)
+        draw.rounded_rectangle([2 * m, 2 * m, 5 * m - 1, 5 * m - 1], radius=max(radio - 0.6, 0) * m, fill=255)
+        sprite = np.asarray(grande.resize((7 * box_size, 7 * box_size), Image.BOX))
+        _sprites_finder[clave] = sprite
+    return sprite
+
+def posiciones_finder(n, border):
+    """Esquina superior izquierda (fila, columna) de los tres patrones de posición"""
+    lejos = n - border - 7
+    return [(border, border), (border, lejos), (lejos, border)]
+
+def mascaras_modulos(matriz, box_size, forma, border, tomar):
+    """Estampa los módulos de datos y los patrones de posición en dos máscaras
+
+    Todo el estampado de datos es una sola operación sobre arrays: el
+    producto de Kronecker de la matriz de módulos con el tile, escrito
+    directamente en un búfer prestado por `tomar`.
+    """
+    modulos = np.array(matriz, dtype=np.uint8)
+    n = modulos.shape[0]
+    finders = posiciones_finder(n, border)
+    for fila, columna in finders:
+        modulos[fila:fila + 7, columna:columna + 7] = 0
+
+    lado = n * box_size
+    datos = tomar((lado, lado))
+    np.multiply(
+        modulos[:, None, :, None], tile_modulo(forma, box_size)[None, :, None, :],
+        out=datos.reshape(n, box_size, n, box_size)
+    )
+
+    finder = tomar((lado, lado))
+    finder.fill(0)
+    sprite = sprite_finder(forma, box_size)
+    for fila, columna in finders:
+        y, x = fila * box_size, columna * box_size
+        finder[y:y + sprite.shape[0], x:x + sprite.shape[1]] = sprite
+    return datos, finder
+
+# Degradados: "linear:#RRGGBB:#RRGGBB[:ángulo]" o "radial:#RRGGBB:#RRGGBB"
+GRADIENT_TYPES = ("linear", "radial")
+GRADIENT_CACHE_MAX = 32
+_campos_degradado = {}
+
+def parsear_degradado(spec):
+    """Convierte la especificación de degradado en (tipo, color inicial, color final, ángulo)"""
+    partes = spec.split(":")
+    if len(partes) not in (3, 4) or partes[0] not in GRADIENT_TYPES:
+        raise ValueError(f"Degradado inválido: {spec}")
+    colores = []
+    for color in partes[1:3]:
+        if not re.fullmatch(r'#?[0-9a-fA-F]{6}', color):
+            raise ValueError(f"Color de degradado inválido: {color}")
+        colores.append(hex_to_rgb(color))
+    try:
+        angulo = int(partes[3]) % 360 if len(partes) == 4 else 0
+    except ValueError:
+        raise ValueError(f"Ángulo de degradado inválido: {partes[3]}")
+    return partes[0], colores[0], colores[1], angulo
+
+def geometria_degradado(tipo, lado, angulo):
+    """Extremos del degradado en un cuadrado de `lado`: los comparten raster y SVG"""
+    centro = lado / 2
+    if tipo == "radial":
+        return centro, centro, lado / math.sqrt(2)
+    rad = math.radians(angulo)
+    dx, dy = math.cos(rad), math.sin(rad)
+    # Media proyección del cuadrado sobre la dirección del degradado
+    mitad = centro * (abs(dx) + abs(dy))
+    return centro - dx * mitad, centro - dy * mitad, centro + dx * mitad, centro + dy * mitad
+
+def campo_degradado(tipo, lado, angulo):
+    """Posición (0-255) de cada píxel dentro del degradado, en caché por tamaño
+
+    Se guarda en uint8 porque la salida tiene 8 bits por canal: cuatro veces
+    menos memoria que float32 sin diferencia visible.
+    """
+    clave = (tipo, lado, angulo)
+    campo = _campos_degradado.get(clave)
+    if campo is None:
+        ejes = np.arange(lado, dtype=np.float32) + 0.5
+        if tipo == "radial":
+            cx, cy, radio = geometria_degradado(tipo, lado, angulo)
+            t = np.hypot(ejes[None, :] - cx, ejes[:, None] - cy) / radio
+        else:
+            x1, y1, x2, y2 = geometria_degradado(tipo, lado, angulo)
+            dx, dy = x2 - x1, y2 - y1
+            t = (np.add.outer((ejes - y1) * dy, (ejes - x1) * dx)) / (dx * dx + dy * dy)
+        campo = np.rint(np.clip(t, 0, 1) * 255).astype(np.uint8)
+        _guardar_acotado(_campos_degradado, clave, campo, GRADIENT_CACHE_MAX)
+    return campo
+
+def tabla_mezcla(qr_color_rgb, bg_color_rgb):
+    """Color RGB (256, 3) de cada nivel de cobertura para un relleno plano"""
+    fondo = np.array(bg_color_rgb, dtype=np.float32)
+    alfas = np.arange(256, dtype=np.float32)[:, None] / 255
+    return np.rint(fondo + (np.array(qr_color_rgb, dtype=np.float32) - fondo) * alfas).astype(np.uint8)
+
+def rasterizar_modulos(matriz, box_size, forma, qr_color_rgb, bg_color_rgb, border, gradient=None, finder_color_rgb=None):
+    """Imagen RGB del QR con módulos de la forma dada, color plano o degradado
+
+    Los patrones de posición pueden llevar su propio color; si no, usan el
+    mismo relleno que los módulos de datos.
+    """
+    with buffer_pool.prestamo() as tomar:
+        datos, finder = mascaras_modulos(matriz, box_size, forma, border, tomar)
+        lado = datos.shape[0]
+        fondo = np.array(bg_color_rgb, dtype=np.float32)
+        salida = tomar((lado, lado, 3))
+
+        if not gradient and finder_color_rgb is None:
+            # Color plano: el píxel solo depende de la cobertura (0-255), así
+            # que la mezcla se calcula una vez por valor y se indexa
+            # (take convierte los índices a intp: se suman ya en un búfer intp)
+            indices = tomar((lado, lado), np.intp)
+            np.add(datos, finder, out=indices)
+            np.take(tabla_mezcla(qr_color_rgb, bg_color_rgb), indices, axis=0, out=salida, mode='clip')
+            return Image.fromarray(salida, "RGB")
+
+        # Mismas operaciones que fondo + (relleno - fondo) * alfa, pero en sitio
+        alfa = tomar((lado, lado), np.float32)
+        np.copyto(alfa, datos)
+        if finder_color_rgb is None:
+            alfa += finder
+        alfa /= 255
+
+        pixeles = tomar((lado, lado, 3), np.float32)
+        if gradient:
+            tipo, inicio, fin, angulo = parsear_degradado(gradient)
+            t = tomar((lado, lado), np.float32)
+            np.copyto(t, campo_degradado(tipo, lado, angulo))
+            t /= 255
+            inicio = np.array(inicio, dtype=np.float32)
+            np.multiply(t[..., None], np.array(fin, dtype=np.float32) - inicio, out=pixeles)
+            pixeles += inicio
+            pixeles -= fondo
+            pixeles *= alfa[..., None]
+        else:
+            np.multiply(alfa[..., None], np.array(qr_color_rgb, dtype=np.float32) - fondo, out=pixeles)
+        pixeles += fondo
+
+        if finder_color_rgb is not None:
+            # Las máscaras no se solapan: los patrones se suman a la misma mezcla
+            np.copyto(alfa, finder)
+            alfa /= 255
+            extra = tomar((lado, lado, 3), np.float32)
+            np.multiply(alfa[..., None], np.array(finder_color_rgb, dtype=np.float32) - fondo, out=extra)
+            pixeles += extra
+
+        np.rint(pixeles, out=pixeles)
+        np.copyto(salida, pixeles, casting='unsafe')
+        # fromarray copia los datos RGB: el búfer puede volver al pool
+        return Image.fromarray(salida, "RGB")
+
+# Inserta el logo en el centro del QR
+def generar_qr_personalizado(data, logo_url=None, bg_color="#ffffff", qr_color="#000000", qr_style="square", qr_size="medium", include_logo=True, gradient=None, finder_color=None, lado_max=None):
+    """Rasteriza el QR; con lado_max, a los píxeles enteros por módulo que quepan en ese lado"""
+    log.debug("Generando QR", extra={'qr_color': qr_color, 'bg_color': bg_color, 'qr_style': qr_style, 'qr_size': qr_size})
+
+    # Configurar tamaño según la opción elegida
+    size_config = QR_SIZE_MAP.get(qr_size, QR_SIZE_MAP["medium"])
 
     # Convertir colores hex a RGB con validación mejorada
     qr_color_rgb = hex_to_rgb(qr_color)
     bg_color_rgb = hex_to_rgb(bg_color)
 
-    print(f"Colores RGB: QR={qr_color_rgb}, Fondo={bg_color_rgb}")
+    log.debug("Colores RGB", extra={'qr_rgb': qr_color_rgb, 'bg_rgb': bg_color_rgb})
 
     # Validar que los colores sean tuplas válidas
     if not isinstance(qr_color_rgb, tuple) or len(qr_color_rgb) != 3:
-        print(f"Color QR inválido, usando negro por defecto")
+        log.debug("Color QR inválido, usando negro por defecto")
         qr_color_rgb = (0, 0, 0)
     if not isinstance(bg_color_rgb, tuple) or len(bg_color_rgb) != 3:
-        print(f"Color fondo inválido, usando blanco por defecto")
+        log.debug("Color fondo inválido, usando blanco por defecto")
         bg_color_rgb = (255, 255, 255)
 
-    # Crear QR con colores validados - siempre cuadrado
+    # Crear QR con colores validados
     qr = qrcode.QRCode(
         version=size_config["version"], 
         box_size=size_config["box_size"], 
         border=size_config["border"]
     )
-    qr.add_data(data)
-    qr.make(fit=True)
-
-    try:
-        img_qr = qr.make_image(fill_color=qr_color_rgb, back_color=bg_color_rgb).convert("RGB")
-    except Exception as e:
-        print(f"Error al crear imagen QR: {e}")
-        # Usar colores por defecto si hay error
-        img_qr = qr.make_image(fill_color=(0, 0, 0), back_color=(255, 255, 255)).convert("RGB")
+    agregar_datos(qr, data)
+    compilar_qr(qr)
+    matriz = qr.get_matrix()
+    box_size = size_config["box_size"]
+    if lado_max is not None:
+        box_size = max(1, lado_max // len(matriz))
+
+    # Los módulos cuadrados usan el mismo rasterizado (tile lleno, sin
+    # antialiasing): mismos píxeles que make_image().convert("RGB") sin sus
+    # dos imágenes intermedias
+    img_qr = rasterizar_modulos(
+        matriz, box_size, MODULE_SHAPES.get(qr_style, "square"),
+        qr_color_rgb, bg_color_rgb, size_config["border"],
+        gradient, hex_to_rgb(finder_color) if finder_color else None
+    )
 
     # Insertar logo si está habilitado y disponible
     if include_logo and logo_url:
         try:
-            # Descargar logo con headers para evitar bloqueos
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            response = requests.get(logo_url, headers=headers, timeout=10, stream=True)
-            response.raise_for_status()
-
-            # Verificar que el contenido sea una imagen válida
-            content_type = response.headers.get('content-type', '')
-
-            # Saltar SVGs ya que PIL tiene problemas con ellos
-            if 'svg' in content_type.lower():
-                print(f"Saltando SVG: {logo_url}")
-                return img_qr
-
-            if not content_type.startswith('image/'):
-                print(f"URL no contiene una imagen válida: {content_type}")
+            logo = cargar_logo(logo_url, qr_size)
+            if logo is None:
                 return img_qr
-
-            # Intentar abrir la imagen
-            try:
-                logo = Image.open(io.BytesIO(response.content)).convert("RGBA")
-            except Exception as img_error:
-                print(f"Error al procesar imagen: {img_error}")
-                return img_qr
-
-            # Redimensionar logo según el tamaño del QR
-            logo_size_map = {
-                "small": 40,
-                "medium": 60,
-                "large": 80
-            }
-            basewidth = logo_size_map.get(qr_size, 60)
-            wpercent = basewidth / float(logo.size[0])
-            hsize = int(float(logo.size[1]) * float(wpercent))
-            logo = logo.resize((basewidth, hsize), Image.LANCZOS)
+            if box_size != size_config["box_size"]:
+                # Misma proporción logo/QR que con el tamaño de módulo de serie
+                escala = box_size / size_config["box_size"]
+                logo = logo.resize((max(1, round(logo.size[0] * escala)), max(1, round(logo.size[1] * escala))), Image.LANCZOS)
 
             # Calcular posición y pegar
             pos = ((img_qr.size[0] - logo.size[0]) // 2, (img_qr.size[1] - logo.size[1]) // 2)
             img_qr.paste(logo, pos, mask=logo)
 
         except Exception as e:
-            print(f"Error al insertar logo desde {logo_url}: {e}")
+            log.warning("Error al insertar logo desde %s", logo_url, extra={'error': str(e), 'limitar': logo_url})
             # Continuar sin logo en caso de error
 
     return img_qr
 
-def aplicar_estilo_redondeado(img, estilo):
-    """Aplica bordes redondeados o circulares al QR"""
-    from PIL import ImageDraw
-
-    # Crear una nueva imagen con fondo transparente
-    size = max(img.size)  # Usar el tamaño más grande para asegurar que sea cuadrado
-    square_img = Image.new('RGB', (size, size), (255, 255, 255))
-
-    # Centrar la imagen original en el cuadrado
-    x = (size - img.size[0]) // 2
-    y = (size - img.size[1]) // 2
-    square_img.paste(img, (x, y))
-
-    # Crear máscara circular
-    mask = Image.new('L', (size, size), 0)
-    draw = ImageDraw.Draw(mask)
-
-    if estilo in ["rounded", "circle"]:
-        # Hacer completamente circular - usar todo el espacio disponible
-        margin = 5  # Pequeño margen para que se vea bien
-        draw.ellipse([margin, margin, size-margin, size-margin], fill=255)
-
-    # Convertir a RGBA para poder usar la máscara
-    square_img = square_img.convert('RGBA')
-
-    # Crear imagen final con fondo transparente
-    output = Image.new('RGBA', (size, size), (255, 255, 255, 0))
-
-    # Aplicar máscara
-    for x in range(size):
-        for y in range(size):
-            if mask.getpixel((x, y)) > 0:
-                output.putpixel((x, y), square_img.getpixel((x, y)) + (255,))
-
-    # Convertir de vuelta a RGB con fondo blanco
-    final = Image.new('RGB', (size, size), (255, 255, 255))
-    final.paste(output, mask=output)
-
-    return final
-
 def hacer_logo_circular(logo):
     """Convierte el logo en circular"""
     from PIL import ImageDraw
@@ -1018,6 +2047,2478 @@ def hacer_logo_circular(logo):
 
     return output
 
+# Formatos de salida soportados por el endpoint de imagen
+FORMATOS_IMAGEN = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "svg": "image/svg+xml"
+}
+
+# Ajustes de codificación elegidos con `python main.py bench-formatos`
+# (QR mediano de 370 px; "con logo" = logo RGBA de 60 px centrado):
+#   PNG RGB por defecto (antes):       1845 B sin logo, ~8 ms
+#   PNG paleta, compress_level 6:       677 B sin logo, 6.5 KB con logo, ~2-7 ms
+#   PNG compress_level 9:               9% menor, el doble de lento con logo
+#   WebP lossless method 1/quality 25:  400 B sin logo, 3.3 KB con logo, ~4-45 ms
+#   WebP method 0: el doble de bytes con logo; method >= 4: 3x-15x más lento sin ganar tamaño
+# Los renders quedan en caché, así que se prioriza el tamaño transferido.
+ENCODER_SETTINGS = {
+    "png": {"compress_level": 6},
+    "webp": {"lossless": True, "method": 1, "quality": 25}
+}
+
+def codificar_imagen(img, formato="png"):
+    """Codifica una imagen Pillow con los ajustes afinados para cada formato"""
+    ajustes = ENCODER_SETTINGS[formato]
+    if formato == "png":
+        # Un QR sin logo tiene dos colores: en modo paleta ocupa una fracción del RGB
+        # (paleta exacta construida a mano: ADAPTIVE es ~20x más lento)
+        colores = img.getcolors(256)
+        if colores is not None and img.mode == "RGB":
+            paleta = Image.new("P", (1, 1))
+            paleta.putpalette([canal for _, color in colores for canal in color])
+            img = img.quantize(palette=paleta, dither=Image.Dither.NONE)
+
+    with buffer_pool.flujo() as buf:
+        img.save(buf, format=formato.upper(), **ajustes)
+        longitud = buf.tell()
+        with buf.getbuffer() as vista:
+            return vista[:longitud].tobytes()
+
+# Maestros indexados para recolorear: por (data, estilo, tamaño), un PNG en modo
+# paleta cuyos índices son niveles de cobertura. Cambiar de colores es
+# reescribir el chunk PLTE: ni rasterizado ni compresión.
+PALETTE_MASTERS_MAX = int(os.environ.get('QR_PALETTE_MASTERS_MAX', '256'))
+_maestros_paleta = {}
+_maestros_paleta_lock = threading.Lock()
+estadisticas_paleta = {'maestros': 0, 'recoloreados': 0}
+
+def maestro_indexado(data, qr_style="square", qr_size="medium"):
+    """(png, inicio y fin del chunk PLTE, niveles de cobertura de cada índice)"""
+    clave = (data, qr_style, qr_size)
+    maestro = _maestros_paleta.get(clave)
+    if maestro is not None:
+        return maestro
+
+    size_config = QR_SIZE_MAP.get(qr_size, QR_SIZE_MAP["medium"])
+    qr = qrcode.QRCode(version=size_config["version"], box_size=size_config["box_size"], border=size_config["border"])
+    agregar_datos(qr, data)
+    compilar_qr(qr)
+    with buffer_pool.prestamo() as tomar:
+        datos, finder = mascaras_modulos(
+            qr.get_matrix(), size_config["box_size"], MODULE_SHAPES.get(qr_style, "square"), size_config["border"], tomar
+        )
+        np.add(datos, finder, out=datos)
+        # Solo los niveles presentes: con módulos cuadrados son 2 y el PNG queda a 1 bit
+        niveles, indices = np.unique(datos, return_inverse=True)
+        img = Image.fromarray(indices.reshape(datos.shape).astype(np.uint8), "P")
+    img.putpalette(bytes(3 * len(niveles)))
+    png = codificar_imagen(img, "png")
+
+    # Recorrer los chunks hasta PLTE (tras la firma de 8 bytes)
+    posicion = 8
+    while png[posicion + 4:posicion + 8] != b'PLTE':
+        posicion += 12 + struct.unpack('>I', png[posicion:posicion + 4])[0]
+    fin = posicion + 12 + struct.unpack('>I', png[posicion:posicion + 4])[0]
+
+    maestro = (png, posicion, fin, niveles)
+    with _maestros_paleta_lock:
+        _guardar_acotado(_maestros_paleta, clave, maestro, PALETTE_MASTERS_MAX)
+        estadisticas_paleta['maestros'] += 1
+    return maestro
+
+def recolorear_png(maestro, qr_color="#000000", bg_color="#ffffff"):
+    """PNG del maestro con los colores pedidos: solo cambia el chunk PLTE"""
+    png, inicio, fin, niveles = maestro
+    paleta = tabla_mezcla(hex_to_rgb(qr_color), hex_to_rgb(bg_color))[niveles].tobytes()
+    with _maestros_paleta_lock:
+        estadisticas_paleta['recoloreados'] += 1
+    return png[:inicio] + _png_chunk(b'PLTE', paleta) + png[fin:]
+
+def rachas_oscuras(matriz):
+    """Recorre las rachas horizontales de módulos oscuros como (fila, columna, longitud)"""
+    for fila, celdas in enumerate(matriz):
+        columna = 0
+        n = len(celdas)
+        while columna < n:
+            if celdas[columna]:
+                inicio = columna
+                while columna < n and celdas[columna]:
+                    columna += 1
+                yield fila, inicio, columna - inicio
+            else:
+                columna += 1
+
+def _rect_redondeado(x, y, lado, radio):
+    """Subtrazo SVG de un cuadrado con esquinas redondeadas"""
+    recto = lado - 2 * radio
+    return (
+        f"M{x + radio:g} {y:g}h{recto:g}a{radio:g} {radio:g} 0 0 1 {radio:g} {radio:g}"
+        f"v{recto:g}a{radio:g} {radio:g} 0 0 1 -{radio:g} {radio:g}"
+        f"h-{recto:g}a{radio:g} {radio:g} 0 0 1 -{radio:g} -{radio:g}"
+        f"v-{recto:g}a{radio:g} {radio:g} 0 0 1 {radio:g} -{radio:g}z"
+    )
+
+def _trazos_formas(matriz, forma, border):
+    """Trazos SVG (datos, patrones de posición) con la geometría del render raster"""
+    geometria = SHAPE_GEOMETRY[forma]
+    n = len(matriz)
+    finders = posiciones_finder(n, border)
+
+    trazo_finder = []
+    for fila, columna in finders:
+        r = geometria["radio_finder"]
+        trazo_finder.append(_rect_redondeado(columna, fila, 7, r))
+        trazo_finder.append(_rect_redondeado(columna + 1, fila + 1, 5, max(r - 1, 0)))
+        trazo_finder.append(_rect_redondeado(columna + 2, fila + 2, 3, max(r - 0.6, 0)))
+
+    # Módulos de datos: la matriz sin los patrones de posición
+    datos = [list(celdas) for celdas in matriz]
+    for fila, columna in finders:
+        for f in range(fila, fila + 7):
+            datos[f][columna:columna + 7] = [False] * 7
+
+    if forma == "square":
+        trazo_datos = "".join(f"M{c} {f}h{l}v1h-{l}z" for f, c, l in rachas_oscuras(datos))
+    else:
+        lado = geometria["lado"]
+        margen = (1 - lado) / 2
+        trazo_datos = "".join(
+            _rect_redondeado(round(c + margen, 4), round(f + margen, 4), lado, geometria["radio"])
+            for f, celdas in enumerate(datos) for c, oscuro in enumerate(celdas) if oscuro
+        )
+    return trazo_datos, "".join(trazo_finder)
+
+def _degradado_svg(gradient, lado):
+    """Definición SVG del degradado, con los mismos extremos que el raster"""
+    tipo, inicio, fin, angulo = parsear_degradado(gradient)
+    paradas = (
+        f'<stop offset="0" stop-color="#{"%02x%02x%02x" % inicio}"/>'
+        f'<stop offset="1" stop-color="#{"%02x%02x%02x" % fin}"/>'
+    )
+    if tipo == "radial":
+        cx, cy, radio = geometria_degradado(tipo, lado, angulo)
+        return f'<radialGradient id="g" gradientUnits="userSpaceOnUse" cx="{cx:g}" cy="{cy:g}" r="{radio:g}">{paradas}</radialGradient>'
+    x1, y1, x2, y2 = geometria_degradado(tipo, lado, angulo)
+    return (
+        f'<linearGradient id="g" gradientUnits="userSpaceOnUse" x1="{x1:g}" y1="{y1:g}" x2="{x2:g}" y2="{y2:g}">'
+        f'{paradas}</linearGradient>'
+    )
+
+def generar_qr_svg(data, logo_url=None, bg_color="#ffffff", qr_color="#000000", qr_style="square", qr_size="medium", include_logo=True, gradient=None, finder_color=None):
+    """Genera el QR como SVG vectorial, con el logo incrustado en PNG"""
+    size_config = QR_SIZE_MAP.get(qr_size, QR_SIZE_MAP["medium"])
+    qr = qrcode.QRCode(
+        version=size_config["version"],
+        box_size=size_config["box_size"],
+        border=size_config["border"]
+    )
+    agregar_datos(qr, data)
+    compilar_qr(qr)
+    matriz = qr.get_matrix()
+    n = len(matriz)
+    lado_px = n * size_config["box_size"]
+
+    fondo = "#%02x%02x%02x" % hex_to_rgb(bg_color)
+    color = "#%02x%02x%02x" % hex_to_rgb(qr_color)
+
+    partes = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{lado_px}" height="{lado_px}" '
+        f'viewBox="0 0 {n} {n}">'
+    ]
+    if gradient:
+        partes.append(f'<defs>{_degradado_svg(gradient, n)}</defs>')
+        color = "url(#g)"
+    partes.append(f'<rect width="{n}" height="{n}" fill="{fondo}"/>')
+
+    forma = MODULE_SHAPES.get(qr_style)
+    if forma is None and not finder_color:
+        trazo = "".join(f"M{c} {f}h{l}v1h-{l}z" for f, c, l in rachas_oscuras(matriz))
+        partes.append(f'<path d="{trazo}" fill="{color}" shape-rendering="crispEdges"/>')
+    else:
+        trazo_datos, trazo_finder = _trazos_formas(matriz, forma or "square", size_config["border"])
+        color_finder = "#%02x%02x%02x" % hex_to_rgb(finder_color) if finder_color else color
+        partes.append(f'<path d="{trazo_datos}" fill="{color}"/>')
+        partes.append(f'<path d="{trazo_finder}" fill="{color_finder}" fill-rule="evenodd"/>')
+
+    if include_logo and logo_url:
+        try:
+            logo = cargar_logo(logo_url, qr_size)
+        except Exception as e:
+            log.warning("Error al insertar logo desde %s", logo_url, extra={'error': str(e), 'limitar': logo_url})
+            logo = None
+        if logo is not None:
+            buf = io.BytesIO()
+            logo.save(buf, format="PNG")
+            ancho = logo.size[0] / size_config["box_size"]
+            alto = logo.size[1] / size_config["box_size"]
+            partes.append(
+                f'<image x="{(n - ancho) / 2}" y="{(n - alto) / 2}" width="{ancho}" height="{alto}" '
+                f'href="data:image/png;base64,{base64.b64encode(buf.getvalue()).decode()}"/>'
+            )
+
+    partes.append('</svg>')
+    return "".join(partes).encode()
+
+# Tarjetas: el QR dentro de un marco con texto, sobre capas estáticas en caché
+CARD_TEMPLATES = {
+    "clasica": {"fondo": "#ffffff", "marco": "#764ba2", "texto": "#4a5568", "caption": "¡Escanéame!"},
+    "menu": {"fondo": "#1a202c", "marco": "#d69e2e", "texto": "#fefcbf", "caption": "Ver menú"},
+    "evento": {"fondo": ("#667eea", "#764ba2"), "marco": "#ffffff", "texto": "#ffffff", "caption": "Escanea para entrar"}
+}
+CARD_WIDTHS = {
+    "small": 360,
+    "medium": 480,
+    "large": 640
+}
+CARD_CAPTION_MAX = 40
+CARD_CACHE_MAX = 64
+_capas_tarjeta = {}
+
+def parsear_tarjeta(card):
+    """Convierte "plantilla" o "plantilla:texto" en (plantilla, texto)"""
+    nombre, _, caption = card.partition(":")
+    if nombre not in CARD_TEMPLATES:
+        raise ValueError(f"Plantilla de tarjeta no soportada: {nombre}")
+    caption = caption.strip() or CARD_TEMPLATES[nombre]["caption"]
+    if len(caption) > CARD_CAPTION_MAX:
+        raise ValueError(f"El texto de la tarjeta admite como máximo {CARD_CAPTION_MAX} caracteres")
+    return nombre, caption
+
+def geometria_tarjeta(ancho):
+    """Tamaño de la tarjeta y posición del hueco donde va el QR"""
+    margen = ancho // 12
+    grosor = max(2, ancho // 60)
+    lado = ancho - 2 * margen
+    return {
+        "tamano": (ancho, round(ancho * 1.3)),
+        "margen": margen,
+        "grosor": grosor,
+        "hueco": (margen, margen, lado)
+    }
+
+def capa_tarjeta(nombre, ancho, caption):
+    """Fondo, marco y texto de una plantilla ya rasterizados, en caché"""
+    clave = (nombre, ancho, caption)
+    capa = _capas_tarjeta.get(clave)
+    if capa is not None:
+        return capa
+
+    from PIL import ImageDraw, ImageFont
+
+    plantilla = CARD_TEMPLATES[nombre]
+    geometria = geometria_tarjeta(ancho)
+    ancho, alto = geometria["tamano"]
+    x, y, lado = geometria["hueco"]
+    grosor = geometria["grosor"]
+
+    if isinstance(plantilla["fondo"], tuple):
+        # Degradado vertical entre los dos colores
+        arriba, abajo = (np.array(hex_to_rgb(c), dtype=np.float32) for c in plantilla["fondo"])
+        t = np.linspace(0, 1, alto, dtype=np.float32)[:, None, None]
+        filas = np.rint(arriba + (abajo - arriba) * t).astype(np.uint8)
+        capa = Image.fromarray(np.broadcast_to(filas, (alto, ancho, 3)).copy(), "RGB")
+    else:
+        capa = Image.new("RGB", (ancho, alto), hex_to_rgb(plantilla["fondo"]))
+
+    draw = ImageDraw.Draw(capa)
+    draw.rounded_rectangle(
+        [x - 2 * grosor, y - 2 * grosor, x + lado + 2 * grosor - 1, y + lado + 2 * grosor - 1],
+        radius=4 * grosor, fill=hex_to_rgb(plantilla["marco"])
+    )
+
+    # Texto centrado bajo el QR, reduciendo la fuente hasta que quepa
+    zona = alto - (y + lado + 2 * grosor)
+    tamano_fuente = ancho // 12
+    while True:
+        fuente = ImageFont.load_default(size=tamano_fuente)
+        izquierda, arriba_txt, derecha, abajo_txt = draw.textbbox((0, 0), caption, font=fuente)
+        if derecha - izquierda <= ancho - 2 * geometria["margen"] or tamano_fuente <= 10:
+            break
+        tamano_fuente -= 2
+    draw.text(
+        ((ancho - (derecha - izquierda)) // 2 - izquierda,
+         y + lado + 2 * grosor + (zona - (abajo_txt - arriba_txt)) // 2 - arriba_txt),
+        caption, font=fuente, fill=hex_to_rgb(plantilla["texto"])
+    )
+
+    _guardar_acotado(_capas_tarjeta, clave, capa, CARD_CACHE_MAX)
+    return capa
+
+def lado_hueco_tarjeta(qr_size="medium"):
+    """Lado en píxeles del hueco del QR en la tarjeta de ese tamaño"""
+    return geometria_tarjeta(CARD_WIDTHS.get(qr_size, CARD_WIDTHS["medium"]))["hueco"][2]
+
+def componer_tarjeta(img_qr, card, qr_size="medium", bg_color="#ffffff"):
+    """Pega el QR centrado en el hueco de la capa estática de la plantilla
+
+    img_qr ya viene a píxeles enteros por módulo y no mayor que el hueco: no
+    se reescala (módulos desiguales leen peor); el sobrante del hueco se
+    rellena con el fondo del QR, como una zona de silencio algo más ancha.
+    """
+    nombre, caption = parsear_tarjeta(card)
+    ancho = CARD_WIDTHS.get(qr_size, CARD_WIDTHS["medium"])
+    x, y, lado = geometria_tarjeta(ancho)["hueco"]
+
+    tarjeta = capa_tarjeta(nombre, ancho, caption).copy()
+    tarjeta.paste(hex_to_rgb(bg_color), (x, y, x + lado, y + lado))
+    tarjeta.paste(img_qr, (x + (lado - img_qr.size[0]) // 2, y + (lado - img_qr.size[1]) // 2))
+    return tarjeta
+
+def renderizar_qr(data, logo_url=None, bg_color="#ffffff", qr_color="#000000", qr_style="square", qr_size="medium", include_logo=True, formato="png", gradient=None, finder_color=None, card=None):
+    """Pipeline completo: codifica, rasteriza y devuelve el QR en el formato pedido"""
+    if formato == "svg":
+        if card:
+            raise ValueError("Las tarjetas solo están disponibles en PNG y WebP")
+        return generar_qr_svg(data, logo_url, bg_color, qr_color, qr_style, qr_size, include_logo, gradient, finder_color)
+
+    if formato == "png" and not (include_logo and logo_url) and not gradient and not finder_color and not card:
+        # Dos colores (más sus niveles de antialiasing): basta con la paleta del maestro
+        return recolorear_png(maestro_indexado(data, qr_style, qr_size), qr_color, bg_color)
+
+    img = generar_qr_personalizado(
+        data, logo_url, bg_color, qr_color, qr_style, qr_size, include_logo, gradient, finder_color,
+        lado_hueco_tarjeta(qr_size) if card else None
+    )
+    if card:
+        img = componer_tarjeta(img, card, qr_size, bg_color)
+    return codificar_imagen(img, formato)
+
+def negociar_formato(formato, accept):
+    """Elige el formato: parámetro explícito, o el mejor tipo listado en Accept
+
+    Solo cuentan los tipos nombrados explícitamente; `*/*` o `image/*` no
+    bastan para servir WebP o SVG a un cliente que quizá no los entienda.
+    """
+    if formato in FORMATOS_IMAGEN:
+        return formato
+
+    preferencia = ["webp", "png", "svg"]
+    candidatos = [
+        (accept[mimetype], -preferencia.index(nombre), nombre)
+        for nombre, mimetype in FORMATOS_IMAGEN.items()
+        if mimetype in accept.values() and accept[mimetype] > 0
+    ]
+    return max(candidatos)[2] if candidatos else "png"
+
+# Ajustes candidatos que compara el benchmark de codificadores
+ENCODER_CANDIDATES = {
+    "png": [{"compress_level": nivel} for nivel in (1, 6, 9)] + [{"optimize": True}],
+    "webp": [{"lossless": True, "method": m, "quality": q} for m, q in ((0, 25), (1, 25), (2, 50), (4, 80), (6, 100))]
+}
+
+def benchmark_formatos(args=None):
+    """Compara tamaño y tiempo de codificación de cada ajuste candidato"""
+    repeticiones = int(args[0]) if args else 20
+
+    sin_logo = generar_qr_personalizado("https://example.com/menu/12345", None)
+    con_logo = sin_logo.copy()
+    # Logo sintético con degradado y alfa, para no depender de la red
+    logo = Image.radial_gradient("L").resize((LOGO_SIZE_MAP["medium"],) * 2)
+    logo = Image.merge("RGBA", (logo, logo.transpose(Image.FLIP_LEFT_RIGHT), logo.rotate(90), logo))
+    con_logo.paste(logo, ((con_logo.size[0] - 60) // 2, (con_logo.size[1] - 60) // 2), mask=logo)
+
+    print(f"{'formato':<8}{'ajustes':<48}{'muestra':<10}{'bytes':>8}{'ms':>9}")
+    for formato, candidatos in ENCODER_CANDIDATES.items():
+        for ajustes in candidatos:
+            for nombre, img in (("sin_logo", sin_logo), ("con_logo", con_logo)):
+                anterior = ENCODER_SETTINGS[formato]
+                ENCODER_SETTINGS[formato] = ajustes
+                try:
+                    inicio = time.perf_counter()
+                    for _ in range(repeticiones):
+                        contenido = codificar_imagen(img, formato)
+                    ms = (time.perf_counter() - inicio) * 1000 / repeticiones
+                finally:
+                    ENCODER_SETTINGS[formato] = anterior
+                print(f"{formato:<8}{json.dumps(ajustes):<48}{nombre:<10}{len(contenido):>8}{ms:>9.2f}")
+
+# Casos de bench-buffers: cada uno recorre una rama distinta del rasterizado
+BUFFER_BENCH_CASES = [
+    ("cuadrado", {}),
+    ("redondeado", {"qr_style": "rounded"}),
+    ("degradado", {"qr_style": "circle", "gradient": "linear:#667eea:#764ba2:45", "finder_color": "#e53e3e"})
+]
+
+def benchmark_buffers(args=None):
+    """Reservas y latencia por render con el pool de búferes y sin él.
+
+    Uso: bench-buffers [renders por caso]
+    """
+    global buffer_pool
+    repeticiones = int(args[0]) if args else 50
+    data = "https://example.com/menu/12345"
+    original = buffer_pool
+
+    print(f"{'caso':<12}{'pool':<6}{'arrays':>8}{'imagenes':>10}{'pico_KB':>9}{'p50_ms':>8}{'p99_ms':>8}")
+    try:
+        for nombre, opciones in BUFFER_BENCH_CASES:
+            for con_pool in (False, True):
+                # Un pool de 0 bytes no retiene nada: cada préstamo es una reserva nueva
+                buffer_pool = PoolBuffers(BUFFER_POOL_BYTES if con_pool else 0, BUFFER_POOL_PER_KEY)
+                renderizar_qr(data, None, include_logo=False, **opciones)
+
+                creados = buffer_pool.creados
+                imagenes = Image.core.get_stats()['new_count']
+                tiempos = []
+                for _ in range(repeticiones):
+                    inicio = time.perf_counter()
+                    renderizar_qr(data, None, include_logo=False, **opciones)
+                    tiempos.append((time.perf_counter() - inicio) * 1000)
+                arrays = (buffer_pool.creados - creados) / repeticiones
+                imagenes = (Image.core.get_stats()['new_count'] - imagenes) / repeticiones
+
+                tracemalloc.start()
+                renderizar_qr(data, None, include_logo=False, **opciones)
+                _, pico = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                tiempos.sort()
+                p99 = tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.99))]
+                print(f"{nombre:<12}{'si' if con_pool else 'no':<6}{arrays:>8.1f}{imagenes:>10.1f}"
+                      f"{pico / 1024:>9.0f}{tiempos[len(tiempos) // 2]:>8.2f}{p99:>8.2f}")
+    finally:
+        buffer_pool = original
+
+def benchmark_codificador(args=None):
+    """Compara qr.make(fit=True) con compilar_qr de la versión 1 a la 40.
+
+    Uso: bench-codificador [repeticiones]  (nivel M, carga en modo byte que
+    llena cada versión; ms_frio incluye construir la plantilla de la versión)
+    """
+    repeticiones = int(args[0]) if args else 5
+    random.seed(0)
+
+    def preparar(data):
+        qr = qrcode.QRCode()
+        qr.add_data(qrutil.QRData(data.encode('ascii'), mode=qrutil.MODE_8BIT_BYTE, check_data=False))
+        return qr
+
+    def medir(funcion, data):
+        tiempos = []
+        for _ in range(repeticiones):
+            qr = preparar(data)
+            inicio = time.perf_counter()
+            funcion(qr)
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+        return qr, sorted(tiempos)[len(tiempos) // 2]
+
+    print(f"{'version':>7}{'qrcode_ms':>11}{'numpy_ms':>10}{'ms_frio':>9}{'x':>7}  identico")
+    for version in range(1, 41):
+        data = _payload_para_version(version)
+        referencia, ms_qrcode = medir(lambda qr: qr.make(fit=True), data)
+        inicio = time.perf_counter()
+        compilar_qr(preparar(data))
+        ms_frio = (time.perf_counter() - inicio) * 1000
+        resultado, ms_numpy = medir(compilar_qr, data)
+        identico = referencia.get_matrix() == resultado.get_matrix() and referencia.data_cache == resultado.data_cache
+        print(f"{version:>7}{ms_qrcode:>11.2f}{ms_numpy:>10.2f}{ms_frio:>9.2f}{ms_qrcode / ms_numpy:>7.1f}  {'si' if identico else 'NO'}")
+
+# Muestras de cargas mixtas para bench-segmentos
+SEGMENT_BENCH_PAYLOADS = [
+    "https://example.com/menu/12345",
+    "https://tienda.example.com/pedido/4830291847561029384756",
+    "https://example.com/p?id=9780306406157&ref=00012345678905",
+    "HTTPS://EXAMPLE.COM/TICKET/A1B2C3D4E5F6G7H8",
+    "HTTP://QR.EXAMPLE.ES/R/ABCDEF123456/7890",
+    "tel:+34600123456",
+    "WIFI:T:WPA;S:Oficina;P:384756102938475610;;",
+    "BEGIN:VCARD\nVERSION:3.0\nN:Pérez;Ana\nTEL:+34911234567\nEND:VCARD",
+    "SHIPMENT 00340123450000000017 LOT 20250114 QTY 000120",
+    "https://wa.me/34600123456?text=Hola%20quiero%20reservar%20mesa%20para%204",
+]
+
+def benchmark_segmentos(args=None):
+    """Compara la versión elegida por add_data con la segmentación óptima.
+
+    Uso: bench-segmentos [fichero con una carga por línea]
+    """
+    if args:
+        with open(args[0], encoding='utf-8') as fichero:
+            payloads = [linea.rstrip('\n') for linea in fichero if linea.strip()]
+    else:
+        payloads = SEGMENT_BENCH_PAYLOADS
+
+    print(f"{'v_add_data':>10}{'v_optima':>10}{'ahorro':>8}{'modulos':>10}{'ms_dp':>8}  carga")
+    total_antes = total_despues = 0
+    for data in payloads:
+        qr = qrcode.QRCode()
+        qr.add_data(data)
+        qr.make(fit=True)
+        inicio = time.perf_counter()
+        optima = segmentos_optimos(data)
+        ms = (time.perf_counter() - inicio) * 1000
+        if optima is None:
+            continue
+        version = optima[0]
+        lado_antes, lado_despues = qr.version * 4 + 17, version * 4 + 17
+        total_antes += lado_antes ** 2
+        total_despues += lado_despues ** 2
+        print(f"{qr.version:>10}{version:>10}{qr.version - version:>8}{lado_antes ** 2 - lado_despues ** 2:>10}{ms:>8.2f}  {data[:50]!r}")
+    if total_antes:
+        print(f"Módulos totales: {total_antes} -> {total_despues} ({100 * (1 - total_despues / total_antes):.1f}% menos)")
+
+# Modelo de coste de render: predice ms y memoria antes de hacer nada a partir de
+# la versión (según la segmentación óptima), el tamaño y el estilo. Los
+# coeficientes salen de bench-coste y se pueden recalibrar en cada máquina.
+#   ms    = a + b * modulos² + c * modulos³ + d * pixeles
+#   bytes = e + f * pixeles
+COST_MODEL_PATH = os.environ.get('QR_COST_MODEL', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cost_model.json'))
+COST_MODEL_DEFAULT = {
+    "cuadrado": {"ms": [0.1818, 0.004281, -1.69e-05, 1.585e-05], "bytes": [281000.0, 4.345]},
+    "estilo": {"ms": [2.566, 0.004109, -7.843e-06, 1.705e-05], "bytes": [281000.0, 4.345]}
+}
+ADMISSION_POLICY = os.environ.get('QR_ADMISSION_POLICY', 'downgrade')
+ADMISSION_MAX_MS = float(os.environ.get('QR_ADMISSION_MAX_MS', '250'))
+ADMISSION_MAX_MB = float(os.environ.get('QR_ADMISSION_MAX_MB', '128'))
+ADMISSION_POLICIES = ("reject", "downgrade", "async")
+
+def cargar_modelo_coste(ruta=COST_MODEL_PATH):
+    try:
+        with open(ruta) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return COST_MODEL_DEFAULT
+    except (OSError, ValueError) as e:
+        log.warning("Modelo de coste ilegible, usando el de serie", extra={'ruta': ruta, 'error': str(e)})
+        return COST_MODEL_DEFAULT
+
+modelo_coste = cargar_modelo_coste()
+
+def _rasgos_coste(version, qr_size):
+    """(módulos de datos por lado, píxeles de la imagen final)"""
+    size_config = QR_SIZE_MAP.get(qr_size, QR_SIZE_MAP["medium"])
+    modulos = 4 * max(version, size_config["version"]) + 17
+    return modulos, ((modulos + 2 * size_config["border"]) * size_config["box_size"]) ** 2
+
+def _clase_coste(qr_style, gradient=None, finder_color=None):
+    return "estilo" if qr_style in MODULE_SHAPES or gradient or finder_color else "cuadrado"
+
+def estimar_coste(data, qr_style="square", qr_size="medium", gradient=None, finder_color=None):
+    """Predicción de {'version', 'ms', 'mb'} sin renderizar; None si data no cabe en un QR"""
+    optima = segmentos_optimos(data)
+    if optima is None:
+        return None
+    modulos, pixeles = _rasgos_coste(optima[0], qr_size)
+    coef = modelo_coste[_clase_coste(qr_style, gradient, finder_color)]
+    return {
+        'version': optima[0],
+        'ms': round(max(coef["ms"][0] + coef["ms"][1] * modulos ** 2 + coef["ms"][2] * modulos ** 3 + coef["ms"][3] * pixeles, 0), 1),
+        'mb': round((coef["bytes"][0] + coef["bytes"][1] * pixeles) / 2 ** 20, 1)
+    }
+
+def admitir_render(data, qr_style="square", qr_size="medium", gradient=None, finder_color=None, politica=None):
+    """Decide qué hacer con un render antes de empezarlo según su coste estimado
+
+    Devuelve (decision, estimacion, opciones): 'ok', 'degradar' (con qr_style,
+    qr_size, gradient y finder_color más baratos en opciones), 'asincrono' o 'rechazar'.
+    """
+    politica = politica or ADMISSION_POLICY
+    opciones = {'qr_style': qr_style, 'qr_size': qr_size, 'gradient': gradient, 'finder_color': finder_color}
+    estimacion = estimar_coste(data, **opciones)
+    if estimacion is None:
+        return 'rechazar', None, opciones
+
+    def cabe(e):
+        return e['ms'] <= ADMISSION_MAX_MS and e['mb'] <= ADMISSION_MAX_MB
+
+    if cabe(estimacion):
+        return 'ok', estimacion, opciones
+    if politica == 'downgrade':
+        # Primero el estilo (rasterizado por píxel), luego el tamaño
+        for cambio in ({'qr_style': 'square', 'gradient': None, 'finder_color': None}, {'qr_size': 'small'}):
+            opciones.update(cambio)
+            degradada = estimar_coste(data, **opciones)
+            if cabe(degradada):
+                return 'degradar', degradada, opciones
+        return 'rechazar', estimacion, opciones
+    if politica == 'async':
+        return 'asincrono', estimacion, opciones
+    return 'rechazar', estimacion, opciones
+
+def _payload_para_version(version):
+    """Texto en modo byte que ocupa exactamente la versión dada (nivel M)"""
+    bits = qrutil.BIT_LIMIT_TABLE[qrcode.constants.ERROR_CORRECT_M][version]
+    longitud = (bits - 4 - qrutil.length_in_bits(qrutil.MODE_8BIT_BYTE, version)) // 8
+    return "".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(longitud))
+
+def benchmark_coste(args=None):
+    """Mide renders por versión, tamaño y estilo y ajusta el modelo de coste.
+
+    Uso: bench-coste [--guardar]  (escribe los coeficientes en QR_COST_MODEL)
+    """
+    random.seed(0)
+    muestras = {"cuadrado": [], "estilo": []}
+    for version in (1, 3, 5, 8, 10, 15, 20, 25, 30, 35, 40):
+        data = _payload_para_version(version)
+        for qr_size in QR_SIZE_MAP:
+            for qr_style, clase in (("square", "cuadrado"), ("rounded", "estilo")):
+                tiempos = []
+                for _ in range(3):
+                    inicio = time.perf_counter()
+                    renderizar_qr(data, None, qr_style=qr_style, qr_size=qr_size, include_logo=False)
+                    tiempos.append((time.perf_counter() - inicio) * 1000)
+                # La memoria en una pasada aparte: tracemalloc multiplica el tiempo
+                tracemalloc.start()
+                renderizar_qr(data, None, qr_style=qr_style, qr_size=qr_size, include_logo=False)
+                _, pico = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                modulos, pixeles = _rasgos_coste(version, qr_size)
+                # tracemalloc no ve los búferes internos de Pillow: sumar la imagen RGB final
+                muestras[clase].append((modulos, pixeles, sorted(tiempos)[1], pico + 3 * pixeles))
+
+    modelo = {}
+    print(f"{'clase':<10}{'modulos':>8}{'pixeles':>10}{'ms':>9}{'ms_pred':>9}{'MB':>8}{'MB_pred':>9}")
+    for clase, filas in muestras.items():
+        m = np.array(filas, dtype=np.float64)
+        rasgos_ms = np.column_stack([np.ones(len(m)), m[:, 0] ** 2, m[:, 0] ** 3, m[:, 1]])
+        coef_ms = np.linalg.lstsq(rasgos_ms, m[:, 2], rcond=None)[0]
+        coef_bytes = np.linalg.lstsq(np.column_stack([np.ones(len(m)), m[:, 1]]), m[:, 3], rcond=None)[0]
+        modelo[clase] = {"ms": [float(f"{c:.4g}") for c in coef_ms], "bytes": [float(f"{c:.4g}") for c in coef_bytes]}
+        for (modulos, pixeles, ms, memoria), pred in zip(filas, rasgos_ms @ coef_ms):
+            pred_bytes = coef_bytes[0] + coef_bytes[1] * pixeles
+            print(f"{clase:<10}{modulos:>8}{pixeles:>10}{ms:>9.1f}{pred:>9.1f}{memoria / 2 ** 20:>8.1f}{pred_bytes / 2 ** 20:>9.1f}")
+
+    print(json.dumps(modelo))
+    if args and "--guardar" in args:
+        with open(COST_MODEL_PATH, 'w') as f:
+            json.dump(modelo, f, indent=2)
+        print(f"Modelo guardado en {COST_MODEL_PATH}")
+
+class RenderCache:
+    """Caché LRU de renders codificados, limitada por bytes totales"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entradas = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave):
+        with self._lock:
+            contenido = self._entradas.get(clave)
+            if contenido is None:
+                self.misses += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.hits += 1
+            return contenido
+
+    def put(self, clave, contenido):
+        if len(contenido) > self.max_bytes:
+            return
+        with self._lock:
+            anterior = self._entradas.pop(clave, None)
+            if anterior is not None:
+                self.bytes -= len(anterior)
+            self._entradas[clave] = contenido
+            self.bytes += len(contenido)
+            while self.bytes > self.max_bytes:
+                _, expulsado = self._entradas.popitem(last=False)
+                self.bytes -= len(expulsado)
+
+    def __len__(self):
+        return len(self._entradas)
+
+RENDER_CACHE_BYTES = int(os.environ.get('QR_RENDER_CACHE_BYTES', str(64 * 1024 * 1024)))
+render_cache = RenderCache(RENDER_CACHE_BYTES)
+
+# Almacenamiento de historial, renders y logos subidos. Por defecto vive en el
+# proceso (dicts, RenderCache y disco); con QR_STORAGE_URL=redis://... se comparte
+# entre workers y nodos, con render_cache como primer nivel local.
+STORAGE_URL = os.environ.get('QR_STORAGE_URL', '')
+STORAGE_POOL_SIZE = int(os.environ.get('QR_STORAGE_POOL_SIZE', '16'))
+STORAGE_TIMEOUT = float(os.environ.get('QR_STORAGE_TIMEOUT', '0.5'))
+STORAGE_RENDER_TTL = int(os.environ.get('QR_STORAGE_RENDER_TTL', str(7 * 24 * 3600)))
+STORAGE_PIPELINE_BATCH = 256
+
+class AlmacenNoDisponible(Exception):
+    """El backend compartido no responde y la operación no admite degradarse"""
+
+class AlmacenLocal:
+    """Backend en proceso: historial en user_qr_history, renders en render_cache y logos en disco"""
+    nombre = "memoria"
+
+    def __init__(self, renders, historial):
+        self.renders = renders
+        self.historial = historial
+
+    def leer_render(self, clave):
+        return self.renders.get(clave)
+
+    def leer_renders(self, claves):
+        return [self.renders.get(clave) for clave in claves]
+
+    def guardar_render(self, clave, contenido):
+        self.renders.put(clave, contenido)
+
+    def agregar_historial(self, user_id, entrada):
+        self.historial.setdefault(user_id, []).append(entrada)
+
+    def leer_historial(self, user_id):
+        return list(self.historial.get(user_id, []))
+
+    def borrar_historial(self, user_id):
+        self.historial[user_id] = []
+
+    def existe_logo(self, sha):
+        return os.path.exists(ruta_logo_subido(sha))
+
+    def leer_logo(self, sha):
+        try:
+            with open(ruta_logo_subido(sha), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def guardar_logo(self, sha, contenido):
+        ruta = ruta_logo_subido(sha)
+        os.makedirs(LOGO_STORE_DIR, exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, 'wb') as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+
+class AlmacenRedis:
+    """Backend compartido en Redis con pool de conexiones y lecturas por lotes en pipeline.
+
+    Los renders se cachean también en local; si Redis no responde, la caché
+    compartida se trata como un fallo de caché y el render sigue adelante.
+    """
+    nombre = "redis"
+    PREFIJO = "qr:"
+
+    def __init__(self, url, renders):
+        if redis is None:
+            raise RuntimeError("QR_STORAGE_URL requiere el paquete redis (pip install redis)")
+        self.renders = renders
+        self.pool = redis.ConnectionPool.from_url(
+            url, max_connections=STORAGE_POOL_SIZE,
+            socket_timeout=STORAGE_TIMEOUT, socket_connect_timeout=STORAGE_TIMEOUT
+        )
+        self.cliente = redis.Redis(connection_pool=self.pool)
+
+    def _clave_render(self, clave):
+        return self.PREFIJO + "render:" + hashlib.sha256(json.dumps(clave).encode()).hexdigest()
+
+    def leer_render(self, clave):
+        return self.leer_renders([clave])[0]
+
+    def leer_renders(self, claves):
+        resultados = [self.renders.get(clave) for clave in claves]
+        pendientes = [i for i, contenido in enumerate(resultados) if contenido is None]
+        try:
+            for inicio in range(0, len(pendientes), STORAGE_PIPELINE_BATCH):
+                lote = pendientes[inicio:inicio + STORAGE_PIPELINE_BATCH]
+                pipe = self.cliente.pipeline(transaction=False)
+                for i in lote:
+                    pipe.get(self._clave_render(claves[i]))
+                for i, contenido in zip(lote, pipe.execute()):
+                    if contenido is not None:
+                        self.renders.put(claves[i], contenido)
+                        resultados[i] = contenido
+        except redis.RedisError as e:
+            log.warning("Caché compartida no disponible", extra={'error': str(e), 'limitar': 'redis'})
+        return resultados
+
+    def guardar_render(self, clave, contenido):
+        self.renders.put(clave, contenido)
+        try:
+            self.cliente.set(self._clave_render(clave), contenido, ex=STORAGE_RENDER_TTL)
+        except redis.RedisError as e:
+            log.warning("Caché compartida no disponible", extra={'error': str(e), 'limitar': 'redis'})
+
+    # Sin Redis el historial se degrada (no se anota, se lee vacío) y el render
+    # sigue; borrar no puede fingir éxito y los logos no tienen copia local.
+    def agregar_historial(self, user_id, entrada):
+        try:
+            self.cliente.rpush(f"{self.PREFIJO}historial:{user_id}", json.dumps(entrada))
+        except redis.RedisError as e:
+            log.warning("Historial compartido no disponible", extra={'error': str(e), 'limitar': 'redis'})
+
+    def leer_historial(self, user_id):
+        try:
+            return [json.loads(e) for e in self.cliente.lrange(f"{self.PREFIJO}historial:{user_id}", 0, -1)]
+        except redis.RedisError as e:
+            log.warning("Historial compartido no disponible", extra={'error': str(e), 'limitar': 'redis'})
+            return []
+
+    def borrar_historial(self, user_id):
+        try:
+            self.cliente.delete(f"{self.PREFIJO}historial:{user_id}")
+        except redis.RedisError as e:
+            raise AlmacenNoDisponible("Historial no disponible") from e
+
+    def existe_logo(self, sha):
+        try:
+            return bool(self.cliente.exists(f"{self.PREFIJO}logo:{sha}"))
+        except redis.RedisError as e:
+            raise LogoUploadError("Almacén de logos no disponible", 503) from e
+
+    def leer_logo(self, sha):
+        try:
+            return self.cliente.get(f"{self.PREFIJO}logo:{sha}")
+        except redis.RedisError as e:
+            raise LogoUploadError("Almacén de logos no disponible", 503) from e
+
+    def guardar_logo(self, sha, contenido):
+        # El hash es del contenido subido: si otro nodo ya lo guardó, es el mismo logo
+        try:
+            self.cliente.set(f"{self.PREFIJO}logo:{sha}", contenido, nx=True)
+        except redis.RedisError as e:
+            raise LogoUploadError("Almacén de logos no disponible", 503) from e
+
+def crear_almacen():
+    if STORAGE_URL:
+        return AlmacenRedis(STORAGE_URL, render_cache)
+    return AlmacenLocal(render_cache, user_qr_history)
+
+almacen = crear_almacen()
+
+def clave_render(data, logo_url, bg_color, qr_color, qr_style, qr_size, include_logo, formato, gradient=None, finder_color=None, card=None):
+    """Clave de la caché de renders; el formato, el relleno y la tarjeta forman parte de ella"""
+    return (
+        data, logo_url if include_logo else None, bg_color.lower(), qr_color.lower(), qr_style, qr_size, formato,
+        gradient.lower() if gradient else None, finder_color.lower() if finder_color else None, card
+    )
+
+# Configuración del pool de procesos de render (0 = renderizar en el hilo de la petición)
+RENDER_WORKERS = int(os.environ.get('QR_RENDER_WORKERS', '0'))
+RENDER_TIMEOUT = float(os.environ.get('QR_RENDER_TIMEOUT', '10'))
+RENDER_SHM_BYTES = int(os.environ.get('QR_RENDER_SHM_BYTES', str(4 * 1024 * 1024)))
+
+class RenderTimeoutError(Exception):
+    """El render no terminó dentro del tiempo máximo permitido"""
+
+# Segmentos de memoria compartida abiertos dentro de un proceso worker
+_segmentos_worker = {}
+
+def _inicializar_worker_render():
+    """Precarga los logos de todas las marcas al arrancar cada proceso worker"""
+    for tipo in ["YouTube", "Spotify", "Instagram", "TikTok", "Web"]:
+        try:
+            for qr_size in LOGO_SIZE_MAP:
+                cargar_logo(obtener_logo(tipo), qr_size)
+        except Exception as e:
+            log.warning("No se pudo precargar el logo de %s", tipo, extra={'error': str(e), 'limitar': tipo})
+
+def _calentar_worker():
+    """Tarea vacía para forzar el arranque de un worker"""
+    return os.getpid()
+
+def _render_en_worker(nombre_segmento, args):
+    """Renderiza en el worker y escribe el PNG en el segmento compartido"""
+    contenido = renderizar_qr(*args)
+
+    shm = _segmentos_worker.get(nombre_segmento)
+    if shm is None:
+        # El proceso principal es el dueño del segmento y quien lo libera
+        shm = shared_memory.SharedMemory(name=nombre_segmento)
+        _segmentos_worker[nombre_segmento] = shm
+
+    # Si no cabe en el segmento se devuelve por pickle como último recurso
+    if len(contenido) > shm.size:
+        return len(contenido), contenido
+
+    shm.buf[:len(contenido)] = contenido
+    return len(contenido), None
+
+class RenderPool:
+    """Pool de procesos pre-calentados que renderizan QRs fuera del GIL
+
+    Cada petición toma prestado un segmento de memoria compartida donde el
+    worker deja el PNG, así los bytes no pasan por pickle. Si un worker se
+    cae el pool se reconstruye; si tarda más de `timeout` se matan los
+    procesos y se lanza RenderTimeoutError.
+    """
+
+    def __init__(self, workers, timeout=RENDER_TIMEOUT, shm_bytes=RENDER_SHM_BYTES):
+        self.workers = workers
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self._segmentos = []
+        self._libres = queue.Queue()
+
+        # Dos segmentos por worker para que haya uno listo mientras otro se copia
+        for _ in range(workers * 2):
+            shm = shared_memory.SharedMemory(create=True, size=shm_bytes)
+            self._segmentos.append(shm)
+            self._libres.put(shm)
+
+    def _obtener_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_inicializar_worker_render
+                )
+                # Arrancar todos los procesos ahora y no en la primera petición
+                for _ in range(self.workers):
+                    self._executor.submit(_calentar_worker)
+            return self._executor
+
+    def _reiniciar(self, executor):
+        """Descarta un executor roto o colgado; el siguiente render crea otro"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+
+        # ProcessPoolExecutor no permite matar workers colgados de forma pública
+        procesos = list(getattr(executor, '_processes', {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for proceso in procesos:
+            proceso.terminate()
+
+    def calentar(self):
+        """Arranca los workers por adelantado"""
+        self._obtener_executor()
+
+    def render(self, *args):
+        """Renderiza en un worker y devuelve los bytes PNG"""
+        try:
+            shm = self._libres.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RenderTimeoutError("No hay segmentos libres en el pool de render")
+
+        try:
+            executor = self._obtener_executor()
+            try:
+                futuro = executor.submit(_render_en_worker, shm.name, args)
+                longitud, contenido = futuro.result(timeout=self.timeout)
+            except FuturesTimeoutError:
+                self._reiniciar(executor)
+                raise RenderTimeoutError(f"El render superó {self.timeout}s")
+            except BrokenProcessPool:
+                self._reiniciar(executor)
+                raise
+
+            if contenido is None:
+                contenido = bytes(shm.buf[:longitud])
+            return contenido
+        finally:
+            self._libres.put(shm)
+
+    def cerrar(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for shm in self._segmentos:
+            shm.close()
+            shm.unlink()
+        self._segmentos = []
+
+# Pool global, creado la primera vez que se necesita
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def obtener_pool_render():
+    """Devuelve el pool de render o None si está deshabilitado"""
+    global _render_pool
+    if RENDER_WORKERS <= 0:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = RenderPool(RENDER_WORKERS)
+            _render_pool.calentar()
+            atexit.register(_render_pool.cerrar)
+        return _render_pool
+
+def render_qr(data, logo_url=None, bg_color="#ffffff", qr_color="#000000", qr_style="square", qr_size="medium", include_logo=True, formato="png", gradient=None, finder_color=None, card=None):
+    """Devuelve el QR codificado, desde la caché o renderizándolo en el pool si está habilitado"""
+    clave = clave_render(data, logo_url, bg_color, qr_color, qr_style, qr_size, include_logo, formato, gradient, finder_color, card)
+    args = (data, logo_url, bg_color, qr_color, qr_style, qr_size, include_logo, formato, gradient, finder_color, card)
+    if calentador is not None:
+        calentador.registrar(clave, args)
+    contenido = almacen.leer_render(clave)
+    if contenido is not None:
+        return contenido
+
+    contenido = None
+    pool = obtener_pool_render()
+    if pool is not None:
+        try:
+            contenido = pool.render(*args)
+        except BrokenProcessPool as e:
+            # Un worker murió: el pool ya se reconstruyó, renderizar aquí esta vez
+            log.error("Worker de render caído, renderizando en el hilo", extra={'error': str(e)})
+    if contenido is None:
+        contenido = renderizar_qr(*args)
+
+    almacen.guardar_render(clave, contenido)
+    return contenido
+
+def respuesta_admision(data, opciones, render_args):
+    """Aplica la política de admisión a un render interactivo
+
+    Devuelve (respuesta, opciones): una respuesta 413/202 si el render no se hace
+    ahora, o None y las opciones (quizá degradadas) con las que renderizar.
+    """
+    decision, estimacion, nuevas = admitir_render(data, **opciones)
+    if decision in ('ok', 'degradar'):
+        if decision == 'degradar':
+            log.info("Render degradado por coste", extra={'estimacion': estimacion, 'opciones': nuevas})
+        return None, nuevas
+    if decision == 'asincrono':
+        cola = obtener_cola_trabajos()
+        if cola is not None:
+            job_id = cola.encolar(get_user_id(), 'render', dict(render_args, **nuevas), 1)
+            return (jsonify(dict(_trabajo_publico(cola.obtener(job_id)), estimacion=estimacion)), 202), nuevas
+    if estimacion is None:
+        return (jsonify({'error': 'El contenido es demasiado largo para un código QR'}), 413), nuevas
+    return (jsonify({
+        'error': 'El QR pedido es demasiado costoso de generar',
+        'estimacion': estimacion, 'max_ms': ADMISSION_MAX_MS, 'max_mb': ADMISSION_MAX_MB
+    }), 413), nuevas
+
+def render_qr_interactivo(data, logo_url=None, bg_color="#ffffff", qr_color="#000000", qr_style="square", qr_size="medium", include_logo=True, formato="png", gradient=None, finder_color=None, card=None):
+    """render_qr con plazo para el logo; devuelve (contenido, degradado)
+
+    Si el logo no está listo en LOGO_DEADLINE se devuelve el render sin logo,
+    que se cachea con su propia clave y no ocupa la del render completo.
+    """
+    if include_logo and logo_url and not logo_listo(logo_url):
+        estadisticas_logo['degradados'] += 1
+        return render_qr(data, None, bg_color, qr_color, qr_style, qr_size, False, formato, gradient, finder_color, card), True
+    return render_qr(data, logo_url, bg_color, qr_color, qr_style, qr_size, include_logo, formato, gradient, finder_color, card), False
+
+# Precalentado por popularidad: un count-min sketch cuenta las claves de render
+# pedidas y, cuando no hay tráfico, se renderizan las más populares (y sus
+# variantes de tamaño/estilo/formato más usadas) con un presupuesto de CPU.
+WARM_TOP_K = int(os.environ.get('QR_WARM_TOP_K', '0'))
+WARM_VARIANTS = int(os.environ.get('QR_WARM_VARIANTS', '3'))
+WARM_CPU_BUDGET = float(os.environ.get('QR_WARM_CPU_BUDGET', '0.1'))
+WARM_IDLE_SECONDS = float(os.environ.get('QR_WARM_IDLE_SECONDS', '2'))
+WARM_DECAY_SECONDS = float(os.environ.get('QR_WARM_DECAY_SECONDS', '3600'))
+WARM_SKETCH_WIDTH = 4096
+WARM_SKETCH_DEPTH = 4
+
+class SketchConteo:
+    """Count-min sketch: sobreestima la frecuencia de una clave, nunca la subestima"""
+
+    def __init__(self, ancho=WARM_SKETCH_WIDTH, profundidad=WARM_SKETCH_DEPTH):
+        self.ancho = ancho
+        self.tabla = np.zeros((profundidad, ancho), dtype=np.uint32)
+        self._filas = np.arange(profundidad)
+
+    def _columnas(self, clave):
+        # Doble hashing: las d funciones salen de dos mitades de un mismo digest
+        h = int.from_bytes(hashlib.blake2b(clave.encode(), digest_size=8).digest(), 'little')
+        return ((h & 0xFFFFFFFF) + self._filas * ((h >> 32) | 1)) % self.ancho
+
+    def sumar(self, clave):
+        """Cuenta una aparición y devuelve la estimación nueva"""
+        columnas = self._columnas(clave)
+        self.tabla[self._filas, columnas] += 1
+        return int(self.tabla[self._filas, columnas].min())
+
+    def estimar(self, clave):
+        return int(self.tabla[self._filas, self._columnas(clave)].min())
+
+    def decaer(self):
+        """Divide todos los contadores entre dos para que pese más el tráfico reciente"""
+        self.tabla >>= 1
+
+class CalentadorRenders:
+    """Sigue la popularidad de los renders y precalienta el top-K en los ratos sin tráfico"""
+
+    def __init__(self, top_k=WARM_TOP_K):
+        self.top_k = top_k
+        self.sketch = SketchConteo()
+        self.top = {}        # clave canónica -> [estimación, args de render_qr]
+        self.variantes = collections.Counter()
+        # Entrada menos popular del top y su estimación, válidas con el top lleno
+        self._menor = None
+        self._umbral = 0
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self._hilo = None
+        self.en_curso = 0
+        self.ultima_peticion = 0.0
+        self.renderizados = 0
+        self.segundos_cpu = 0.0
+
+    def registrar(self, clave, args):
+        """Cuenta un render pedido por tráfico real (clave canónica y args en el orden de render_qr)"""
+        clave = json.dumps(clave)
+        variante = (args[4], args[5], args[7])
+        with self._lock:
+            estimacion = self.sketch.sumar(clave)
+            if variante[0] in ("square", *MODULE_SHAPES) and variante[1] in QR_SIZE_MAP:
+                self.variantes[variante] += 1
+            if clave in self.top:
+                self.top[clave][0] = estimacion
+                # Las estimaciones solo crecen: el mínimo cambia solo si sube el menor
+                if clave == self._menor:
+                    self._recalcular_umbral()
+            elif len(self.top) < self.top_k:
+                self.top[clave] = [estimacion, args]
+                if len(self.top) == self.top_k:
+                    self._recalcular_umbral()
+            elif estimacion > self._umbral:
+                # Sustituir al menos popular del top actual
+                del self.top[self._menor]
+                self.top[clave] = [estimacion, args]
+                self._recalcular_umbral()
+
+    def _recalcular_umbral(self):
+        self._menor = min(self.top, key=lambda c: self.top[c][0])
+        self._umbral = self.top[self._menor][0]
+
+    def candidatos(self):
+        """Args a precalentar: el top-K por popularidad y cada uno en las variantes más usadas"""
+        with self._lock:
+            top = sorted(self.top.values(), key=lambda t: t[0], reverse=True)
+            variantes = [v for v, _ in self.variantes.most_common(WARM_VARIANTS)]
+        vistos = set()
+        for _, args in top:
+            for estilo, tamano, formato in [(args[4], args[5], args[7])] + variantes:
+                if args[10] and formato == 'svg':
+                    continue
+                candidato = args[:4] + (estilo, tamano) + args[6:7] + (formato,) + args[8:]
+                if candidato not in vistos:
+                    vistos.add(candidato)
+                    yield candidato
+
+    def entrar(self):
+        with self._lock:
+            self.en_curso += 1
+            self.ultima_peticion = time.monotonic()
+
+    def salir(self):
+        with self._lock:
+            self.en_curso -= 1
+            self.ultima_peticion = time.monotonic()
+
+    def inactivo(self):
+        return self.en_curso == 0 and time.monotonic() - self.ultima_peticion >= WARM_IDLE_SECONDS
+
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._bucle, name="calentador-renders", daemon=True)
+            self._hilo.start()
+
+    def parar(self):
+        self._parar.set()
+
+    def _bucle(self):
+        siguiente_decaimiento = time.monotonic() + WARM_DECAY_SECONDS
+        while not self._parar.wait(WARM_IDLE_SECONDS):
+            if time.monotonic() >= siguiente_decaimiento:
+                with self._lock:
+                    self.sketch.decaer()
+                    for entrada in self.top.values():
+                        entrada[0] >>= 1
+                    self._umbral >>= 1
+                siguiente_decaimiento += WARM_DECAY_SECONDS
+            if self.inactivo():
+                try:
+                    self.calentar()
+                except Exception as e:
+                    log.exception("Error en el precalentado")
+
+    def calentar(self):
+        """Renderiza los candidatos que falten mientras no llegue tráfico"""
+        candidatos = list(self.candidatos())
+        presentes = almacen.leer_renders([clave_render(*args) for args in candidatos])
+        for args, presente in zip(candidatos, presentes):
+            if presente is not None:
+                continue
+            if not self.inactivo() or self._parar.is_set():
+                return
+            inicio = time.thread_time()
+            almacen.guardar_render(clave_render(*args), renderizar_qr(*args))
+            coste = time.thread_time() - inicio
+            self.renderizados += 1
+            self.segundos_cpu += coste
+            # Presupuesto de CPU: por cada segundo renderizando, dormir (1/presupuesto - 1)
+            if self._parar.wait(coste * (1 / WARM_CPU_BUDGET - 1)):
+                return
+
+    def resumen(self):
+        return {
+            'top_k': len(self.top),
+            'variantes': [list(v) for v, _ in self.variantes.most_common(WARM_VARIANTS)],
+            'renderizados': self.renderizados,
+            'segundos_cpu': round(self.segundos_cpu, 3),
+            'sketch_bytes': self.sketch.tabla.nbytes
+        }
+
+calentador = CalentadorRenders() if WARM_TOP_K > 0 else None
+
+@app.before_request
+def marcar_peticion():
+    """Cuenta peticiones en curso para que el calentador solo trabaje sin tráfico"""
+    if calentador is not None:
+        calentador.iniciar()
+        calentador.entrar()
+        g.peticion_contada = True
+
+@app.teardown_request
+def terminar_peticion(exc=None):
+    if calentador is not None and g.pop('peticion_contada', False):
+        calentador.salir()
+
+# Render en el cliente: solo la matriz empaquetada a bits, el navegador la pinta en un canvas
+def matriz_cliente(data, logo_url=None, qr_size="medium"):
+    """JSON con la matriz del QR (1 bit por módulo, filas de arriba abajo) y la colocación del logo"""
+    clave = ("matrix", data, logo_url, qr_size)
+    contenido = almacen.leer_render(clave)
+    if contenido is not None:
+        return contenido
+
+    size_config = QR_SIZE_MAP.get(qr_size, QR_SIZE_MAP["medium"])
+    qr = qrcode.QRCode(version=size_config["version"], border=size_config["border"])
+    agregar_datos(qr, data)
+    compilar_qr(qr)
+    matriz = np.array(qr.get_matrix(), dtype=bool)
+    lado = matriz.shape[0]
+    tamano_px = lado * size_config["box_size"]
+
+    logo = None
+    if logo_url:
+        if logo_url.startswith(PREFIJO_LOGO_SUBIDO):
+            url = f"/logos/{logo_url[len(PREFIJO_LOGO_SUBIDO):]}"
+        else:
+            url = logo_url
+        # Mismo criterio que generar_qr_personalizado: ancho fijo, alto proporcional, centrado
+        logo = {'url': url, 'width': LOGO_SIZE_MAP.get(qr_size, 60), 'center': [tamano_px // 2, tamano_px // 2]}
+
+    contenido = json.dumps({
+        'version': qr.version,
+        'modules': lado,
+        'border': size_config["border"],
+        'box_size': size_config["box_size"],
+        'size_px': tamano_px,
+        'matrix': base64.b64encode(np.packbits(matriz).tobytes()).decode('ascii'),
+        'logo': logo
+    }, separators=(',', ':')).encode()
+    almacen.guardar_render(clave, contenido)
+    return contenido
+
+# Vista previa mientras se escribe: módulos pequeños, sin caché de renders (cada
+# pulsación es una clave distinta) y logo solo si ya está en memoria
+PREVIEW_BOX_SIZE = 4
+
+def generar_preview(data, bg_color="#ffffff", qr_color="#000000", qr_style="square", qr_size="medium", logo_url=None, gradient=None, finder_color=None):
+    """PNG de baja resolución para la vista previa en vivo"""
+    size_config = QR_SIZE_MAP.get(qr_size, QR_SIZE_MAP["medium"])
+    qr = qrcode.QRCode(version=size_config["version"], border=size_config["border"])
+    agregar_datos(qr, data)
+    compilar_qr(qr)
+    img = rasterizar_modulos(
+        qr.get_matrix(), PREVIEW_BOX_SIZE, MODULE_SHAPES.get(qr_style, "square"),
+        hex_to_rgb(qr_color), hex_to_rgb(bg_color), size_config["border"],
+        gradient, hex_to_rgb(finder_color) if finder_color else None
+    )
+
+    if logo_url:
+        if logo_url in logo_originales or (logo_url, qr_size) in logo_sprites or logo_url.startswith(PREFIJO_LOGO_SUBIDO):
+            logo = cargar_logo(logo_url, qr_size)
+            if logo is not None:
+                escala = PREVIEW_BOX_SIZE / size_config["box_size"]
+                logo = logo.resize((max(1, round(logo.size[0] * escala)), max(1, round(logo.size[1] * escala))), Image.BILINEAR)
+                img.paste(logo, ((img.size[0] - logo.size[0]) // 2, (img.size[1] - logo.size[1]) // 2), mask=logo)
+        else:
+            # Adelantar la descarga para que el render final no tenga que esperarla
+            logo_listo(logo_url, plazo=0)
+    return codificar_imagen(img, "png")
+
+# Anexo estructurado: cargas cerca del límite repartidas en hasta 16 símbolos
+# de versión moderada, que los lectores reensamblan en orden
+APPEND_MAX_SYMBOLS = 16  # la posición ocupa 4 bits en la cabecera
+# Objetivo de lectura fiable con la cámara de un móvil: ningún símbolo por encima de esta versión.
+# También es el tope de max_version en /qr_append, junto con el de caracteres por petición.
+APPEND_MAX_VERSION = int(os.environ.get('QR_APPEND_MAX_VERSION', '20'))
+APPEND_MAX_CHARS = int(os.environ.get('QR_APPEND_MAX_CHARS', '8192'))
+APPEND_LAYOUTS = ("tiled", "set")
+_anexo_executor = ThreadPoolExecutor(
+    max_workers=min(APPEND_MAX_SYMBOLS, os.cpu_count() or 1), thread_name_prefix="anexo"
+)
+
+def _costes_minimos(data):
+    """Suma acumulada (con 0 inicial) del coste en sextos de bit de cada carácter en su modo más barato
+
+    Es una cota inferior de los bits de cualquier trozo: sin cabeceras de segmento.
+    """
+    return np.concatenate([[0], np.cumsum([
+        min(coste for coste in (_coste_caracter(modo, caracter) for modo in SEGMENT_MODES) if coste is not None)
+        for caracter in data
+    ])])
+
+def _cortes_equilibrados(costes, partes):
+    """Posiciones que parten el texto en trozos de coste codificado parecido, o None"""
+    cortes = np.searchsorted(costes, costes[-1] * np.arange(1, partes) / partes, side='right')
+    cortes = [0, *cortes.tolist(), len(costes) - 1]
+    # Con muy pocos caracteres dos cortes pueden coincidir: esa partición no vale
+    if any(fin <= inicio for inicio, fin in zip(cortes, cortes[1:])):
+        return None
+    return cortes
+
+def _version_simbolo(texto, error_correction, max_version, extra_bits, desde=1):
+    """(versión, segmentos) mínimos para el trozo con extra_bits de cabecera, o None"""
+    for primera, ultima in SEGMENT_VERSION_GROUPS:
+        if primera > max_version:
+            break
+        if ultima < desde:
+            continue
+        segmentos, bits = segmentar_optimo(texto, primera)
+        for version in range(max(primera, desde), min(ultima, max_version) + 1):
+            if bits + extra_bits <= qrutil.BIT_LIMIT_TABLE[error_correction][version]:
+                return version, segmentos
+    return None
+
+def plan_anexo(data, max_version=APPEND_MAX_VERSION, error_correction=qrcode.constants.ERROR_CORRECT_M):
+    """Reparto de data en símbolos con el mínimo de módulos totales
+
+    Prueba de 1 a 16 símbolos con trozos equilibrados por coste y se queda
+    con el que suma menos módulos entre los que dejan todos los símbolos en
+    versión <= max_version. Devuelve [(versión, texto, segmentos), ...] o
+    None si ni con 16 símbolos se cumple.
+    """
+    limites = qrutil.BIT_LIMIT_TABLE[error_correction]
+    # Ningún carácter cuesta menos de 20/6 bits (numérico): descartar sin recorrer data
+    if len(data) * 20 > APPEND_MAX_SYMBOLS * limites[max_version] * 6:
+        return None
+    costes = _costes_minimos(data)
+    mejor, mejor_modulos = None, math.inf
+    for partes in range(1, min(APPEND_MAX_SYMBOLS, len(data)) + 1):
+        cortes = _cortes_equilibrados(costes, partes)
+        if cortes is None:
+            continue
+        extra = APPEND_HEADER_BITS if partes > 1 else 0
+        # Cota inferior de la versión de cada trozo: descarta sin segmentar
+        # los repartos que no caben o que no pueden mejorar al mejor
+        minimas = [
+            bisect.bisect_left(limites, -(-int(costes[fin] - costes[inicio]) // 6) + extra, 1)
+            for inicio, fin in zip(cortes, cortes[1:])
+        ]
+        if max(minimas) > max_version or sum((4 * v + 17) ** 2 for v in minimas) >= mejor_modulos:
+            continue
+        simbolos = []
+        for (inicio, fin), minima in zip(zip(cortes, cortes[1:]), minimas):
+            resultado = _version_simbolo(data[inicio:fin], error_correction, max_version, extra, minima)
+            if resultado is None:
+                break
+            simbolos.append((resultado[0], data[inicio:fin], resultado[1]))
+        else:
+            modulos = sum((4 * version + 17) ** 2 for version, _, _ in simbolos)
+            if modulos < mejor_modulos:
+                mejor, mejor_modulos = simbolos, modulos
+    return mejor
+
+def matriz_simbolo_anexo(version, segmentos, anexo, border):
+    """Matriz de un símbolo del plan, con su cabecera si hay más de uno"""
+    qr = qrcode.QRCode(version=version, border=border)
+    for modo, texto in segmentos:
+        qr.add_data(qrutil.QRData(texto.encode('utf-8'), mode=modo, check_data=False))
+    compilar_qr(qr, anexo)
+    return qr.get_matrix()
+
+def generar_anexo(data, bg_color="#ffffff", qr_color="#000000", qr_style="square", qr_size="medium",
+                  formato="png", layout="tiled", max_version=APPEND_MAX_VERSION):
+    """Devuelve (contenido, versiones): un mosaico en `formato` o un ZIP con una imagen por símbolo, ambos en `formato`"""
+    plan = plan_anexo(data, max_version)
+    if plan is None:
+        raise qrcode.exceptions.DataOverflowError(
+            f"No cabe en {APPEND_MAX_SYMBOLS} símbolos de versión {max_version} o menor"
+        )
+    total = len(plan)
+    # La paridad es el XOR de todos los bytes del mensaje completo
+    paridad = int(np.bitwise_xor.reduce(np.frombuffer(data.encode('utf-8'), dtype=np.uint8)))
+    size_config = QR_SIZE_MAP.get(qr_size, QR_SIZE_MAP["medium"])
+    forma = MODULE_SHAPES.get(qr_style, "square")
+    qr_rgb, bg_rgb = hex_to_rgb(qr_color), hex_to_rgb(bg_color)
+
+    def simbolo(posicion):
+        version, _, segmentos = plan[posicion]
+        matriz = matriz_simbolo_anexo(version, segmentos, (posicion, total, paridad) if total > 1 else None, size_config["border"])
+        return rasterizar_modulos(matriz, size_config["box_size"], forma, qr_rgb, bg_rgb, size_config["border"])
+
+    # Codificación y rasterizado de cada símbolo en paralelo (NumPy suelta el GIL)
+    imagenes = list(_anexo_executor.map(simbolo, range(total)))
+    versiones = [version for version, _, _ in plan]
+
+    if layout == "set":
+        salida = io.BytesIO()
+        with zipfile.ZipFile(salida, 'w', zipfile.ZIP_STORED) as archivo:
+            for posicion, img in enumerate(imagenes):
+                archivo.writestr(f"simbolo_{posicion + 1:02d}_de_{total:02d}.{formato}", codificar_imagen(img, formato))
+        return salida.getvalue(), versiones
+
+    # Mosaico en orden de lectura; cada símbolo ya trae su zona de silencio
+    columnas = math.ceil(math.sqrt(total))
+    filas = math.ceil(total / columnas)
+    celda = max(img.size[0] for img in imagenes)
+    mosaico = Image.new("RGB", (columnas * celda, filas * celda), bg_rgb)
+    for posicion, img in enumerate(imagenes):
+        fila, columna = divmod(posicion, columnas)
+        desplazamiento = (celda - img.size[0]) // 2
+        mosaico.paste(img, (columna * celda + desplazamiento, fila * celda + desplazamiento))
+    return codificar_imagen(mosaico, formato), versiones
+
+# Exportación para impresión: franjas horizontales directas a un codificador en streaming
+PRINT_MAX_PX = 20000
+PRINT_STRIP_BYTES = 4 * 1024 * 1024
+# Pool de franjas compartido por todas las exportaciones y cuántas pueden usarlo a la vez
+PRINT_WORKERS = int(os.environ.get('QR_PRINT_WORKERS', str(min(4, os.cpu_count() or 1))))
+PRINT_CONCURRENCY = int(os.environ.get('QR_PRINT_CONCURRENCY', '2'))
+
+def _png_chunk(tipo, datos):
+    """Serializa un chunk PNG con su longitud y CRC"""
+    return struct.pack('>I', len(datos)) + tipo + datos + struct.pack('>I', zlib.crc32(tipo + datos))
+
+def _adler32_combine(adler1, adler2, len2):
+    """Combina dos Adler-32 como zlib's adler32_combine (no expuesto en Python)"""
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    return sum1 | (sum2 << 16)
+
+def preparar_impresion(data, ancho_px, qr_color="#000000", bg_color="#ffffff", logo_url=None, formato="png"):
+    """Codifica el QR y arma el contexto que necesita cada franja"""
+    qr = qrcode.QRCode(border=4)
+    agregar_datos(qr, data)
+    compilar_qr(qr)
+    matriz = qr.get_matrix()
+    n = len(matriz)
+
+    # Matriz de módulos en modo paleta (0 = fondo, 1 = módulo); se escala por franja
+    ctx = {
+        'formato': formato,
+        'ancho': ancho_px,
+        'n': n,
+        'modulos': bytes(1 if celda else 0 for fila in matriz for celda in fila),
+        'paleta': list(hex_to_rgb(bg_color)) + list(hex_to_rgb(qr_color)),
+        'logo': None,
+    }
+
+    if logo_url:
+        try:
+            logo = cargar_logo_original(logo_url)
+        except Exception as e:
+            log.warning("Error al cargar logo para impresión desde %s", logo_url, extra={'error': str(e), 'limitar': logo_url})
+            logo = None
+        if logo is not None:
+            # Misma proporción logo/QR que el render en pantalla (60 px con box_size 10)
+            ancho_logo = max(1, round(LOGO_SIZE_MAP["medium"] * ancho_px / (n * 10)))
+            alto_logo = max(1, round(logo.size[1] * ancho_logo / logo.size[0]))
+            ctx['logo'] = (logo.size, logo.tobytes())
+            ctx['logo_caja'] = (
+                (ancho_px - ancho_logo) // 2, (ancho_px - alto_logo) // 2,
+                ancho_logo, alto_logo
+            )
+    return ctx
+
+def render_franja_impresion(ctx, y0, y1, final):
+    """Rasteriza las filas [y0, y1) y las deja listas para el contenedor de salida"""
+    ancho, n = ctx['ancho'], ctx['n']
+    modulos = Image.frombytes('P', (n, n), ctx['modulos'])
+    modulos.putpalette(ctx['paleta'])
+
+    # Escalar solo la región de la matriz que cubre esta franja
+    escala = n / ancho
+    franja = modulos.resize((ancho, y1 - y0), Image.NEAREST, box=(0, y0 * escala, n, y1 * escala))
+    franja = franja.convert('RGB')
+
+    if ctx['logo'] is not None:
+        lx, ly, lw, lh = ctx['logo_caja']
+        top, bottom = max(y0, ly), min(y1, ly + lh)
+        if top < bottom:
+            tamano, pixeles = ctx['logo']
+            logo = Image.frombytes('RGBA', tamano, pixeles)
+            escala_logo = tamano[1] / lh
+            trozo = logo.resize((lw, bottom - top), Image.LANCZOS,
+                                box=(0, (top - ly) * escala_logo, tamano[0], (bottom - ly) * escala_logo))
+            franja.paste(trozo, (lx, top - y0), mask=trozo)
+
+    crudo = franja.tobytes()
+    if ctx['formato'] == 'tiff':
+        return crudo
+
+    # PNG: byte de filtro 0 por fila y deflate independiente, concatenable con las demás franjas
+    stride = ancho * 3
+    filtrado = b''.join(b'\x00' + crudo[i:i + stride] for i in range(0, len(crudo), stride))
+    compresor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    comprimido = compresor.compress(filtrado)
+    comprimido += compresor.flush(zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH)
+    return comprimido, zlib.adler32(filtrado), len(filtrado)
+
+# Contextos de exportación ya deserializados dentro de cada worker, por exportación
+_ctx_impresion = collections.OrderedDict()
+
+def _render_franja_en_worker(clave, ctx_serializado, y0, y1, final):
+    ctx = _ctx_impresion.get(clave)
+    if ctx is None:
+        ctx = _ctx_impresion[clave] = pickle.loads(ctx_serializado)
+        while len(_ctx_impresion) > PRINT_CONCURRENCY:
+            _ctx_impresion.popitem(last=False)
+    return render_franja_impresion(ctx, y0, y1, final)
+
+# Pool global de franjas: se crea una vez y se reconstruye si se rompe
+_pool_impresion = None
+_pool_impresion_lock = threading.Lock()
+_exportaciones_en_pool = threading.BoundedSemaphore(max(1, PRINT_CONCURRENCY))
+_claves_impresion = itertools.count()
+
+def obtener_pool_impresion():
+    """Devuelve el pool de procesos de franjas o None si está deshabilitado"""
+    global _pool_impresion
+    if PRINT_WORKERS <= 1:
+        return None
+    with _pool_impresion_lock:
+        if _pool_impresion is None:
+            _pool_impresion = ProcessPoolExecutor(
+                max_workers=PRINT_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            atexit.register(_pool_impresion.shutdown, wait=False, cancel_futures=True)
+        return _pool_impresion
+
+def _descartar_pool_impresion(executor):
+    global _pool_impresion
+    with _pool_impresion_lock:
+        if _pool_impresion is executor:
+            _pool_impresion = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def _cabecera_tiff(ancho, dpi, franjas):
+    """Cabecera TIFF sin compresión; los tamaños se conocen antes de renderizar"""
+    entradas = 12
+    inicio_extra = 8 + 2 + entradas * 12 + 4
+    off_bps = inicio_extra
+    off_xres = off_bps + 6
+    off_yres = off_xres + 8
+    off_offsets = off_yres + 8
+    off_counts = off_offsets + 4 * len(franjas)
+    inicio_datos = off_counts + 4 * len(franjas)
+
+    conteos = [(y1 - y0) * ancho * 3 for y0, y1 in franjas]
+    offsets = []
+    posicion = inicio_datos
+    for conteo in conteos:
+        offsets.append(posicion)
+        posicion += conteo
+
+    def entrada(tag, tipo, cuenta, valor):
+        return struct.pack('<HHII', tag, tipo, cuenta, valor)
+
+    # Con una sola franja el valor va directamente en la entrada del IFD
+    if len(franjas) == 1:
+        valor_offsets, valor_counts = offsets[0], conteos[0]
+    else:
+        valor_offsets, valor_counts = off_offsets, off_counts
+
+    ifd = struct.pack('<H', entradas) + b''.join([
+        entrada(256, 4, 1, ancho),
+        entrada(257, 4, 1, ancho),
+        entrada(258, 3, 3, off_bps),
+        entrada(259, 3, 1, 1),
+        entrada(262, 3, 1, 2),
+        entrada(273, 4, len(franjas), valor_offsets),
+        entrada(277, 3, 1, 3),
+        entrada(278, 4, 1, franjas[0][1] - franjas[0][0]),
+        entrada(279, 4, len(franjas), valor_counts),
+        entrada(282, 5, 1, off_xres),
+        entrada(283, 5, 1, off_yres),
+        entrada(296, 3, 1, 2),
+    ]) + struct.pack('<I', 0)
+
+    extra = struct.pack('<HHH', 8, 8, 8) + struct.pack('<II', dpi, 1) * 2
+    extra += struct.pack(f'<{len(offsets)}I', *offsets) + struct.pack(f'<{len(conteos)}I', *conteos)
+    return b'II*\x00' + struct.pack('<I', 8) + ifd + extra
+
+def validar_impresion(ancho_cm, dpi, formato):
+    """Comprueba los parámetros de impresión y devuelve el lado en píxeles"""
+    if not (math.isfinite(ancho_cm) and math.isfinite(dpi)):
+        raise ValueError("ancho_cm y dpi deben ser números finitos")
+    ancho = round(ancho_cm / 2.54 * dpi)
+    if ancho < 1 or ancho > PRINT_MAX_PX:
+        raise ValueError(f"El tamaño de impresión debe estar entre 1 y {PRINT_MAX_PX} px por lado")
+    if formato not in ("png", "tiff"):
+        raise ValueError(f"Formato de impresión no soportado: {formato}")
+    return ancho
+
+def exportar_impresion(data, ancho_cm, dpi, formato="png", qr_color="#000000", bg_color="#ffffff", logo_url=None, workers=None):
+    """Genera el QR a tamaño físico y DPI dados, produciendo el archivo por trozos
+
+    La memoria máxima ronda una franja por worker más las franjas en vuelo,
+    sin importar el tamaño final de la imagen. Las franjas se rasterizan en
+    el pool compartido; como mucho QR_PRINT_CONCURRENCY exportaciones lo
+    usan a la vez y las demás esperan turno. workers=1 fuerza el hilo actual.
+    """
+    ancho = validar_impresion(ancho_cm, dpi, formato)
+    ctx = preparar_impresion(data, ancho, qr_color, bg_color, logo_url, formato)
+    filas = max(1, PRINT_STRIP_BYTES // (ancho * 3))
+    franjas = [(y, min(y + filas, ancho)) for y in range(0, ancho, filas)]
+
+    if formato == "png":
+        yield b'\x89PNG\r\n\x1a\n'
+        yield _png_chunk(b'IHDR', struct.pack('>IIBBBBB', ancho, ancho, 8, 2, 0, 0, 0))
+        ppm = round(dpi / 0.0254)
+        yield _png_chunk(b'pHYs', struct.pack('>IIB', ppm, ppm, 1))
+        # Cabecera zlib; luego van los bloques deflate de cada franja
+        yield _png_chunk(b'IDAT', b'\x78\x9c')
+    else:
+        yield _cabecera_tiff(ancho, dpi, franjas)
+
+    adler = 1
+
+    def emitir(resultado):
+        nonlocal adler
+        if formato == "tiff":
+            return resultado
+        comprimido, adler_franja, longitud = resultado
+        adler = _adler32_combine(adler, adler_franja, longitud)
+        return _png_chunk(b'IDAT', comprimido)
+
+    executor = obtener_pool_impresion() if workers != 1 and len(franjas) > 1 else None
+    if executor is None:
+        for i, (y0, y1) in enumerate(franjas):
+            yield emitir(render_franja_impresion(ctx, y0, y1, i == len(franjas) - 1))
+    else:
+        en_vuelo = (workers or PRINT_WORKERS) * 2
+        clave = next(_claves_impresion)
+        ctx_serializado = pickle.dumps(ctx, protocol=pickle.HIGHEST_PROTOCOL)
+        with _exportaciones_en_pool:
+            # Limitar las franjas en vuelo para que la memoria no crezca con el tamaño
+            pendientes = collections.deque()
+            try:
+                for i, (y0, y1) in enumerate(franjas):
+                    pendientes.append(executor.submit(
+                        _render_franja_en_worker, clave, ctx_serializado, y0, y1, i == len(franjas) - 1
+                    ))
+                    if len(pendientes) >= en_vuelo:
+                        yield emitir(pendientes.popleft().result())
+                while pendientes:
+                    yield emitir(pendientes.popleft().result())
+            except BrokenProcessPool:
+                _descartar_pool_impresion(executor)
+                raise
+            finally:
+                # Si el cliente corta la descarga no dejar franjas ocupando el pool
+                for futuro in pendientes:
+                    futuro.cancel()
+
+    if formato == "png":
+        yield _png_chunk(b'IDAT', struct.pack('>I', adler))
+        yield _png_chunk(b'IEND', b'')
+
+# Hojas de etiquetas en PDF: QR vectoriales, logos compartidos como XObject
+MM_A_PT = 72 / 25.4
+PAGE_SIZES = {
+    "A4": (595.28, 841.89),
+    "Letter": (612.0, 792.0)
+}
+LABEL_TEMPLATE_DEFAULT = {
+    "page": "A4",
+    "rows": 8,
+    "columns": 3,
+    "margin_top": 10,
+    "margin_bottom": 10,
+    "margin_left": 8,
+    "margin_right": 8,
+    "gap": 2,
+    "padding": 2
+}
+LABEL_MAX_PAYLOADS = 10000
+
+def _color_pdf(hex_color):
+    return " ".join(f"{c / 255:.4f}" for c in hex_to_rgb(hex_color))
+
+def _qr_vectorial(data, x, y, lado):
+    """Operadores PDF que dibujan el QR en (x, y) con el lado dado, en puntos"""
+    qr = qrcode.QRCode(border=4)
+    agregar_datos(qr, data)
+    compilar_qr(qr)
+    matriz = qr.get_matrix()
+    n = len(matriz)
+
+    # Un rectángulo por racha horizontal de módulos oscuros, en unidades de módulo
+    ops = [f"q {lado / n:.5f} 0 0 {lado / n:.5f} {x:.3f} {y:.3f} cm"]
+    for fila, columna, longitud in rachas_oscuras(matriz):
+        ops.append(f"{columna} {n - fila - 1} {longitud} 1 re")
+    ops.append("f Q")
+    return "\n".join(ops), n
+
+def _logo_xobject(logo, num_imagen, num_mascara):
+    """Objetos PDF de imagen (RGB) y su máscara suave (alfa) para un logo"""
+    logo = logo.copy()
+    logo.thumbnail((256, 256), Image.LANCZOS)
+    ancho, alto = logo.size
+    rgb = zlib.compress(logo.convert("RGB").tobytes())
+    alfa = zlib.compress(logo.getchannel("A").tobytes())
+    imagen = (
+        f"<< /Type /XObject /Subtype /Image /Width {ancho} /Height {alto} /ColorSpace /DeviceRGB "
+        f"/BitsPerComponent 8 /SMask {num_mascara} 0 R /Filter /FlateDecode /Length {len(rgb)} >>"
+    ).encode(), rgb
+    mascara = (
+        f"<< /Type /XObject /Subtype /Image /Width {ancho} /Height {alto} /ColorSpace /DeviceGray "
+        f"/BitsPerComponent 8 /Filter /FlateDecode /Length {len(alfa)} >>"
+    ).encode(), alfa
+    return imagen, mascara
+
+def generar_hoja_etiquetas(payloads, plantilla=None, qr_color="#000000", bg_color="#ffffff", include_logo=True, logo_url=None):
+    """Genera un PDF de etiquetas página a página a partir de un iterable de contenidos
+
+    Solo se mantiene en memoria la página actual; cada logo distinto se
+    escribe una vez y todas las páginas lo referencian. Con `logo_url` todas
+    las etiquetas llevan ese logo en lugar del de la marca detectada.
+    """
+    logo_fijo = logo_url
+    plantilla = {**LABEL_TEMPLATE_DEFAULT, **(plantilla or {})}
+    if plantilla["page"] not in PAGE_SIZES:
+        raise ValueError(f"Tamaño de página no soportado: {plantilla['page']}")
+    ancho_pag, alto_pag = PAGE_SIZES[plantilla["page"]]
+    filas, columnas = int(plantilla["rows"]), int(plantilla["columns"])
+    if filas < 1 or columnas < 1:
+        raise ValueError("La plantilla necesita al menos una fila y una columna")
+
+    izquierda = plantilla["margin_left"] * MM_A_PT
+    arriba = plantilla["margin_top"] * MM_A_PT
+    hueco = plantilla["gap"] * MM_A_PT
+    relleno = plantilla["padding"] * MM_A_PT
+    ancho_celda = (ancho_pag - izquierda - plantilla["margin_right"] * MM_A_PT - hueco * (columnas - 1)) / columnas
+    alto_celda = (alto_pag - arriba - plantilla["margin_bottom"] * MM_A_PT - hueco * (filas - 1)) / filas
+    lado = min(ancho_celda, alto_celda) - 2 * relleno
+    if lado <= 0:
+        raise ValueError("Las etiquetas no tienen espacio para el QR con esos márgenes")
+
+    color_qr, color_fondo = _color_pdf(qr_color), _color_pdf(bg_color)
+    posicion = 0
+    offsets = {}
+    siguiente = [3]  # 1 = catálogo, 2 = árbol de páginas (se escriben al final)
+    paginas = []
+    logos = {}  # logo_url -> (nombre, número de objeto) o None si no se pudo cargar
+
+    def nuevo_numero():
+        siguiente[0] += 1
+        return siguiente[0] - 1
+
+    def objeto(num, cuerpo, contenido=None):
+        nonlocal posicion
+        offsets[num] = posicion
+        datos = f"{num} 0 obj\n".encode() + cuerpo
+        if contenido is not None:
+            datos += b"\nstream\n" + contenido + b"\nendstream"
+        datos += b"\nendobj\n"
+        posicion += len(datos)
+        return datos
+
+    def emitir(datos):
+        nonlocal posicion
+        posicion += len(datos)
+        return datos
+
+    yield emitir(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    por_pagina = filas * columnas
+    iterador = iter(payloads)
+    while True:
+        lote = list(itertools.islice(iterador, por_pagina))
+        if not lote:
+            break
+
+        ops = []
+        usados = {}
+        for i, data in enumerate(lote):
+            fila, columna = divmod(i, columnas)
+            x = izquierda + columna * (ancho_celda + hueco) + (ancho_celda - lado) / 2
+            y = alto_pag - arriba - fila * (alto_celda + hueco) - alto_celda + (alto_celda - lado) / 2
+
+            ops.append(f"{color_fondo} rg {x:.3f} {y:.3f} {lado:.3f} {lado:.3f} re f")
+            vectorial, n = _qr_vectorial(data, x, y, lado)
+            ops.append(f"{color_qr} rg")
+            ops.append(vectorial)
+
+            if not include_logo:
+                continue
+            logo_url = logo_fijo or obtener_logo(detectar_tipo_enlace(data))
+            if not logo_url:
+                continue
+            if logo_url not in logos:
+                try:
+                    logo = cargar_logo_original(logo_url)
+                except Exception as e:
+                    log.warning("Error al cargar logo para etiquetas desde %s", logo_url, extra={'error': str(e), 'limitar': logo_url})
+                    logo = None
+                if logo is None:
+                    logos[logo_url] = None
+                else:
+                    num_imagen, num_mascara = nuevo_numero(), nuevo_numero()
+                    imagen, mascara = _logo_xobject(logo, num_imagen, num_mascara)
+                    yield objeto(num_mascara, *mascara)
+                    yield objeto(num_imagen, *imagen)
+                    logos[logo_url] = (f"L{len(logos) + 1}", num_imagen, logo.size[1] / logo.size[0])
+            if logos[logo_url] is None:
+                continue
+
+            # Misma proporción logo/QR que el render en pantalla (60 px con box_size 10)
+            nombre, num_imagen, proporcion = logos[logo_url]
+            usados[nombre] = num_imagen
+            ancho_logo = lado * LOGO_SIZE_MAP["medium"] / (n * 10)
+            alto_logo = ancho_logo * proporcion
+            lx = x + (lado - ancho_logo) / 2
+            ly = y + (lado - alto_logo) / 2
+            ops.append(f"q {ancho_logo:.3f} 0 0 {alto_logo:.3f} {lx:.3f} {ly:.3f} cm /{nombre} Do Q")
+
+        contenido = zlib.compress("\n".join(ops).encode())
+        num_contenido, num_pagina = nuevo_numero(), nuevo_numero()
+        yield objeto(num_contenido, f"<< /Length {len(contenido)} /Filter /FlateDecode >>".encode(), contenido)
+
+        xobjects = " ".join(f"/{nombre} {num} 0 R" for nombre, num in usados.items())
+        yield objeto(num_pagina, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {ancho_pag} {alto_pag}] "
+            f"/Contents {num_contenido} 0 R /Resources << /XObject << {xobjects} >> >> >>"
+        ).encode())
+        paginas.append(num_pagina)
+
+    if not paginas:
+        raise ValueError("No hay contenidos para generar etiquetas")
+
+    kids = " ".join(f"{num} 0 R" for num in paginas)
+    yield objeto(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(paginas)} >>".encode())
+    yield objeto(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+    inicio_xref = posicion
+    total = siguiente[0]
+    xref = [f"xref\n0 {total}\n", "0000000000 65535 f \n"]
+    xref += [f"{offsets[num]:010d} 00000 n \n" for num in range(1, total)]
+    xref.append(f"trailer\n<< /Size {total} /Root 1 0 R >>\nstartxref\n{inicio_xref}\n%%EOF\n")
+    yield emitir("".join(xref).encode())
+
+# Generación masiva offline: python main.py lote entrada.csv|.jsonl salida[.zip]
+# Cada fila lleva `data` y opcionalmente nombre, qr_color, bg_color, qr_style,
+# qr_size, include_logo, logo, gradient, finder_color y card.
+BULK_FILA_CAMPOS = ("bg_color", "qr_color", "qr_style", "qr_size", "gradient", "finder_color", "card")
+BULK_EN_VUELO_POR_PROCESO = 4
+
+def leer_filas_lote(ruta):
+    """Itera las filas de un CSV (con cabecera) o JSONL como dicts"""
+    with open(ruta, newline='', encoding='utf-8') as f:
+        if ruta.endswith(('.jsonl', '.ndjson')):
+            for linea in f:
+                if linea.strip():
+                    fila = json.loads(linea)
+                    yield fila if isinstance(fila, dict) else {'data': str(fila)}
+        else:
+            yield from csv.DictReader(f)
+
+def nombre_archivo_lote(indice, fila, formato):
+    nombre = re.sub(r'[^\w.-]', '_', str(fila.get('nombre') or ''))[:100].strip('._')
+    return f"{nombre or f'{indice:06d}'}.{formato}"
+
+def _inicializar_worker_lote():
+    # Ctrl+C llega a todo el grupo de procesos: solo el padre lo atiende y para con orden
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def argumentos_fila_lote(fila, formato):
+    """Argumentos de renderizar_qr/render_qr para una fila de lote"""
+    include_logo = str(fila.get('include_logo', 'true')).lower() not in ('false', '0', 'no', '')
+    argumentos = {campo: fila[campo] for campo in BULK_FILA_CAMPOS if fila.get(campo)}
+    argumentos.update(
+        data=fila['data'], logo_url=resolver_logo(fila['data'], fila.get('logo'), include_logo),
+        include_logo=include_logo, formato=formato
+    )
+    return argumentos
+
+def _render_fila_lote(indice, fila, formato):
+    """Render de una fila en un proceso del lote; devuelve (indice, contenido, ms)"""
+    inicio = time.perf_counter()
+    contenido = renderizar_qr(**argumentos_fila_lote(fila, formato))
+    return indice, contenido, (time.perf_counter() - inicio) * 1000
+
+def _abrir_checkpoint(ruta, entrada, reiniciar):
+    """Lee los índices ya terminados y deja el checkpoint abierto para añadir más"""
+    huella = {'entrada': os.path.abspath(entrada), 'bytes': os.path.getsize(entrada)}
+    hechos = set()
+    if os.path.exists(ruta) and not reiniciar:
+        with open(ruta) as f:
+            cabecera = json.loads(f.readline() or 'null')
+            if cabecera != huella:
+                raise SystemExit(f"{ruta} es de otra entrada ({cabecera}); usa --reiniciar para empezar de cero")
+            hechos = {int(linea) for linea in f if linea.strip().isdigit()}
+        return hechos, open(ruta, 'a', buffering=1)
+    f = open(ruta, 'w', buffering=1)
+    f.write(json.dumps(huella) + "\n")
+    return hechos, f
+
+def generar_lote(args=None):
+    """Renderiza un CSV/JSONL completo a un directorio o ZIP, reanudable tras una interrupción.
+
+    Uso: lote entrada salida [--procesos N] [--formato png|webp|svg] [--checkpoint ruta] [--reiniciar]
+    """
+    parser = argparse.ArgumentParser(prog="main.py lote")
+    parser.add_argument("entrada")
+    parser.add_argument("salida", help="directorio, o archivo .zip")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--formato", choices=sorted(FORMATOS_IMAGEN), default="png")
+    parser.add_argument("--checkpoint")
+    parser.add_argument("--reiniciar", action="store_true")
+    opciones = parser.parse_args(args)
+
+    # Con ZIP se escribe primero a un directorio de trabajo y se empaqueta al final:
+    # un ZIP a medio escribir no se puede reabrir para continuar
+    es_zip = opciones.salida.endswith('.zip')
+    directorio = opciones.salida + '.partes' if es_zip else opciones.salida
+    os.makedirs(directorio, exist_ok=True)
+    ruta_checkpoint = opciones.checkpoint or opciones.salida.rstrip('/') + '.checkpoint'
+    hechos, checkpoint = _abrir_checkpoint(ruta_checkpoint, opciones.entrada, opciones.reiniciar)
+
+    renderizados = errores = bytes_escritos = 0
+    tiempos = []
+    inicio = time.perf_counter()
+    filas = ((i, fila) for i, fila in enumerate(leer_filas_lote(opciones.entrada)) if i not in hechos)
+    executor = ProcessPoolExecutor(
+        max_workers=opciones.procesos, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_inicializar_worker_lote
+    )
+    en_vuelo = {}  # futuro -> (indice, nombre de archivo)
+    try:
+        agotadas = False
+        while en_vuelo or not agotadas:
+            # Ventana acotada de trabajos pendientes: la entrada se lee en streaming
+            while not agotadas and len(en_vuelo) < opciones.procesos * BULK_EN_VUELO_POR_PROCESO:
+                siguiente = next(filas, None)
+                if siguiente is None:
+                    agotadas = True
+                    break
+                indice, fila = siguiente
+                if not fila.get('data'):
+                    print(f"Fila {indice}: sin data, se omite", file=sys.stderr)
+                    errores += 1
+                    continue
+                futuro = executor.submit(_render_fila_lote, indice, fila, opciones.formato)
+                en_vuelo[futuro] = (indice, nombre_archivo_lote(indice, fila, opciones.formato))
+            if not en_vuelo:
+                break
+            terminados, _ = wait(en_vuelo, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                indice, nombre = en_vuelo.pop(futuro)
+                try:
+                    _, contenido, ms = futuro.result()
+                except Exception as e:
+                    print(f"Fila {indice}: {e}", file=sys.stderr)
+                    errores += 1
+                    continue
+                ruta = os.path.join(directorio, nombre)
+                with open(ruta + '.tmp', 'wb') as f:
+                    f.write(contenido)
+                os.replace(ruta + '.tmp', ruta)
+                checkpoint.write(f"{indice}\n")
+                renderizados += 1
+                bytes_escritos += len(contenido)
+                tiempos.append(ms)
+    except KeyboardInterrupt:
+        print(f"\nInterrumpido: vuelve a lanzar el mismo comando para continuar ({ruta_checkpoint})", file=sys.stderr)
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise SystemExit(130)
+    finally:
+        checkpoint.close()
+    executor.shutdown()
+
+    if es_zip and not errores:
+        with zipfile.ZipFile(opciones.salida + '.tmp', 'w', zipfile.ZIP_STORED) as zf:
+            for nombre in sorted(os.listdir(directorio)):
+                if nombre.endswith('.tmp'):
+                    continue
+                zf.write(os.path.join(directorio, nombre), nombre)
+        os.replace(opciones.salida + '.tmp', opciones.salida)
+        shutil.rmtree(directorio)
+    if not errores:
+        os.remove(ruta_checkpoint)
+
+    segundos = time.perf_counter() - inicio
+    tiempos.sort()
+    print(f"Renderizados: {renderizados}  reanudados: {len(hechos)}  errores: {errores}")
+    print(f"Tiempo: {segundos:.1f} s  ({renderizados / segundos if segundos else 0:.1f} QR/s con {opciones.procesos} procesos)")
+    if tiempos:
+        print(f"Por QR: p50 {tiempos[len(tiempos) // 2]:.1f} ms  p95 {tiempos[int(len(tiempos) * 0.95)]:.1f} ms  "
+              f"media {bytes_escritos / renderizados / 1024:.1f} KiB")
+    if errores:
+        print(f"Hay filas con error: se conserva {ruta_checkpoint} para reintentarlas", file=sys.stderr)
+        raise SystemExit(1)
+
+# Trabajos asíncronos: cola persistente en SQLite, hilos worker y progreso por SSE.
+# Un trabajo 'lote' avanza elemento a elemento y se reanuda desde el último
+# terminado; 'impresion' y 'etiquetas' son un único elemento.
+JOBS_DIR = os.environ.get('QR_JOBS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs'))
+JOBS_DB = os.environ.get('QR_JOBS_DB', os.path.join(JOBS_DIR, 'jobs.sqlite3'))
+JOBS_WORKERS = int(os.environ.get('QR_JOBS_WORKERS', '2'))
+# Un trabajo 'en_curso' sin latido en este tiempo se da por huérfano (proceso caído) y se retoma
+JOBS_STALE_SECONDS = float(os.environ.get('QR_JOBS_STALE_SECONDS', '30'))
+JOBS_MAX_ITEMS = 100000
+JOBS_HEARTBEAT = 5
+JOB_TYPES = {
+    'render': None,  # un único QR, derivado de una petición interactiva demasiado cara
+    'lote': 'application/zip',
+    'impresion': None,  # PNG o TIFF según el formato pedido
+    'etiquetas': 'application/pdf'
+}
+# 'render' solo lo encola la admisión por coste; POST /jobs no lo acepta
+JOB_TYPES_PUBLICOS = ('lote', 'impresion', 'etiquetas')
+
+class JobError(Exception):
+    pass
+
+class TrabajoInterrumpido(Exception):
+    """El proceso se está cerrando: el trabajo queda en curso y se retoma al arrancar de nuevo"""
+
+class ColaTrabajos:
+    """Cola de trabajos persistente; varios procesos pueden compartir la misma base de datos"""
+
+    def __init__(self, ruta_db=JOBS_DB, directorio=JOBS_DIR, workers=JOBS_WORKERS):
+        self.ruta_db = ruta_db
+        self.directorio = directorio
+        os.makedirs(directorio, exist_ok=True)
+        self._local = threading.local()
+        self._hay_trabajo = threading.Event()
+        self._parar = threading.Event()
+        self._conexion().execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                params TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                hechos INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                artefacto TEXT,
+                creado REAL NOT NULL,
+                actualizado REAL NOT NULL
+            )""")
+        self._conexion().execute("CREATE INDEX IF NOT EXISTS jobs_estado ON jobs (estado, creado)")
+        self._hilos = [
+            threading.Thread(target=self._bucle, name=f"trabajos-{i}", daemon=True) for i in range(workers)
+        ]
+        for hilo in self._hilos:
+            hilo.start()
+
+    def _conexion(self):
+        """Una conexión por hilo, en modo autocommit y WAL para leer mientras se escribe"""
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta_db, timeout=30, isolation_level=None)
+            conexion.row_factory = sqlite3.Row
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    def encolar(self, user_id, tipo, params, total):
+        job_id = os.urandom(12).hex()
+        ahora = time.time()
+        self._conexion().execute(
+            "INSERT INTO jobs (id, user_id, tipo, estado, params, total, creado, actualizado) VALUES (?, ?, ?, 'pendiente', ?, ?, ?, ?)",
+            (job_id, user_id, tipo, json.dumps(params), total, ahora, ahora)
+        )
+        self._hay_trabajo.set()
+        return job_id
+
+    def obtener(self, job_id):
+        fila = self._conexion().execute(
+            "SELECT id, user_id, tipo, estado, total, hechos, error, artefacto, creado, actualizado FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        return dict(fila) if fila else None
+
+    def _reclamar(self):
+        """Toma el trabajo pendiente (o huérfano) más antiguo de forma atómica"""
+        ahora = time.time()
+        fila = self._conexion().execute("""
+            UPDATE jobs SET estado = 'en_curso', actualizado = ?
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE estado = 'pendiente' OR (estado = 'en_curso' AND actualizado < ?)
+                ORDER BY creado LIMIT 1
+            )
+            RETURNING *""", (ahora, ahora - JOBS_STALE_SECONDS)).fetchone()
+        return dict(fila) if fila else None
+
+    def _progreso(self, job_id, hechos):
+        self._conexion().execute("UPDATE jobs SET hechos = ?, actualizado = ? WHERE id = ?", (hechos, time.time(), job_id))
+
+    def _finalizar(self, job_id, estado, artefacto=None, error=None):
+        self._conexion().execute(
+            "UPDATE jobs SET estado = ?, artefacto = ?, error = ?, actualizado = ? WHERE id = ?",
+            (estado, artefacto, error, time.time(), job_id)
+        )
+
+    def parar(self):
+        self._parar.set()
+        self._hay_trabajo.set()
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            try:
+                trabajo = self._reclamar()
+            except sqlite3.Error as e:
+                log.error("Error leyendo la cola de trabajos", extra={'error': str(e), 'limitar': str(e)})
+                trabajo = None
+            if trabajo is None:
+                # Sin trabajo: esperar a un encolado local o volver a mirar (otros procesos, huérfanos)
+                self._hay_trabajo.wait(1)
+                self._hay_trabajo.clear()
+                continue
+            token = contexto_log.set((trabajo['id'], False))
+            try:
+                artefacto = self._ejecutar(trabajo)
+                self._finalizar(trabajo['id'], 'terminado', artefacto=artefacto)
+            except TrabajoInterrumpido:
+                return
+            except Exception as e:
+                log.error("Trabajo fallido", extra={'tipo': trabajo['tipo'], 'error': str(e)})
+                self._finalizar(trabajo['id'], 'error', error=str(e))
+            finally:
+                contexto_log.reset(token)
+
+    def _ejecutar(self, trabajo):
+        params = json.loads(trabajo['params'])
+        if trabajo['tipo'] == 'lote':
+            return self._ejecutar_lote(trabajo, params)
+        if trabajo['tipo'] == 'render':
+            partes = [render_qr(**params)]
+            extension = params['formato']
+        elif trabajo['tipo'] == 'impresion':
+            partes = exportar_impresion(
+                params['data'], params['ancho_cm'], params['dpi'], params['formato'],
+                qr_color=params['qr_color'], bg_color=params['bg_color'], logo_url=params['logo_url']
+            )
+            extension = params['formato']
+        else:
+            partes = generar_hoja_etiquetas(
+                params['payloads'], params['plantilla'], qr_color=params['qr_color'], bg_color=params['bg_color'],
+                include_logo=params['include_logo'], logo_url=params['logo_url']
+            )
+            extension = 'pdf'
+        return self._volcar(trabajo['id'], partes, extension)
+
+    def _volcar(self, job_id, partes, extension):
+        """Escribe un artefacto generado por trozos, con latido para no parecer huérfano"""
+        nombre = f"{job_id}.{extension}"
+        ruta = os.path.join(self.directorio, nombre)
+        ultimo_latido = time.monotonic()
+        with open(ruta + '.tmp', 'wb') as f:
+            for parte in partes:
+                f.write(parte)
+                if time.monotonic() - ultimo_latido > JOBS_HEARTBEAT:
+                    self._progreso(job_id, 0)
+                    ultimo_latido = time.monotonic()
+        os.replace(ruta + '.tmp', ruta)
+        self._progreso(job_id, 1)
+        return nombre
+
+    def _ejecutar_lote(self, trabajo, params):
+        """Renderiza elemento a elemento a un directorio de trabajo y lo empaqueta en un ZIP"""
+        job_id = trabajo['id']
+        directorio = os.path.join(self.directorio, job_id)
+        os.makedirs(directorio, exist_ok=True)
+        items = params['items']
+        for indice in range(trabajo['hechos'], len(items)):
+            if self._parar.is_set():
+                raise TrabajoInterrumpido()
+            fila = items[indice] if isinstance(items[indice], dict) else {'data': str(items[indice])}
+            if not fila.get('data'):
+                raise JobError(f"Elemento {indice}: falta data")
+            try:
+                contenido = render_qr(**argumentos_fila_lote(fila, params['formato']))
+            except (LogoUploadError, ValueError, RenderTimeoutError) as e:
+                raise JobError(f"Elemento {indice}: {e}")
+            ruta = os.path.join(directorio, nombre_archivo_lote(indice, fila, params['formato']))
+            with open(ruta + '.tmp', 'wb') as f:
+                f.write(contenido)
+            os.replace(ruta + '.tmp', ruta)
+            self._progreso(job_id, indice + 1)
+
+        nombre = f"{job_id}.zip"
+        ruta_zip = os.path.join(self.directorio, nombre)
+        with zipfile.ZipFile(ruta_zip + '.tmp', 'w', zipfile.ZIP_STORED) as zf:
+            for archivo in sorted(os.listdir(directorio)):
+                if not archivo.endswith('.tmp'):
+                    zf.write(os.path.join(directorio, archivo), archivo)
+        os.replace(ruta_zip + '.tmp', ruta_zip)
+        shutil.rmtree(directorio)
+        return nombre
+
+_cola_trabajos = None
+_cola_trabajos_lock = threading.Lock()
+
+def obtener_cola_trabajos():
+    """Devuelve la cola de trabajos (arrancando sus workers la primera vez) o None si está deshabilitada"""
+    global _cola_trabajos
+    if JOBS_WORKERS <= 0:
+        return None
+    with _cola_trabajos_lock:
+        if _cola_trabajos is None:
+            _cola_trabajos = ColaTrabajos()
+            atexit.register(_cola_trabajos.parar)
+        return _cola_trabajos
+
+# Analítica de escaneos: códigos de seguimiento /s/<codigo> que redirigen al
+# destino. Por código se guarda un HyperLogLog de visitantes y contadores por
+# hora y por día en anillo (~1,6 KB en total); los escaneos se acumulan en
+# memoria y se vuelcan cada pocos segundos a SQLite sumándose a lo guardado,
+# así varios procesos pueden compartir la base de datos.
+SCANS_DB = os.environ.get('QR_SCANS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scans.sqlite3'))
+SCANS_FLUSH_SECONDS = float(os.environ.get('QR_SCANS_FLUSH_SECONDS', '5'))
+# Clave del hash de visitantes: fija entre reinicios o los únicos se contarían dos veces.
+# Sin ella no se estiman únicos: un valor de serie público haría el hash reversible.
+SCANS_SALT = os.environ.get('QR_SCANS_SALT', '')
+# Forman parte del formato guardado: cambiarlos invalida las estadísticas existentes
+SCAN_HLL_BITS = 10
+SCAN_HOURS = 48
+SCAN_DAYS = 90
+_CABECERA_ESCANEOS = struct.Struct('<QII')
+
+class EstadisticasEscaneo:
+    """Contadores de un código: total, HyperLogLog de visitantes y anillos por hora y día
+
+    Un anillo guarda la última unidad (hora o día desde epoch) que ha visto;
+    la unidad u vive en la posición u % tamaño y al avanzar se vacían las
+    posiciones que se reutilizan. Tamaño fijo: registrar, fusionar y
+    consultar no dependen del número de escaneos.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.registros = np.zeros(1 << SCAN_HLL_BITS, dtype=np.uint8)
+        self.horas = np.zeros(SCAN_HOURS, dtype=np.uint32)
+        self.dias = np.zeros(SCAN_DAYS, dtype=np.uint32)
+        self.hora = 0
+        self.dia = 0
+
+    @staticmethod
+    def _avanzar(anillo, ultima, unidad):
+        """Vacía las posiciones entre la última unidad vista y la nueva"""
+        if unidad <= ultima:
+            return ultima
+        if unidad - ultima >= anillo.size:
+            anillo.fill(0)
+        else:
+            anillo[np.arange(ultima + 1, unidad + 1) % anillo.size] = 0
+        return unidad
+
+    def avanzar(self, ahora):
+        self.hora = self._avanzar(self.horas, self.hora, int(ahora // 3600))
+        self.dia = self._avanzar(self.dias, self.dia, int(ahora // 86400))
+
+    def registrar(self, visitante, ahora):
+        """Cuenta un escaneo; `visitante` es un hash de 64 bits, o None para no contarlo en únicos"""
+        self.total += 1
+        if visitante is not None:
+            indice = visitante >> (64 - SCAN_HLL_BITS)
+            resto = visitante & ((1 << (64 - SCAN_HLL_BITS)) - 1)
+            rango = 64 - SCAN_HLL_BITS - resto.bit_length() + 1
+            if rango > self.registros[indice]:
+                self.registros[indice] = rango
+        self.avanzar(ahora)
+        hora, dia = int(ahora // 3600), int(ahora // 86400)
+        # Un escaneo más antiguo que el anillo solo cuenta en el total
+        if hora > self.hora - SCAN_HOURS:
+            self.horas[hora % SCAN_HOURS] += 1
+        if dia > self.dia - SCAN_DAYS:
+            self.dias[dia % SCAN_DAYS] += 1
+
+    def fusionar(self, otra):
+        """Suma otra instancia: máximo de registros y suma de anillos alineados"""
+        self.total += otra.total
+        np.maximum(self.registros, otra.registros, out=self.registros)
+        self.hora = self._sumar_anillo(self.horas, self.hora, otra.horas, otra.hora)
+        self.dia = self._sumar_anillo(self.dias, self.dia, otra.dias, otra.dia)
+
+    @classmethod
+    def _sumar_anillo(cls, anillo, ultima, otro, otra_ultima):
+        """Lleva los dos anillos a la misma unidad y los suma posición a posición"""
+        unidad = max(ultima, otra_ultima)
+        cls._avanzar(anillo, ultima, unidad)
+        otro = otro.copy()
+        cls._avanzar(otro, otra_ultima, unidad)
+        anillo += otro
+        return unidad
+
+    def unicos(self):
+        """Estimación de visitantes distintos (error típico 1,04/sqrt(m) ≈ 3%)"""
+        m = self.registros.size
+        estimacion = 0.7213 / (1 + 1.079 / m) * m * m / np.ldexp(1.0, -self.registros.astype(np.int32)).sum()
+        vacios = int(np.count_nonzero(self.registros == 0))
+        if estimacion <= 2.5 * m and vacios:
+            # Rango pequeño: conteo lineal sobre los registros vacíos
+            estimacion = m * math.log(m / vacios)
+        return int(round(estimacion))
+
+    def a_bytes(self):
+        return (
+            _CABECERA_ESCANEOS.pack(self.total, self.hora, self.dia)
+            + self.registros.tobytes() + self.horas.tobytes() + self.dias.tobytes()
+        )
+
+    @classmethod
+    def desde_bytes(cls, datos):
+        estadisticas = cls()
+        estadisticas.total, estadisticas.hora, estadisticas.dia = _CABECERA_ESCANEOS.unpack_from(datos)
+        offset = _CABECERA_ESCANEOS.size
+        for nombre in ('registros', 'horas', 'dias'):
+            anillo = getattr(estadisticas, nombre)
+            anillo[:] = np.frombuffer(datos, dtype=anillo.dtype, count=anillo.size, offset=offset)
+            offset += anillo.nbytes
+        return estadisticas
+
+    def resumen(self, ahora):
+        """Totales y series de tamaño fijo, de la más antigua a la actual"""
+        self.avanzar(ahora)
+        return {
+            'total': self.total,
+            'unicos': self.unicos(),
+            'por_hora': np.roll(self.horas, -((self.hora + 1) % SCAN_HOURS)).tolist(),
+            'por_dia': np.roll(self.dias, -((self.dia + 1) % SCAN_DAYS)).tolist()
+        }
+
+class RegistroEscaneos:
+    """Códigos de seguimiento y sus estadísticas en SQLite, con escritura diferida"""
+
+    def __init__(self, ruta_db=SCANS_DB, intervalo=SCANS_FLUSH_SECONDS):
+        self.ruta_db = ruta_db
+        self.intervalo = intervalo
+        self._local = threading.local()
+        self._pendientes = {}
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        conexion = self._conexion()
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS codigos (
+                codigo TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                creado REAL NOT NULL
+            )""")
+        conexion.execute("CREATE TABLE IF NOT EXISTS escaneos (codigo TEXT PRIMARY KEY, datos BLOB NOT NULL)")
+        self._hilo = threading.Thread(target=self._bucle, name="escaneos", daemon=True)
+        self._hilo.start()
+
+    def _conexion(self):
+        """Una conexión por hilo, en modo autocommit y WAL como la cola de trabajos"""
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta_db, timeout=30, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    def crear_codigo(self, url, user_id):
+        """Código estable por (usuario, destino): emitirlo dos veces devuelve el mismo"""
+        resumen = hashlib.blake2b(f"{user_id}\0{url}".encode(), digest_size=8).digest()
+        codigo = base64.urlsafe_b64encode(resumen).decode('ascii').rstrip('=')
+        self._conexion().execute(
+            "INSERT OR IGNORE INTO codigos (codigo, url, user_id, creado) VALUES (?, ?, ?, ?)",
+            (codigo, url, user_id, time.time())
+        )
+        return codigo
+
+    def destino(self, codigo):
+        """(url, user_id) del código, o None"""
+        return self._conexion().execute("SELECT url, user_id FROM codigos WHERE codigo = ?", (codigo,)).fetchone()
+
+    def registrar(self, codigo, visitante, ahora=None):
+        """Cuenta un escaneo en memoria; llega a la base de datos en el siguiente volcado"""
+        with self._lock:
+            pendiente = self._pendientes.get(codigo)
+            if pendiente is None:
+                pendiente = self._pendientes[codigo] = EstadisticasEscaneo()
+            pendiente.registrar(visitante, time.time() if ahora is None else ahora)
+
+    def estadisticas(self, codigo):
+        """Lo guardado más lo pendiente de volcar: una fila y una fusión de tamaño fijo"""
+        fila = self._conexion().execute("SELECT datos FROM escaneos WHERE codigo = ?", (codigo,)).fetchone()
+        estadisticas = EstadisticasEscaneo.desde_bytes(fila[0]) if fila else EstadisticasEscaneo()
+        with self._lock:
+            pendiente = self._pendientes.get(codigo)
+            if pendiente is not None:
+                estadisticas.fusionar(pendiente)
+        return estadisticas
+
+    def volcar(self):
+        """Suma lo pendiente a lo guardado en una sola transacción"""
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+        if not pendientes:
+            return 0
+        conexion = self._conexion()
+        try:
+            conexion.execute("BEGIN IMMEDIATE")
+            for codigo, pendiente in pendientes.items():
+                fila = conexion.execute("SELECT datos FROM escaneos WHERE codigo = ?", (codigo,)).fetchone()
+                if fila:
+                    guardada = EstadisticasEscaneo.desde_bytes(fila[0])
+                    guardada.fusionar(pendiente)
+                    pendiente = guardada
+                conexion.execute("INSERT OR REPLACE INTO escaneos (codigo, datos) VALUES (?, ?)", (codigo, pendiente.a_bytes()))
+            conexion.execute("COMMIT")
+        except sqlite3.Error:
+            conexion.execute("ROLLBACK")
+            # Devolver lo no guardado para el siguiente intento
+            with self._lock:
+                for codigo, pendiente in pendientes.items():
+                    actual = self._pendientes.get(codigo)
+                    if actual is not None:
+                        pendiente.fusionar(actual)
+                    self._pendientes[codigo] = pendiente
+            raise
+        return len(pendientes)
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                self.volcar()
+            except sqlite3.Error as e:
+                log.error("No se pudieron volcar los escaneos", extra={'error': str(e), 'limitar': str(e)})
+
+    def parar(self):
+        self._parar.set()
+        self.volcar()
+
+    def pendientes(self):
+        with self._lock:
+            return len(self._pendientes)
+
+_registro_escaneos = None
+_registro_escaneos_lock = threading.Lock()
+
+def obtener_registro_escaneos():
+    """Devuelve el registro de escaneos, creándolo (y su hilo de volcado) la primera vez"""
+    global _registro_escaneos
+    with _registro_escaneos_lock:
+        if _registro_escaneos is None:
+            if not SCANS_SALT:
+                log.warning("QR_SCANS_SALT sin definir: se cuentan escaneos pero no visitantes únicos")
+            _registro_escaneos = RegistroEscaneos()
+            atexit.register(_registro_escaneos.parar)
+        return _registro_escaneos
+
+def hash_visitante():
+    """Hash de 64 bits de IP y User-Agent, o None sin QR_SCANS_SALT; solo se guarda dentro del HyperLogLog
+
+    La IP es remote_addr (el último salto de confianza con QR_TRUSTED_PROXIES):
+    el primer salto de X-Forwarded-For lo escribe el cliente y permitiría
+    inflar los únicos a voluntad.
+    """
+    if not SCANS_SALT:
+        return None
+    ip = request.remote_addr or ''
+    clave = hashlib.blake2b(
+        f"{ip}\0{request.headers.get('User-Agent', '')}".encode(), digest_size=8, key=SCANS_SALT.encode()[:64]
+    )
+    return int.from_bytes(clave.digest(), 'big')
+
 def get_user_id():
     """Obtener el ID del usuario autenticado desde los headers de Replit"""
     return request.headers.get('X-Replit-User-Id')
@@ -1030,6 +4531,216 @@ def is_authenticated():
     """Verificar si el usuario está autenticado"""
     return get_user_id() is not None
 
+# Token para los endpoints y cabeceras de administración (vacío = deshabilitados)
+ADMIN_TOKEN = os.environ.get('QR_ADMIN_TOKEN', '')
+
+def is_admin():
+    """Verificar si la petición trae el token de administración"""
+    token = request.headers.get('X-Admin-Token')
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+# Perfilado bajo demanda: una fracción de peticiones (QR_PROFILE_SAMPLE_RATE)
+# o una petición concreta con `X-QR-Profile: 1` y el token de administración
+PROFILE_SAMPLE_RATE = float(os.environ.get('QR_PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL = float(os.environ.get('QR_PROFILE_INTERVAL', '0.001'))
+PROFILE_DIR = os.environ.get('QR_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+
+class PerfiladorMuestreo:
+    """Perfilador por muestreo de un hilo, con salida en formato speedscope
+
+    Un hilo aparte lee la pila del hilo perfilado cada `intervalo` segundos,
+    así el código perfilado no lleva instrumentación. Los renders que se
+    hacen en el pool de procesos no aparecen en el perfil.
+    """
+
+    def __init__(self, thread_id, intervalo=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.intervalo = intervalo
+        self.frames = []
+        self._indices = {}
+        self.muestras = []
+        self.pesos = []
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._muestrear, daemon=True)
+
+    def start(self):
+        self.inicio = time.perf_counter()
+        self._hilo.start()
+
+    def stop(self):
+        self._parar.set()
+        self._hilo.join()
+        self.fin = time.perf_counter()
+
+    def _muestrear(self):
+        anterior = time.perf_counter()
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            ahora = time.perf_counter()
+            if frame is None:
+                continue
+
+            pila = []
+            while frame is not None:
+                codigo = frame.f_code
+                clave = (codigo.co_name, codigo.co_filename, codigo.co_firstlineno)
+                indice = self._indices.get(clave)
+                if indice is None:
+                    indice = self._indices[clave] = len(self.frames)
+                    self.frames.append({'name': clave[0], 'file': clave[1], 'line': clave[2]})
+                pila.append(indice)
+                frame = frame.f_back
+
+            # speedscope espera la pila de la raíz a la hoja
+            pila.reverse()
+            self.muestras.append(pila)
+            self.pesos.append(ahora - anterior)
+            anterior = ahora
+
+    def speedscope(self, nombre):
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': nombre,
+            'exporter': 'myQR',
+            'shared': {'frames': self.frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': nombre,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': self.fin - self.inicio,
+                'samples': self.muestras,
+                'weights': self.pesos
+            }]
+        }
+
+def guardar_perfil(perfilador, nombre):
+    """Escribe el perfil en PROFILE_DIR y devuelve el nombre del archivo"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    archivo = f"{time.strftime('%Y%m%d-%H%M%S')}_{nombre}_{os.urandom(4).hex()}.speedscope.json"
+    with open(os.path.join(PROFILE_DIR, archivo), 'w') as f:
+        json.dump(perfilador.speedscope(nombre), f)
+    return archivo
+
+@app.before_request
+def iniciar_perfil():
+    """Arranca el perfilador si la petición fue muestreada o lo pide un admin"""
+    solicitado = request.headers.get('X-QR-Profile') == '1'
+    if not solicitado and (PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE):
+        return
+    if solicitado and not is_admin():
+        return
+    g.perfilador = PerfiladorMuestreo(threading.get_ident())
+    g.perfilador.start()
+
+@app.after_request
+def terminar_perfil(response):
+    """Guarda el perfil de la petición; en respuestas en streaming cubre hasta que empieza el envío"""
+    perfilador = g.pop('perfilador', None)
+    if perfilador is None:
+        return response
+    perfilador.stop()
+    try:
+        archivo = guardar_perfil(perfilador, request.endpoint or 'desconocido')
+        response.headers['X-QR-Profile-File'] = archivo
+    except OSError as e:
+        log.warning("No se pudo guardar el perfil", extra={'error': str(e)})
+    return response
+
+# Contabilidad de memoria para instancias de larga duración
+_memoria_baseline = None
+_memoria_lock = threading.Lock()
+
+def rss_actual():
+    """RSS actual del proceso en bytes (solo Linux), o None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _bytes_imagen(img):
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+def reporte_memoria(top_usuarios=10):
+    """Memoria por subsistema: historial, cachés, imágenes Pillow vivas y proceso"""
+    historial = sorted(((len(v), k) for k, v in list(user_qr_history.items())), reverse=True)
+
+    # Recorrer el heap es caro, pero este reporte solo se pide a mano
+    imagenes = [obj for obj in gc.get_objects() if isinstance(obj, Image.Image)]
+
+    return {
+        'proceso': {
+            'rss_bytes': rss_actual(),
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        },
+        'historial': {
+            'usuarios': len(historial),
+            'entradas': sum(n for n, _ in historial),
+            'top_usuarios': [{'user_id': k, 'entradas': n} for n, k in historial[:top_usuarios]]
+        },
+        'render_cache': {
+            'almacen': almacen.nombre,
+            'entradas': len(render_cache),
+            'bytes': render_cache.bytes,
+            'max_bytes': render_cache.max_bytes,
+            'hits': render_cache.hits,
+            'misses': render_cache.misses,
+            'calentador': calentador.resumen() if calentador is not None else None
+        },
+        'logos': {
+            'originales': len(logo_originales),
+            'sprites': len(logo_sprites),
+            'renders_degradados': estadisticas_logo['degradados'],
+            'bytes': sum(_bytes_imagen(img) for cache in (logo_originales, logo_sprites) for img in list(cache.values()))
+        },
+        'buffer_pool': buffer_pool.resumen(),
+        'maestros_paleta': dict(
+            estadisticas_paleta, entradas=len(_maestros_paleta),
+            bytes=sum(len(maestro[0]) for maestro in list(_maestros_paleta.values()))
+        ),
+        'escaneos_pendientes': _registro_escaneos.pendientes() if _registro_escaneos is not None else None,
+        'pillow': {
+            'imagenes_vivas': len(imagenes),
+            'bytes': sum(_bytes_imagen(img) for img in imagenes)
+        },
+        'tracemalloc': {
+            'activo': tracemalloc.is_tracing(),
+            'baseline': _memoria_baseline is not None,
+            'traced_bytes': tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        }
+    }
+
+def tomar_baseline_memoria(frames=10):
+    """Arranca tracemalloc si hace falta y guarda la instantánea de referencia"""
+    global _memoria_baseline
+    with _memoria_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        _memoria_baseline = tracemalloc.take_snapshot()
+
+def detener_tracemalloc():
+    global _memoria_baseline
+    with _memoria_lock:
+        _memoria_baseline = None
+        tracemalloc.stop()
+
+def diff_memoria(agrupar='lineno', limite=20):
+    """Crecimiento desde la baseline, agrupado por línea o por traceback"""
+    with _memoria_lock:
+        if _memoria_baseline is None:
+            return None
+        actual = tracemalloc.take_snapshot()
+        filtros = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        diferencias = actual.filter_traces(filtros).compare_to(_memoria_baseline.filter_traces(filtros), agrupar)
+
+    return [{
+        'traceback': [f"{frame.filename}:{frame.lineno}" for frame in d.traceback],
+        'size_diff': d.size_diff,
+        'size': d.size,
+        'count_diff': d.count_diff
+    } for d in diferencias[:limite]]
+
 @app.route('/auth_status')
 def auth_status():
     """Endpoint para verificar el estado de autenticación"""
@@ -1056,7 +4767,7 @@ def get_history():
         return jsonify([])
 
     user_id = get_user_id()
-    return jsonify(user_qr_history.get(user_id, []))
+    return jsonify(almacen.leer_historial(user_id))
 
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
@@ -1065,9 +4776,536 @@ def clear_history():
         return jsonify({'error': 'No autenticado'}), 401
 
     user_id = get_user_id()
-    user_qr_history[user_id] = []
+    try:
+        almacen.borrar_historial(user_id)
+    except AlmacenNoDisponible as e:
+        return jsonify({'error': str(e)}), 503
     return jsonify({'success': True})
 
+def resolver_logo(data, logo_hash=None, include_logo=True):
+    """Logo a usar en un render: el subido por el usuario o el de la marca detectada"""
+    if not include_logo:
+        return None
+    if logo_hash:
+        if ruta_logo_subido(logo_hash) is None or not almacen.existe_logo(logo_hash):
+            raise LogoUploadError("Logo no encontrado", 404)
+        return PREFIJO_LOGO_SUBIDO + logo_hash
+    return obtener_logo(detectar_tipo_enlace(data))
+
+@app.route('/logos', methods=['POST'])
+def upload_logo():
+    """Sube un logo propio (cuerpo de la petición = imagen) y devuelve su hash"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+
+    try:
+        sha, nuevo = guardar_logo_subido(request.stream, request.content_length)
+    except LogoUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
+    return jsonify({'hash': sha, 'logo': PREFIJO_LOGO_SUBIDO + sha, 'nuevo': nuevo}), 201 if nuevo else 200
+
+@app.route('/logos/<sha>')
+def get_logo(sha):
+    """Devuelve la versión normalizada de un logo subido"""
+    try:
+        contenido = almacen.leer_logo(sha) if ruta_logo_subido(sha) else None
+    except LogoUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    if contenido is None:
+        return jsonify({'error': 'Logo no encontrado'}), 404
+    return send_file(io.BytesIO(contenido), mimetype='image/png', max_age=31536000)
+
+@app.route('/print_export')
+def print_export():
+    """Descarga el QR a tamaño de impresión (PNG o TIFF) generado por franjas"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+
+    data = request.args.get('data')
+    if not data:
+        return jsonify({'error': 'Falta el parámetro data'}), 400
+
+    formato = request.args.get('formato', 'png').lower()
+    include_logo = request.args.get('include_logo', 'true') != 'false'
+    try:
+        logo_url = resolver_logo(data, request.args.get('logo'), include_logo)
+    except LogoUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
+    try:
+        ancho_cm = float(request.args.get('ancho_cm', '10'))
+        dpi = int(request.args.get('dpi', '300'))
+        partes = exportar_impresion(
+            data, ancho_cm, dpi, formato,
+            qr_color=request.args.get('qr_color', '#000000'),
+            bg_color=request.args.get('bg_color', '#ffffff'),
+            logo_url=logo_url
+        )
+        # Validar los parámetros antes de empezar a enviar la respuesta
+        primera = next(partes)
+    except qrcode.exceptions.DataOverflowError as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    mimetype = 'image/tiff' if formato == 'tiff' else 'image/png'
+    return Response(
+        itertools.chain([primera], partes),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=qr_{dpi}dpi.{formato}'}
+    )
+
+@app.route('/label_sheet', methods=['POST'])
+def label_sheet():
+    """Descarga un PDF con hojas de etiquetas QR para imprimir en lote"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+
+    cuerpo = request.get_json(silent=True) or {}
+    payloads = cuerpo.get('payloads')
+    if not isinstance(payloads, list) or not payloads:
+        return jsonify({'error': 'Se necesita una lista de contenidos en payloads'}), 400
+    if len(payloads) > LABEL_MAX_PAYLOADS:
+        return jsonify({'error': f'Máximo {LABEL_MAX_PAYLOADS} etiquetas por hoja'}), 400
+
+    payloads = [str(p) for p in payloads]
+    # Un contenido que no cabe rompería el PDF a medio enviar: comprobarlos todos antes
+    for indice, payload in enumerate(payloads):
+        if not cabe_en_qr(payload):
+            return jsonify({'error': f'El contenido {indice} no cabe en un código QR', 'indice': indice}), 413
+
+    logo_url = None
+    if cuerpo.get('logo'):
+        try:
+            logo_url = resolver_logo('', cuerpo['logo'])
+        except LogoUploadError as e:
+            return jsonify({'error': str(e)}), e.status
+
+    try:
+        partes = generar_hoja_etiquetas(
+            payloads,
+            cuerpo.get('plantilla'),
+            qr_color=cuerpo.get('qr_color', '#000000'),
+            bg_color=cuerpo.get('bg_color', '#ffffff'),
+            include_logo=bool(cuerpo.get('include_logo', True)),
+            logo_url=logo_url
+        )
+        # Validar la plantilla antes de empezar a enviar la respuesta
+        primera = next(partes)
+    except qrcode.exceptions.DataOverflowError as e:
+        return jsonify({'error': str(e)}), 413
+    except (ValueError, TypeError, KeyError) as e:
+        return jsonify({'error': f'Plantilla inválida: {e}'}), 400
+
+    return Response(
+        itertools.chain([primera], partes),
+        mimetype='application/pdf',
+        headers={'Content-Disposition': 'attachment; filename=etiquetas_qr.pdf'}
+    )
+
+@app.before_request
+def arrancar_trabajos():
+    """Arranca la cola con la primera petición para retomar los trabajos pendientes tras un reinicio"""
+    if _cola_trabajos is None and JOBS_WORKERS > 0:
+        obtener_cola_trabajos()
+
+def _trabajo_publico(trabajo):
+    base = f"/jobs/{trabajo['id']}"
+    return {
+        'id': trabajo['id'],
+        'tipo': trabajo['tipo'],
+        'estado': trabajo['estado'],
+        'total': trabajo['total'],
+        'hechos': trabajo['hechos'],
+        'error': trabajo['error'],
+        'eventos': f"{base}/events",
+        'artefacto': f"{base}/artifact" if trabajo['estado'] == 'terminado' else None
+    }
+
+def _trabajo_del_usuario(job_id):
+    cola = obtener_cola_trabajos()
+    trabajo = cola.obtener(job_id) if cola is not None else None
+    if trabajo is None or trabajo['user_id'] != get_user_id():
+        return None
+    return trabajo
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Encola un trabajo largo (lote, impresion o etiquetas) y devuelve su id"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+    cola = obtener_cola_trabajos()
+    if cola is None:
+        return jsonify({'error': 'Los trabajos asíncronos están deshabilitados'}), 503
+
+    cuerpo = request.get_json(silent=True) or {}
+    tipo = cuerpo.get('tipo')
+    if tipo not in JOB_TYPES_PUBLICOS:
+        return jsonify({'error': f"tipo debe ser uno de: {', '.join(JOB_TYPES_PUBLICOS)}"}), 400
+
+    try:
+        logo_url = resolver_logo('', cuerpo['logo']) if cuerpo.get('logo') else None
+        if tipo == 'lote':
+            items = cuerpo.get('items')
+            if not isinstance(items, list) or not items:
+                raise ValueError('Se necesita una lista de elementos en items')
+            if len(items) > JOBS_MAX_ITEMS:
+                raise ValueError(f'Máximo {JOBS_MAX_ITEMS} elementos por trabajo')
+            formato = cuerpo.get('formato', 'png')
+            if formato not in FORMATOS_IMAGEN:
+                raise ValueError(f'Formato no soportado: {formato}')
+            params = {'items': items, 'formato': formato}
+            total = len(items)
+        elif tipo == 'impresion':
+            if not cuerpo.get('data'):
+                raise ValueError('Falta data')
+            include_logo = bool(cuerpo.get('include_logo', True))
+            params = {
+                'data': cuerpo['data'],
+                'ancho_cm': float(cuerpo.get('ancho_cm', 10)),
+                'dpi': int(cuerpo.get('dpi', 300)),
+                'formato': str(cuerpo.get('formato', 'png')).lower(),
+                'qr_color': cuerpo.get('qr_color', '#000000'),
+                'bg_color': cuerpo.get('bg_color', '#ffffff'),
+                'logo_url': resolver_logo(cuerpo['data'], cuerpo.get('logo'), include_logo)
+            }
+            validar_impresion(params['ancho_cm'], params['dpi'], params['formato'])
+            if not cabe_en_qr(params['data']):
+                raise ValueError('El contenido no cabe en un código QR')
+            total = 1
+        else:
+            payloads = cuerpo.get('payloads')
+            if not isinstance(payloads, list) or not payloads:
+                raise ValueError('Se necesita una lista de contenidos en payloads')
+            if len(payloads) > LABEL_MAX_PAYLOADS:
+                raise ValueError(f'Máximo {LABEL_MAX_PAYLOADS} etiquetas por hoja')
+            payloads = [str(p) for p in payloads]
+            for indice, payload in enumerate(payloads):
+                if not cabe_en_qr(payload):
+                    raise ValueError(f'El contenido {indice} no cabe en un código QR')
+            params = {
+                'payloads': payloads,
+                'plantilla': cuerpo.get('plantilla'),
+                'qr_color': cuerpo.get('qr_color', '#000000'),
+                'bg_color': cuerpo.get('bg_color', '#ffffff'),
+                'include_logo': bool(cuerpo.get('include_logo', True)),
+                'logo_url': logo_url
+            }
+            total = 1
+    except LogoUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    job_id = cola.encolar(get_user_id(), tipo, params, total)
+    return jsonify(_trabajo_publico(cola.obtener(job_id))), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+    trabajo = _trabajo_del_usuario(job_id)
+    if trabajo is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(_trabajo_publico(trabajo))
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Progreso del trabajo como Server-Sent Events hasta que termina o falla"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+    if _trabajo_del_usuario(job_id) is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+
+    cola = obtener_cola_trabajos()
+
+    def eventos():
+        anterior = None
+        ultimo_envio = time.monotonic()
+        while True:
+            trabajo = _trabajo_publico(cola.obtener(job_id))
+            if trabajo != anterior:
+                evento = 'fin' if trabajo['estado'] in ('terminado', 'error') else 'progreso'
+                yield f"event: {evento}\ndata: {json.dumps(trabajo)}\n\n"
+                if evento == 'fin':
+                    return
+                anterior = trabajo
+                ultimo_envio = time.monotonic()
+            elif time.monotonic() - ultimo_envio > 15:
+                # Comentario SSE para que los proxies no cierren la conexión inactiva
+                yield ": keepalive\n\n"
+                ultimo_envio = time.monotonic()
+            time.sleep(0.5)
+
+    return Response(eventos(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/artifact')
+def job_artifact(job_id):
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+    trabajo = _trabajo_del_usuario(job_id)
+    if trabajo is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    if trabajo['estado'] != 'terminado':
+        return jsonify({'error': f"El trabajo está {trabajo['estado']}"}), 409
+    nombre = trabajo['artefacto']
+    extension = nombre.rsplit('.', 1)[-1]
+    mimetype = JOB_TYPES[trabajo['tipo']] or FORMATOS_IMAGEN.get(extension) or 'image/tiff'
+    return send_file(
+        os.path.join(obtener_cola_trabajos().directorio, nombre), mimetype=mimetype,
+        as_attachment=True, download_name=f"qr_{trabajo['tipo']}_{nombre}"
+    )
+
+@app.route('/codes', methods=['POST'])
+def create_code():
+    """Emite un código de seguimiento para una URL; el QR debe apuntar a url_escaneo"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+    url = str((request.get_json(silent=True) or {}).get('url') or request.form.get('url', '')).strip()
+    if urlparse(url).scheme not in ('http', 'https') or not urlparse(url).netloc:
+        return jsonify({'error': 'Se necesita una URL http(s) en url'}), 400
+
+    codigo = obtener_registro_escaneos().crear_codigo(url, get_user_id())
+    url_escaneo = f"{request.host_url}s/{codigo}"
+    return jsonify({
+        'codigo': codigo,
+        'url': url,
+        'url_escaneo': url_escaneo,
+        'estadisticas': f"/codes/{codigo}/stats"
+    }), 201
+
+@app.route('/s/<codigo>')
+def scan_code(codigo):
+    """Cuenta el escaneo y redirige al destino"""
+    registro = obtener_registro_escaneos()
+    fila = registro.destino(codigo)
+    if fila is None:
+        return jsonify({'error': 'Código no encontrado'}), 404
+    registro.registrar(codigo, hash_visitante())
+    respuesta = redirect(fila[0], 302)
+    # Sin caché: cada escaneo tiene que llegar hasta aquí para contarse
+    respuesta.headers['Cache-Control'] = 'no-store'
+    return respuesta
+
+@app.route('/codes/<codigo>/stats')
+def code_stats(codigo):
+    """Escaneos totales, visitantes únicos estimados y series por hora y día"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+    registro = obtener_registro_escaneos()
+    fila = registro.destino(codigo)
+    if fila is None or fila[1] != get_user_id():
+        return jsonify({'error': 'Código no encontrado'}), 404
+    resumen = registro.estadisticas(codigo).resumen(time.time())
+    if not SCANS_SALT:
+        resumen['unicos'] = None
+    return jsonify(dict(resumen, codigo=codigo, url=fila[0], horas=SCAN_HOURS, dias=SCAN_DAYS))
+
+@app.route('/qr_image')
+def qr_image():
+    """Devuelve solo la imagen del QR en PNG, WebP o SVG según `format` o Accept"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+
+    data = request.args.get('data')
+    if not data:
+        return jsonify({'error': 'Falta el parámetro data'}), 400
+
+    formato = request.args.get('format')
+    if formato is not None and formato not in FORMATOS_IMAGEN:
+        return jsonify({'error': f'Formato no soportado: {formato}'}), 400
+    formato = negociar_formato(formato, request.accept_mimetypes)
+
+    include_logo = request.args.get('include_logo', 'true') != 'false'
+    try:
+        logo_url = resolver_logo(data, request.args.get('logo'), include_logo)
+    except LogoUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
+    gradient = request.args.get('gradient')
+    finder_color = request.args.get('finder_color')
+    card = request.args.get('card')
+    try:
+        if gradient:
+            parsear_degradado(gradient)
+        if finder_color and not re.fullmatch(r'#?[0-9a-fA-F]{6}', finder_color):
+            raise ValueError(f"Color de patrones inválido: {finder_color}")
+        if card:
+            parsear_tarjeta(card)
+            if formato == 'svg':
+                raise ValueError("Las tarjetas solo están disponibles en PNG y WebP")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    bg_color = request.args.get('bg_color', '#ffffff')
+    qr_color = request.args.get('qr_color', '#000000')
+    rechazo, opciones = respuesta_admision(
+        data,
+        {'qr_style': request.args.get('qr_style', 'square'), 'qr_size': request.args.get('qr_size', 'medium'),
+         'gradient': gradient, 'finder_color': finder_color},
+        {'data': data, 'logo_url': logo_url, 'bg_color': bg_color, 'qr_color': qr_color,
+         'include_logo': include_logo, 'formato': formato, 'card': card}
+    )
+    if rechazo is not None:
+        return rechazo
+
+    try:
+        contenido, degradado = render_qr_interactivo(
+            data, logo_url, bg_color, qr_color, opciones['qr_style'], opciones['qr_size'],
+            include_logo, formato, opciones['gradient'], opciones['finder_color'], card
+        )
+    except RenderTimeoutError as e:
+        log.warning("Render cancelado", extra={'error': str(e)})
+        return jsonify({'error': 'El QR tardó demasiado en generarse, inténtalo de nuevo'}), 503
+
+    respuesta = Response(contenido, mimetype=FORMATOS_IMAGEN[formato])
+    respuesta.vary.add('Accept')
+    if degradado:
+        # Sin logo por falta de tiempo: que no se cachee fuera, la próxima vez llevará logo
+        respuesta.headers['X-QR-Degraded'] = 'logo'
+        respuesta.headers['Cache-Control'] = 'no-store'
+    return respuesta
+
+@app.route('/qr_matrix')
+def qr_matrix():
+    """Matriz del QR empaquetada a bits para pintarla en el navegador sin rasterizar aquí"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+
+    data = request.args.get('data')
+    if not data:
+        return jsonify({'error': 'Falta el parámetro data'}), 400
+
+    qr_size = request.args.get('qr_size', 'medium')
+    if qr_size not in QR_SIZE_MAP:
+        return jsonify({'error': f'Tamaño no soportado: {qr_size}'}), 400
+
+    include_logo = request.args.get('include_logo', 'true') != 'false'
+    try:
+        logo_url = resolver_logo(data, request.args.get('logo'), include_logo)
+    except LogoUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+
+    # Misma cota que la admisión de /qr_image: lo que no cabe se rechaza antes de codificar
+    if not cabe_en_qr(data):
+        return jsonify({'error': 'Contenido demasiado largo para un QR'}), 413
+    try:
+        contenido = matriz_cliente(data, logo_url, qr_size)
+    except qrcode.exceptions.DataOverflowError:
+        # La versión fija de qr_size puede quedarse corta aunque quepa en una mayor
+        return jsonify({'error': 'Contenido demasiado largo para un QR'}), 413
+    return Response(contenido, mimetype='application/json')
+
+@app.route('/qr_preview')
+def qr_preview():
+    """Vista previa rápida (PNG pequeño, o la matriz con format=matrix) para pedir mientras se escribe"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+
+    data = request.args.get('data')
+    if not data:
+        return jsonify({'error': 'Falta el parámetro data'}), 400
+
+    qr_size = request.args.get('qr_size', 'medium')
+    include_logo = request.args.get('include_logo', 'true') != 'false'
+    gradient = request.args.get('gradient')
+    finder_color = request.args.get('finder_color')
+    try:
+        logo_url = resolver_logo(data, request.args.get('logo'), include_logo)
+        if gradient:
+            parsear_degradado(gradient)
+        if finder_color and not re.fullmatch(r'#?[0-9a-fA-F]{6}', finder_color):
+            raise ValueError(f"Color de patrones inválido: {finder_color}")
+        if request.args.get('format') == 'matrix':
+            return Response(matriz_cliente(data, logo_url, qr_size), mimetype='application/json')
+        contenido = generar_preview(
+            data, request.args.get('bg_color', '#ffffff'), request.args.get('qr_color', '#000000'),
+            request.args.get('qr_style', 'square'), qr_size, logo_url, gradient, finder_color
+        )
+    except LogoUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except (ValueError, qrcode.exceptions.DataOverflowError) as e:
+        return jsonify({'error': str(e) or 'Contenido demasiado largo para un QR'}), 400
+
+    respuesta = Response(contenido, mimetype='image/png')
+    respuesta.headers['Cache-Control'] = 'private, max-age=60'
+    return respuesta
+
+@app.route('/qr_append', methods=['GET', 'POST'])
+def qr_append():
+    """Reparte cargas grandes en símbolos de anexo estructurado: mosaico o ZIP"""
+    if not is_authenticated():
+        return jsonify({'error': 'No autenticado'}), 401
+
+    data = request.values.get('data', '')
+    if not data:
+        return jsonify({'error': 'Falta data'}), 400
+    if len(data) > APPEND_MAX_CHARS:
+        return jsonify({'error': f'Máximo {APPEND_MAX_CHARS} caracteres por petición'}), 413
+    layout = request.values.get('layout', 'tiled')
+    formato = request.values.get('format', 'png')
+    if layout not in APPEND_LAYOUTS:
+        return jsonify({'error': f"layout debe ser uno de: {', '.join(APPEND_LAYOUTS)}"}), 400
+    if formato not in ('png', 'webp'):
+        return jsonify({'error': 'El mosaico solo está disponible en PNG y WebP'}), 400
+    try:
+        max_version = int(request.values.get('max_version', APPEND_MAX_VERSION))
+        if not 1 <= max_version <= APPEND_MAX_VERSION:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': f'max_version debe estar entre 1 y {APPEND_MAX_VERSION}'}), 400
+
+    try:
+        contenido, versiones = generar_anexo(
+            data, request.values.get('bg_color', '#ffffff'), request.values.get('qr_color', '#000000'),
+            request.values.get('qr_style', 'square'), request.values.get('qr_size', 'medium'),
+            formato, layout, max_version
+        )
+    except qrcode.exceptions.DataOverflowError as e:
+        return jsonify({'error': str(e)}), 413
+
+    if layout == "set":
+        respuesta = Response(contenido, mimetype='application/zip')
+        respuesta.headers['Content-Disposition'] = 'attachment; filename="qr_anexo.zip"'
+    else:
+        respuesta = Response(contenido, mimetype=FORMATOS_IMAGEN[formato])
+    respuesta.headers['X-QR-Symbols'] = str(len(versiones))
+    respuesta.headers['X-QR-Versions'] = ','.join(map(str, versiones))
+    return respuesta
+
+@app.route('/admin/memory')
+def admin_memory():
+    """Reporte de memoria por subsistema (solo administradores)"""
+    if not is_admin():
+        return jsonify({'error': 'No autorizado'}), 403
+    return jsonify(reporte_memoria())
+
+@app.route('/admin/memory/baseline', methods=['POST', 'DELETE'])
+def admin_memory_baseline():
+    """POST toma la instantánea de referencia de tracemalloc; DELETE lo detiene"""
+    if not is_admin():
+        return jsonify({'error': 'No autorizado'}), 403
+    if request.method == 'DELETE':
+        detener_tracemalloc()
+    else:
+        tomar_baseline_memoria(request.args.get('frames', 10, type=int))
+    return jsonify({'success': True})
+
+@app.route('/admin/memory/diff')
+def admin_memory_diff():
+    """Diferencias de tracemalloc contra la baseline"""
+    if not is_admin():
+        return jsonify({'error': 'No autorizado'}), 403
+
+    agrupar = request.args.get('group', 'lineno')
+    if agrupar not in ('lineno', 'traceback', 'filename'):
+        return jsonify({'error': f'Agrupación no soportada: {agrupar}'}), 400
+    diferencias = diff_memoria(agrupar, request.args.get('limit', 20, type=int))
+    if diferencias is None:
+        return jsonify({'error': 'No hay baseline; haz POST /admin/memory/baseline primero'}), 409
+    return jsonify(diferencias)
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
@@ -1088,13 +5326,18 @@ def index():
         logo_url = obtener_logo(tipo) if include_logo else None
         user_id = get_user_id()
 
-        # Inicializar historial del usuario si no existe
-        if user_id not in user_qr_history:
-            user_qr_history[user_id] = []
+        rechazo, opciones = respuesta_admision(
+            data, {'qr_style': qr_style, 'qr_size': qr_size},
+            {'data': data, 'logo_url': logo_url, 'bg_color': bg_color, 'qr_color': qr_color,
+             'include_logo': include_logo, 'formato': 'png'}
+        )
+        if rechazo is not None:
+            return rechazo
+        qr_style, qr_size = opciones['qr_style'], opciones['qr_size']
 
         # Agregar al historial del usuario
         from datetime import datetime
-        user_qr_history[user_id].append({
+        almacen.agregar_historial(user_id, {
             'data': data,
             'type': tipo,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -1102,14 +5345,18 @@ def index():
             'colors': 'Estándar'
         })
 
-        img = generar_qr_personalizado(data, logo_url, bg_color, qr_color, qr_style, qr_size, include_logo)
-        buf = io.BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
+        try:
+            png, degradado = render_qr_interactivo(data, logo_url, bg_color, qr_color, qr_style, qr_size, include_logo)
+        except RenderTimeoutError as e:
+            log.warning("Render cancelado", extra={'error': str(e)})
+            return jsonify({'error': 'El QR tardó demasiado en generarse, inténtalo de nuevo'}), 503
 
         # Codificar imagen en base64 para mostrarla en HTML
-        buf.seek(0)
-        img_base64 = base64.b64encode(buf.read()).decode()
+        img_base64 = base64.b64encode(png).decode()
+        aviso_degradado = (
+            '<div class="aviso-degradado">⏳ El logo no llegó a tiempo: este QR va sin logo. '
+            'Vuelve a generarlo en unos segundos para tenerlo con logo.</div>'
+        ) if degradado else ''
 
         # Mostrar página con QR y opciones PRO
         qr_result_html = f'''
@@ -1145,6 +5392,13 @@ def index():
                     font-size: 2.5em;
                     text-shadow: 2px 2px 4px rgba(0,0,0,0.1);
                 }}
+                .aviso-degradado {{
+                    background: #fffbeb;
+                    color: #92400e;
+                    border-radius: 10px;
+                    padding: 10px 15px;
+                    margin-top: 20px;
+                }}
                 .qr-image {{
                     max-width: 300px;
                     width: 100%;
@@ -1408,6 +5662,7 @@ def index():
                     <div class="content-text">{data}</div>
                     <strong>🏷️ Tipo:</strong> {tipo}
                 </div>
+                {aviso_degradado}
                 <img src="data:image/png;base64,{img_base64}" alt="Código QR" class="qr-image" id="qrImage">
 
                 <!-- PRO Customization Section -->
@@ -1547,46 +5802,123 @@ def index():
                 </div>
 
                 <button onclick="location.href='/'">🔙 Volver al Inicio</button>
-                <a href="data:image/png;base64,{img_base64}" download="qr_code.png">
+                <a href="data:image/png;base64,{img_base64}" download="qr_code.png" id="downloadLink">
                     <button class="download-btn">📥 Descargar QR</button>
                 </a>
             </div>
 
             <script>
-                function customizeQR() {
+                // Render en el navegador: se pide la matriz una vez por (tamaño, logo)
+                // y los colores se aplican aquí sin volver al servidor
+                const matrices = new Map();
+
+                function leerOpciones() {{
                     const form = document.getElementById('customizeForm');
-                    const formData = new FormData(form);
+                    return {{
+                        data: form.elements['data'].value,
+                        qr_color: form.elements['qr_color'].value,
+                        bg_color: form.elements['bg_color'].value,
+                        qr_size: form.elements['qr_size'].value,
+                        include_logo: document.getElementById('include_logo').checked
+                    }};
+                }}
 
-                    // Crear URL con parámetros
-                    const params = new URLSearchParams();
-                    for (let [key, value] of formData.entries()) {{
-                        params.append(key, value);
+                function obtenerMatriz(opciones) {{
+                    const params = new URLSearchParams({{
+                        data: opciones.data,
+                        qr_size: opciones.qr_size,
+                        include_logo: opciones.include_logo ? 'true' : 'false'
+                    }});
+                    const clave = params.toString();
+                    if (!matrices.has(clave)) {{
+                        matrices.set(clave, fetch('/qr_matrix?' + clave).then(r => {{
+                            if (!r.ok) {{
+                                matrices.delete(clave);
+                                throw new Error('Error ' + r.status);
+                            }}
+                            return r.json();
+                        }}));
                     }}
+                    return matrices.get(clave);
+                }}
 
-                    // Enviar como POST
-                    const form2 = document.createElement('form');
-                    form2.method = 'POST';
-                    form2.action = '/';
-
-                    for (let [key, value] of formData.entries()) {{
-                        const input = document.createElement('input');
-                        input.type = 'hidden';
-                        input.name = key;
-                        input.value = value;
-                        form2.appendChild(input);
+                function cargarImagen(url) {{
+                    return new Promise((resolve, reject) => {{
+                        const img = new Image();
+                        img.crossOrigin = 'anonymous';
+                        img.onload = () => resolve(img);
+                        img.onerror = reject;
+                        img.src = url;
+                    }});
+                }}
+
+                async function pintarQR(info, opciones) {{
+                    const bits = Uint8Array.from(atob(info.matrix), c => c.charCodeAt(0));
+                    const canvas = document.createElement('canvas');
+                    canvas.width = canvas.height = info.size_px;
+                    const ctx = canvas.getContext('2d');
+                    ctx.fillStyle = opciones.bg_color;
+                    ctx.fillRect(0, 0, info.size_px, info.size_px);
+                    ctx.fillStyle = opciones.qr_color;
+                    for (let i = 0; i < info.modules * info.modules; i++) {{
+                        if (bits[i >> 3] & (0x80 >> (i & 7))) {{
+                            const x = (i % info.modules) * info.box_size;
+                            const y = Math.floor(i / info.modules) * info.box_size;
+                            ctx.fillRect(x, y, info.box_size, info.box_size);
+                        }}
+                    }}
+                    if (info.logo) {{
+                        try {{
+                            const logo = await cargarImagen(info.logo.url);
+                            const w = info.logo.width;
+                            const h = Math.floor(logo.naturalHeight * w / logo.naturalWidth);
+                            ctx.drawImage(logo, info.logo.center[0] - Math.ceil(w / 2), info.logo.center[1] - Math.ceil(h / 2), w, h);
+                        }} catch (e) {{
+                            console.warn('No se pudo cargar el logo', e);
+                        }}
                     }}
+                    return canvas;
+                }}
 
-                    document.body.appendChild(form2);
-                    form2.submit();
+                async function customizeQR() {{
+                    const opciones = leerOpciones();
+                    try {{
+                        const canvas = await pintarQR(await obtenerMatriz(opciones), opciones);
+                        const url = canvas.toDataURL('image/png');
+                        document.getElementById('qrImage').src = url;
+                        document.getElementById('downloadLink').href = url;
+                    }} catch (e) {{
+                        console.error('Error al personalizar el QR', e);
+                    }}
                 }}
+
+                document.getElementById('customizeForm').addEventListener('change', customizeQR);
             </script>
         </body>
         </html>'''
-        return render_template_string(qr_result_html)
+        respuesta = Response(render_template_string(qr_result_html), mimetype='text/html')
+        if degradado:
+            # Igual que /qr_image: la página lleva el QR sin logo y no debe cachearse
+            respuesta.headers['X-QR-Degraded'] = 'logo'
+            respuesta.headers['Cache-Control'] = 'no-store'
+        return respuesta
 
     return render_template_string(HTML)
 # Run the app in debug mode so you can easily iterate.
 
+# Comandos de mantenimiento: python main.py <comando> [argumentos]
+COMANDOS = {
+    'bench-formatos': benchmark_formatos,
+    'bench-segmentos': benchmark_segmentos,
+    'lote': generar_lote,
+    'bench-coste': benchmark_coste,
+    'bench-buffers': benchmark_buffers,
+    'bench-codificador': benchmark_codificador
+}
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    if len(sys.argv) > 1 and sys.argv[1] in COMANDOS:
+        COMANDOS[sys.argv[1]](sys.argv[2:])
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=True)
     
\ No newline at end of file
@@ -0,0 +1,139 @@
+"""Backends de almacenamiento: en proceso y Redis (contra un servidor fakeredis por TCP)"""
+import socket
+import threading
+
+import pytest
+
+import main
+
+redis = pytest.importorskip("redis")
+fakeredis = pytest.importorskip("fakeredis")
+
+SHA = "a" * 64
+
+
+@pytest.fixture
+def servidor_redis():
+    servidor = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    host, puerto = servidor.server_address
+    yield f"redis://{host}:{puerto}/0"
+    servidor.shutdown()
+    servidor.server_close()
+
+
+@pytest.fixture
+def almacen_redis(servidor_redis):
+    almacen = main.AlmacenRedis(servidor_redis, main.RenderCache(1024 * 1024))
+    yield almacen
+    almacen.pool.disconnect()
+
+
+@pytest.fixture
+def almacen_caido():
+    # Un puerto recién liberado: la conexión se rechaza al momento
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        puerto = s.getsockname()[1]
+    almacen = main.AlmacenRedis(f"redis://127.0.0.1:{puerto}/0", main.RenderCache(1024 * 1024))
+    yield almacen
+    almacen.pool.disconnect()
+
+
+def test_local_renders_historial_y_logos(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "LOGO_STORE_DIR", str(tmp_path))
+    almacen = main.AlmacenLocal(main.RenderCache(1024), {})
+
+    almacen.guardar_render(("a",), b"png-a")
+    assert almacen.leer_renders([("a",), ("b",)]) == [b"png-a", None]
+
+    almacen.agregar_historial("u1", {"data": "x"})
+    historial = almacen.leer_historial("u1")
+    historial.append({"data": "y"})
+    assert almacen.leer_historial("u1") == [{"data": "x"}]
+    assert almacen.leer_historial("u2") == []
+    almacen.borrar_historial("u1")
+    assert almacen.leer_historial("u1") == []
+
+    assert not almacen.existe_logo(SHA)
+    assert almacen.leer_logo(SHA) is None
+    almacen.guardar_logo(SHA, b"logo")
+    assert almacen.existe_logo(SHA)
+    assert almacen.leer_logo(SHA) == b"logo"
+
+
+def test_redis_renders_por_lotes_en_pipeline(servidor_redis, almacen_redis, monkeypatch):
+    monkeypatch.setattr(main, "STORAGE_PIPELINE_BATCH", 3)
+    claves = [("qr", i) for i in range(7)]
+    for clave in claves[::2]:
+        almacen_redis.guardar_render(clave, repr(clave).encode())
+
+    # Otro nodo: caché local vacía, mismo Redis
+    otro = main.AlmacenRedis(servidor_redis, main.RenderCache(1024 * 1024))
+    ejecuciones = []
+    pipeline = otro.cliente.pipeline
+
+    def pipeline_espia(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        pipe.execute = lambda: ejecuciones.append(len(pipe.command_stack)) or execute()
+        return pipe
+
+    monkeypatch.setattr(otro.cliente, "pipeline", pipeline_espia)
+    esperado = [repr(clave).encode() if i % 2 == 0 else None for i, clave in enumerate(claves)]
+    assert otro.leer_renders(claves) == esperado
+    assert ejecuciones == [3, 3, 1]
+
+    # Los aciertos quedan en la caché local: la segunda lectura solo pide los fallos
+    ejecuciones.clear()
+    assert otro.leer_renders(claves) == esperado
+    assert ejecuciones == [3]
+    otro.pool.disconnect()
+
+
+def test_redis_render_con_ttl(almacen_redis):
+    almacen_redis.guardar_render(("ttl",), b"png")
+    ttl = almacen_redis.cliente.ttl(almacen_redis._clave_render(("ttl",)))
+    assert main.STORAGE_RENDER_TTL - 5 <= ttl <= main.STORAGE_RENDER_TTL
+
+
+def test_redis_historial(almacen_redis):
+    almacen_redis.agregar_historial("u1", {"data": "x"})
+    almacen_redis.agregar_historial("u1", {"data": "y"})
+    assert almacen_redis.leer_historial("u1") == [{"data": "x"}, {"data": "y"}]
+    almacen_redis.borrar_historial("u1")
+    assert almacen_redis.leer_historial("u1") == []
+
+
+def test_redis_logo_no_sobrescribe(almacen_redis):
+    assert not almacen_redis.existe_logo(SHA)
+    almacen_redis.guardar_logo(SHA, b"primero")
+    almacen_redis.guardar_logo(SHA, b"segundo")
+    assert almacen_redis.existe_logo(SHA)
+    assert almacen_redis.leer_logo(SHA) == b"primero"
+
+
+def test_redis_caido_degrada(almacen_caido):
+    almacen_caido.guardar_render(("a",), b"png-a")
+    assert almacen_caido.leer_render(("a",)) == b"png-a"
+    assert almacen_caido.leer_render(("b",)) is None
+
+    almacen_caido.agregar_historial("u1", {"data": "x"})
+    assert almacen_caido.leer_historial("u1") == []
+    with pytest.raises(main.AlmacenNoDisponible):
+        almacen_caido.borrar_historial("u1")
+
+    with pytest.raises(main.LogoUploadError) as error:
+        almacen_caido.existe_logo(SHA)
+    assert error.value.status == 503
+
+
+def test_rutas_con_redis_caido(almacen_caido, monkeypatch):
+    monkeypatch.setattr(main, "almacen", almacen_caido)
+    cliente = main.app.test_client()
+    cabeceras = {"X-Replit-User-Id": "1"}
+
+    assert cliente.get("/history", headers=cabeceras).get_json() == []
+    assert cliente.post("/clear_history", headers=cabeceras).status_code == 503
+    assert cliente.get(f"/logos/{SHA}", headers=cabeceras).status_code == 503
@@ -0,0 +1,36 @@
+"""Seguimiento de popularidad del precalentado"""
+import main
+
+
+def _args(clave):
+    return (clave, None, "#ffffff", "#000000", "square", "medium", True, "png", None, None, None)
+
+
+def _pedir(calentador, clave, veces):
+    for _ in range(veces):
+        calentador.registrar(clave, _args(clave))
+
+
+def test_una_peticion_suelta_no_expulsa_al_top():
+    calentador = main.CalentadorRenders(top_k=3)
+    for clave in "abc":
+        _pedir(calentador, clave, 100)
+
+    _pedir(calentador, "x", 1)
+    assert set(calentador.top) == {'"a"', '"b"', '"c"'}
+
+    # Solo entra cuando supera al menos popular del top actual
+    _pedir(calentador, "x", 150)
+    assert '"x"' in calentador.top and len(calentador.top) == 3
+
+
+def test_umbral_sigue_al_minimo_del_top():
+    calentador = main.CalentadorRenders(top_k=2)
+    _pedir(calentador, "a", 5)
+    _pedir(calentador, "b", 3)
+    assert calentador._umbral == 3
+
+    _pedir(calentador, "b", 10)
+    assert calentador._umbral == 5
+    _pedir(calentador, "c", 4)
+    assert set(calentador.top) == {'"a"', '"b"'}
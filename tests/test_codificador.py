@@ -0,0 +1,182 @@
+"""El codificador numpy debe dar exactamente lo mismo que qrcode, y los contenedores en streaming deben decodificar"""
+import io
+import random
+import zlib
+
+import numpy as np
+import pytest
+import qrcode
+from PIL import Image
+from qrcode import util as qrutil
+
+import main
+
+NIVELES = [
+    qrcode.constants.ERROR_CORRECT_L,
+    qrcode.constants.ERROR_CORRECT_M,
+    qrcode.constants.ERROR_CORRECT_Q,
+    qrcode.constants.ERROR_CORRECT_H,
+]
+VERSIONES = [1, 2, 6, 7, 10, 14, 21, 27, 34, 40]
+
+
+def _carga_llena(version, nivel, semilla):
+    """Texto en modo byte que llena justo la versión para ese nivel"""
+    bits = qrutil.BIT_LIMIT_TABLE[nivel][version]
+    longitud = (bits - 4 - qrutil.length_in_bits(qrutil.MODE_8BIT_BYTE, version)) // 8
+    azar = random.Random(semilla)
+    return "".join(azar.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(longitud))
+
+
+def _qr_bytes(data, nivel, mascara=None):
+    qr = qrcode.QRCode(error_correction=nivel, mask_pattern=mascara)
+    qr.add_data(qrutil.QRData(data.encode("ascii"), mode=qrutil.MODE_8BIT_BYTE, check_data=False))
+    return qr
+
+
+def _mismo_resultado(referencia, resultado):
+    assert resultado.version == referencia.version
+    assert resultado.data_cache == referencia.data_cache
+    assert resultado.get_matrix() == referencia.get_matrix()
+
+
+@pytest.mark.parametrize("nivel", NIVELES)
+@pytest.mark.parametrize("version", VERSIONES)
+def test_compilar_qr_igual_que_qrcode(version, nivel):
+    data = _carga_llena(version, nivel, version * 10 + nivel)
+    referencia = _qr_bytes(data, nivel)
+    referencia.make(fit=True)
+    resultado = _qr_bytes(data, nivel)
+    main.compilar_qr(resultado)
+    assert resultado.version == version
+    _mismo_resultado(referencia, resultado)
+
+
+@pytest.mark.parametrize("mascara", range(8))
+def test_compilar_qr_con_mascara_fija(mascara):
+    data = _carga_llena(8, qrcode.constants.ERROR_CORRECT_Q, mascara)
+    referencia = _qr_bytes(data, qrcode.constants.ERROR_CORRECT_Q, mascara)
+    referencia.make(fit=True)
+    resultado = _qr_bytes(data, qrcode.constants.ERROR_CORRECT_Q, mascara)
+    main.compilar_qr(resultado)
+    _mismo_resultado(referencia, resultado)
+
+
+@pytest.mark.parametrize("data", main.SEGMENT_BENCH_PAYLOADS)
+def test_compilar_qr_con_segmentos_mixtos(data):
+    referencia = qrcode.QRCode()
+    main.agregar_datos(referencia, data)
+    referencia.make(fit=True)
+    resultado = qrcode.QRCode()
+    main.agregar_datos(resultado, data)
+    main.compilar_qr(resultado)
+    _mismo_resultado(referencia, resultado)
+
+
+def test_penalizaciones_iguales_que_lost_point():
+    qr = _qr_bytes(_carga_llena(5, qrcode.constants.ERROR_CORRECT_M, 1), qrcode.constants.ERROR_CORRECT_M)
+    main.compilar_qr(qr)
+    base, filas, columnas, mascaras = main.plantilla_qr(qr.version)
+    matrices = np.repeat(base[None], 8, axis=0)
+    bits = np.zeros(len(filas), dtype=bool)
+    bits[:len(qr.data_cache) * 8] = np.unpackbits(np.array(qr.data_cache, dtype=np.uint8))[:len(filas)]
+    matrices[:, filas, columnas] = bits[None] ^ mascaras
+    esperado = [qrutil.lost_point(m.tolist()) for m in matrices]
+    assert main.penalizaciones_mascaras(matrices).tolist() == esperado
+
+
+@pytest.mark.parametrize("ec", [7, 10, 18, 30])
+def test_paridad_rs_igual_que_division(ec):
+    datos = np.random.default_rng(ec).integers(0, 256, size=(5, 40), dtype=np.uint8)
+    datos[0] = 0
+    assert np.array_equal(main.codificar_bloques_rs(datos, ec), main.dividir_rs(datos, ec))
+
+
+@pytest.mark.parametrize("data", main.SEGMENT_BENCH_PAYLOADS + ["", "0", "12345678901234567890", "ÁÉÍÓÚ ñ"])
+@pytest.mark.parametrize("version", [1, 10, 27])
+def test_segmentacion_optima(data, version):
+    segmentos, bits = main.segmentar_optimo(data, version)
+    assert "".join(texto for _, texto in segmentos) == data
+
+    # Los bits calculados son los que se escriben de verdad
+    escritos = sum(
+        len(main._bits_segmento(qrutil.QRData(texto.encode("utf-8"), mode=modo, check_data=False), version))
+        for modo, texto in segmentos
+    )
+    assert bits == escritos
+
+    # Y nunca más que un único segmento en modo byte
+    if data:
+        unico = qrutil.QRData(data.encode("utf-8"), mode=qrutil.MODE_8BIT_BYTE, check_data=False)
+        assert bits <= len(main._bits_segmento(unico, version))
+
+
+def test_adler32_combine():
+    azar = random.Random(0)
+    trozos = [bytes(azar.getrandbits(8) for _ in range(n)) for n in (0, 1, 1000, 65521, 70000)]
+    adler = 1
+    for trozo in trozos:
+        adler = main._adler32_combine(adler, zlib.adler32(trozo), len(trozo))
+    assert adler == zlib.adler32(b"".join(trozos))
+
+
+@pytest.mark.parametrize("formato", ["png", "tiff"])
+def test_impresion_por_franjas_decodifica(formato, monkeypatch):
+    # Franjas pequeñas para que haya muchas y la última quede incompleta
+    monkeypatch.setattr(main, "PRINT_STRIP_BYTES", 30000)
+    contenido = b"".join(main.exportar_impresion("https://example.com", 3, 300, formato, workers=1))
+    imagen = Image.open(io.BytesIO(contenido))
+    imagen.load()
+    assert imagen.format == formato.upper()
+    assert imagen.size == (354, 354)
+
+    # Igual que escalar la matriz entera de una vez
+    qr = qrcode.QRCode(border=4)
+    main.agregar_datos(qr, "https://example.com")
+    main.compilar_qr(qr)
+    matriz = np.array(qr.get_matrix(), dtype=np.uint8)
+    modulos = Image.fromarray(np.where(matriz, 0, 255).astype(np.uint8))
+    esperado = modulos.resize(imagen.size, Image.NEAREST).convert("RGB")
+    assert imagen.convert("RGB").tobytes() == esperado.tobytes()
+
+
+def test_impresion_en_pool_igual_que_en_hilo(monkeypatch):
+    monkeypatch.setattr(main, "PRINT_STRIP_BYTES", 30000)
+    monkeypatch.setattr(main, "PRINT_WORKERS", 2)
+    en_hilo = b"".join(main.exportar_impresion("https://example.com", 3, 300, "png", workers=1))
+    en_pool = b"".join(main.exportar_impresion("https://example.com", 3, 300, "png"))
+    assert en_pool == en_hilo
+
+
+def _visitante(azar):
+    return azar.getrandbits(64)
+
+
+def test_escaneos_fusion_igual_que_registro_unico():
+    azar = random.Random(0)
+    ahora = 1_700_000_000
+    eventos = [(_visitante(azar), ahora + azar.randrange(0, 120 * 86400)) for _ in range(3000)]
+    eventos.sort(key=lambda e: e[1])
+
+    unica = main.EstadisticasEscaneo()
+    partes = [main.EstadisticasEscaneo(), main.EstadisticasEscaneo()]
+    for i, (visitante, instante) in enumerate(eventos):
+        unica.registrar(visitante, instante)
+        partes[i % 2].registrar(visitante, instante)
+
+    fusion = main.EstadisticasEscaneo.desde_bytes(partes[0].a_bytes())
+    fusion.fusionar(main.EstadisticasEscaneo.desde_bytes(partes[1].a_bytes()))
+    assert fusion.total == unica.total
+    assert np.array_equal(fusion.registros, unica.registros)
+    fin = eventos[-1][1]
+    assert fusion.resumen(fin) == unica.resumen(fin)
+
+
+def test_escaneos_unicos_aproximados():
+    azar = random.Random(1)
+    estadisticas = main.EstadisticasEscaneo()
+    visitantes = [_visitante(azar) for _ in range(20000)]
+    for i in range(40000):
+        estadisticas.registrar(visitantes[i % len(visitantes)], 1_700_000_000 + i)
+    assert abs(estadisticas.unicos() - 20000) < 20000 * 0.1
+    assert len(estadisticas.a_bytes()) == 1592
@@ -0,0 +1,26 @@
+"""Identificación de visitantes para los únicos de /s/<codigo>"""
+import main
+
+
+def _hash(cabeceras, remoto="203.0.113.7"):
+    with main.app.test_request_context("/s/x", headers=cabeceras, environ_base={"REMOTE_ADDR": remoto}):
+        return main.hash_visitante()
+
+
+def test_x_forwarded_for_no_cambia_el_visitante(monkeypatch):
+    monkeypatch.setattr(main, "SCANS_SALT", "sal-de-prueba")
+    base = _hash({"User-Agent": "movil"})
+    assert _hash({"User-Agent": "movil", "X-Forwarded-For": "198.51.100.1"}) == base
+    assert _hash({"User-Agent": "movil", "X-Forwarded-For": "198.51.100.2"}) == base
+    assert _hash({"User-Agent": "movil"}, remoto="203.0.113.8") != base
+
+
+def test_sin_sal_no_hay_hash(monkeypatch):
+    monkeypatch.setattr(main, "SCANS_SALT", "")
+    assert _hash({"User-Agent": "movil"}) is None
+
+    estadisticas = main.EstadisticasEscaneo()
+    estadisticas.registrar(None, 1_700_000_000)
+    assert estadisticas.total == 1
+    assert estadisticas.unicos() == 0
+    assert estadisticas.resumen(1_700_000_000)["por_hora"][-1] == 1
@@ -0,0 +1,31 @@
+"""Filtro de logs: la limitación de repetidos es opcional por llamada"""
+import logging
+
+import main
+
+
+def _registro(msg, *args, **extra):
+    registro = logging.makeLogRecord({"msg": msg, "args": args, "levelno": logging.ERROR, "levelname": "ERROR"})
+    registro.__dict__.update(extra)
+    return registro
+
+
+def test_sin_limitar_se_emite_siempre():
+    filtro = main.FiltroContexto()
+    assert filtro.filter(_registro("Trabajo fallido", error="disk full"))
+    assert filtro.filter(_registro("Trabajo fallido", error="bad template"))
+    assert filtro.filter(_registro("Trabajo fallido", error="bad template"))
+    assert filtro.suprimidos == 0
+
+
+def test_limitar_por_clave():
+    filtro = main.FiltroContexto()
+    assert filtro.filter(_registro("Error al descargar logo %s", "http://a", limitar="http://a"))
+    assert not filtro.filter(_registro("Error al descargar logo %s", "http://a", limitar="http://a"))
+    assert filtro.filter(_registro("Error al descargar logo %s", "http://b", limitar="http://b"))
+    assert filtro.suprimidos == 1
+
+    # La clave no acaba como campo del evento
+    registro = _registro("Error al descargar logo %s", "http://c", limitar="http://c")
+    filtro.filter(registro)
+    assert not hasattr(registro, "limitar")
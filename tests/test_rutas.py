@@ -0,0 +1,123 @@
+"""Rutas HTTP: autenticación, límites y marcas de respuesta degradada"""
+import pytest
+
+import main
+
+CABECERAS = {"X-Replit-User-Id": "1"}
+
+
+@pytest.fixture
+def cliente():
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize("degradado", [False, True])
+def test_index_marca_qr_sin_logo(cliente, monkeypatch, degradado):
+    png = main.renderizar_qr("https://example.com", include_logo=False)
+    monkeypatch.setattr(main, "render_qr_interactivo", lambda *args, **kwargs: (png, degradado))
+
+    respuesta = cliente.post("/", data={"data": "https://example.com"}, headers=CABECERAS)
+    assert respuesta.status_code == 200
+    assert (respuesta.headers.get("X-QR-Degraded") == "logo") is degradado
+    assert (respuesta.headers.get("Cache-Control") == "no-store") is degradado
+    assert ("aviso-degradado\">" in respuesta.get_data(as_text=True)) is degradado
+
+
+def test_jobs_no_acepta_render(cliente, monkeypatch):
+    monkeypatch.setattr(main, "obtener_cola_trabajos", lambda: object())
+    respuesta = cliente.post("/jobs", json={"tipo": "render", "payloads": ["x"]}, headers=CABECERAS)
+    assert respuesta.status_code == 400
+    assert "render" not in respuesta.get_json()["error"]
+
+
+def test_qr_append_requiere_autenticacion(cliente):
+    assert cliente.get("/qr_append", query_string={"data": "hola"}).status_code == 401
+
+
+def test_qr_append_limites(cliente, monkeypatch):
+    monkeypatch.setattr(main, "APPEND_MAX_CHARS", 100)
+    respuesta = cliente.get("/qr_append", query_string={"data": "x" * 101}, headers=CABECERAS)
+    assert respuesta.status_code == 413
+
+    respuesta = cliente.get("/qr_append", query_string={"data": "x", "max_version": main.APPEND_MAX_VERSION + 1},
+                            headers=CABECERAS)
+    assert respuesta.status_code == 400
+
+    # Más de lo que caben 16 símbolos: se rechaza sin planificar
+    assert main.plan_anexo("1" * 700, max_version=1) is None
+
+
+def test_qr_append_mosaico(cliente):
+    data = "".join(chr(ord("a") + i % 26) for i in range(1200))
+    respuesta = cliente.get("/qr_append", query_string={"data": data, "max_version": 10}, headers=CABECERAS)
+    assert respuesta.status_code == 200
+    assert respuesta.mimetype == "image/png"
+    versiones = respuesta.headers["X-QR-Versions"].split(",")
+    assert int(respuesta.headers["X-QR-Symbols"]) == len(versiones) > 1
+    assert all(int(v) <= 10 for v in versiones)
+
+
+def test_label_sheet_rechaza_contenido_que_no_cabe(cliente):
+    respuesta = cliente.post("/label_sheet", json={"payloads": ["ok", "x" * 4000]}, headers=CABECERAS)
+    assert respuesta.status_code == 413
+    assert respuesta.get_json()["indice"] == 1
+
+
+def test_label_sheet_pdf_completo(cliente):
+    respuesta = cliente.post("/label_sheet", json={"payloads": ["a", "b", "1" * 5000]}, headers=CABECERAS)
+    assert respuesta.status_code == 200
+    assert respuesta.data.startswith(b"%PDF") and respuesta.data.rstrip().endswith(b"%%EOF")
+
+
+def test_jobs_etiquetas_rechaza_contenido_que_no_cabe(cliente, monkeypatch):
+    monkeypatch.setattr(main, "obtener_cola_trabajos", lambda: object())
+    respuesta = cliente.post("/jobs", json={"tipo": "etiquetas", "payloads": ["x" * 4000]}, headers=CABECERAS)
+    assert respuesta.status_code == 400
+
+
+@pytest.mark.parametrize("parametros, status", [
+    ({"data": "x" * 4000}, 413),
+    ({"data": "hola", "ancho_cm": "inf"}, 400),
+    ({"data": "hola", "ancho_cm": "nan"}, 400),
+    ({"data": "hola", "ancho_cm": "-inf"}, 400),
+    ({"data": "hola", "dpi": "inf"}, 400),
+    ({"data": "hola", "ancho_cm": "1000"}, 400),
+    ({"data": "hola", "formato": "gif"}, 400),
+])
+def test_print_export_rechaza_parametros(cliente, parametros, status):
+    respuesta = cliente.get("/print_export", query_string=parametros, headers=CABECERAS)
+    assert respuesta.status_code == status
+    assert "error" in respuesta.get_json()
+
+
+def test_print_export_descarga(cliente):
+    respuesta = cliente.get("/print_export", query_string={"data": "hola", "ancho_cm": "2", "dpi": "150",
+                                                           "include_logo": "false"}, headers=CABECERAS)
+    assert respuesta.status_code == 200
+    assert respuesta.mimetype == "image/png"
+    assert respuesta.data.startswith(b"\x89PNG")
+
+
+def test_validar_impresion_no_finitos():
+    for ancho_cm, dpi in [(float("inf"), 300), (10, float("inf")), (float("nan"), 300)]:
+        with pytest.raises(ValueError):
+            main.validar_impresion(ancho_cm, dpi, "png")
+
+
+@pytest.mark.parametrize("longitud", [4000, 100000])
+def test_qr_matrix_contenido_que_no_cabe(cliente, longitud):
+    respuesta = cliente.get("/qr_matrix", query_string={"data": "x" * longitud}, headers=CABECERAS)
+    assert respuesta.status_code == 413
+
+
+def test_qr_matrix(cliente):
+    respuesta = cliente.get("/qr_matrix", query_string={"data": "hola", "include_logo": "false"}, headers=CABECERAS)
+    assert respuesta.status_code == 200
+    assert respuesta.get_json()["version"] == 1
+
+
+def test_cabe_en_qr():
+    assert main.cabe_en_qr("1" * 5596)
+    assert not main.cabe_en_qr("1" * 5597)
+    assert main.cabe_en_qr("x" * 2331)
+    assert not main.cabe_en_qr("x" * 2332)
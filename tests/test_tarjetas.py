@@ -0,0 +1,34 @@
+"""Tarjetas: el QR va a píxeles enteros por módulo, centrado en el hueco"""
+import io
+
+import numpy as np
+import pytest
+import qrcode
+from PIL import Image
+
+import main
+
+
+@pytest.mark.parametrize("qr_size", ["small", "medium", "large"])
+@pytest.mark.parametrize("data", ["https://example.com", "x" * 300])
+def test_modulos_enteros_en_la_tarjeta(qr_size, data):
+    contenido = main.renderizar_qr(data, include_logo=False, qr_size=qr_size, card="clasica")
+    tarjeta = np.array(Image.open(io.BytesIO(contenido)).convert("RGB"))
+
+    config = main.QR_SIZE_MAP[qr_size]
+    qr = qrcode.QRCode(version=config["version"], border=config["border"])
+    main.agregar_datos(qr, data)
+    main.compilar_qr(qr)
+    matriz = np.array(qr.get_matrix(), dtype=bool)
+
+    x, y, lado = main.geometria_tarjeta(main.CARD_WIDTHS[qr_size])["hueco"]
+    pixeles = lado // len(matriz)
+    esperado = np.kron(matriz, np.ones((pixeles, pixeles), dtype=bool))
+    desplazamiento = (lado - esperado.shape[0]) // 2
+
+    hueco = tarjeta[y:y + lado, x:x + lado]
+    oscuros = hueco.sum(axis=2) < 384
+    qr_pegado = oscuros[desplazamiento:desplazamiento + esperado.shape[0], desplazamiento:desplazamiento + esperado.shape[1]]
+    assert np.array_equal(qr_pegado, esperado)
+    # Fuera del QR el hueco es fondo
+    assert oscuros.sum() == esperado.sum()